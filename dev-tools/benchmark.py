@@ -0,0 +1,306 @@
+"""End to end benchmark of redccd on synthetic nights
+
+Generates synthetic nights of several sizes with goodman_spec.simulator, runs
+redccd on each one in a fresh interpreter with ``--timing-report`` and
+``--memory-profile`` and collects the wall time, frames per second, peak memory
+and per-stage times. The results are compared against a stored baseline,
+usually recorded on the same machine before a change, and the script exits with
+status 1 when any measurement regresses beyond the tolerance.
+
+Usage:
+    python dev-tools/benchmark.py [--sizes small medium] [--save-baseline]
+
+The baseline is only meaningful on the machine where it was recorded, record
+a new one with ``--save-baseline`` before measuring a change.
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPO_PATH)
+
+DEFAULT_BASELINE = os.path.join(REPO_PATH, 'dev-tools',
+                                'benchmark-baseline.json')
+
+# arguments of goodman_spec.simulator.NightSimulator for every night size.
+NIGHT_SIZES = {'small': {'n_bias': 5,
+                         'n_flats': 5,
+                         'n_comps': 1,
+                         'n_objects': 2,
+                         'n_configurations': 1},
+               'medium': {'n_bias': 11,
+                          'n_flats': 7,
+                          'n_comps': 2,
+                          'n_objects': 5,
+                          'n_configurations': 2},
+               'large': {'n_bias': 21,
+                         'n_flats': 11,
+                         'n_comps': 3,
+                         'n_objects': 10,
+                         'n_configurations': 3}}
+
+# run level measurements compared against the baseline and whether a larger
+# value is better.
+RUN_METRICS = [('wall_seconds', False),
+               ('frames_per_second', True),
+               ('peak_rss_bytes', False)]
+
+
+def get_args(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+
+    parser.add_argument('--baseline',
+                        action='store',
+                        default=DEFAULT_BASELINE,
+                        metavar='<baseline_file>',
+                        help="Baseline JSON file. Default "
+                             "dev-tools/benchmark-baseline.json")
+
+    parser.add_argument('--binning',
+                        action='store',
+                        default='1x1',
+                        metavar='<SxP>',
+                        help="Binning of the synthetic data. Default 1x1")
+
+    parser.add_argument('--camera',
+                        action='store',
+                        default='Red',
+                        choices=['Blue', 'Red'],
+                        help="Camera of the synthetic data. Default Red")
+
+    parser.add_argument('--output',
+                        action='store',
+                        default=None,
+                        metavar='<results_file>',
+                        help="Write the results of this run to a JSON file.")
+
+    parser.add_argument('--redccd-args',
+                        action='store',
+                        default='--cosmic none',
+                        metavar='<arguments>',
+                        help="Extra arguments for redccd. "
+                             "Default '--cosmic none'")
+
+    parser.add_argument('--save-baseline',
+                        action='store_true',
+                        help="Store the results as the new baseline.")
+
+    parser.add_argument('--sizes',
+                        nargs='+',
+                        default=['small', 'medium'],
+                        choices=sorted(NIGHT_SIZES),
+                        help="Night sizes to run. Default small medium")
+
+    parser.add_argument('--tolerance',
+                        action='store',
+                        type=float,
+                        default=0.15,
+                        metavar='<fraction>',
+                        help="Allowed relative regression. Default 0.15")
+
+    parser.add_argument('--work-dir',
+                        action='store',
+                        default=None,
+                        metavar='<path>',
+                        help="Keep the synthetic nights in this directory and "
+                             "reuse them in later runs. By default they are "
+                             "written to a temporary directory and removed.")
+
+    return parser.parse_args(args=arguments)
+
+
+def generate_night(raw_path, size, camera, binning):
+    """Writes a synthetic night unless it already exists
+
+    The seed is fixed so that every run processes exactly the same data.
+
+    """
+    if os.path.isdir(raw_path) and os.listdir(raw_path):
+        print('Reusing synthetic night {:s}'.format(raw_path))
+        return
+    from goodman_spec.simulator import NightSimulator
+
+    start = time.time()
+    simulator = NightSimulator(path=raw_path,
+                               camera=camera,
+                               binning=binning,
+                               seed=42,
+                               **NIGHT_SIZES[size])
+    file_list = simulator()
+    print('Generated {:s} night, {:d} frames in {:.1f}s'.format(
+        size, len(file_list), time.time() - start))
+
+
+def run_redccd(raw_path, red_path, report_file, extra_args):
+    """Runs redccd in a fresh interpreter and returns its timing report"""
+    if os.path.isdir(red_path):
+        shutil.rmtree(red_path)
+    os.makedirs(red_path)
+    command = [sys.executable,
+               os.path.join(REPO_PATH, 'bin', 'redccd'),
+               '--raw-path', raw_path,
+               '--red-path', red_path,
+               '--timing-report', report_file,
+               '--memory-profile'] + extra_args
+    env = dict(os.environ, PYTHONPATH=REPO_PATH)
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        status = subprocess.call(command, stdout=devnull, env=env)
+    elapsed = time.time() - start
+    if status != 0 or not os.path.isfile(report_file):
+        raise RuntimeError('redccd failed with status {:d}: '
+                           '{:s}'.format(status, ' '.join(command)))
+    with open(report_file) as report:
+        result = json.load(report)
+    result['process_seconds'] = elapsed
+    return result
+
+
+def summarize(report):
+    """Keeps the measurements that are compared between runs"""
+    summary = {name: report.get(name) for name, _ in RUN_METRICS}
+    summary['frames'] = report.get('frames')
+    summary['process_seconds'] = report.get('process_seconds')
+    summary['stages'] = {
+        name: {'seconds': stage['seconds'],
+               'frames_per_second': stage.get('frames_per_second', 0.),
+               'peak_rss_bytes': stage.get('peak_rss_bytes')}
+        for name, stage in report['stages'].items()}
+    return summary
+
+
+def compare(result, baseline, tolerance):
+    """Prints the relative change of every measurement
+
+    Returns:
+        A list of the measurements that regressed beyond the tolerance.
+
+    """
+    regressions = []
+
+    def check(label, value, reference, larger_is_better):
+        if not value or not reference:
+            return
+        ratio = value / reference
+        regressed = ratio < 1 - tolerance if larger_is_better \
+            else ratio > 1 + tolerance
+        print('    {:32s} {:12.3f} {:12.3f} {:+7.1%}{:s}'.format(
+            label, reference, value, ratio - 1,
+            '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(label)
+
+    print('    {:32s} {:>12s} {:>12s} {:>7s}'.format('', 'baseline', 'current',
+                                                   'change'))
+    for name, larger_is_better in RUN_METRICS:
+        scale = 1e6 if name.endswith('bytes') else 1.
+        label = name.replace('_bytes', '_mb')
+        value, reference = result.get(name), baseline.get(name)
+        check(label,
+              value / scale if value else value,
+              reference / scale if reference else reference,
+              larger_is_better)
+    for name in sorted(baseline['stages']):
+        if name in result['stages']:
+            check('{:s} seconds'.format(name),
+                  result['stages'][name]['seconds'],
+                  baseline['stages'][name]['seconds'],
+                  False)
+    return regressions
+
+
+def main():
+    args = get_args()
+    binning = [int(b) for b in args.binning.lower().split('x')]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='goodman_benchmark_')
+    extra_args = shlex.split(args.redccd_args)
+
+    results = {}
+    try:
+        for size in args.sizes:
+            night_path = os.path.join(work_dir, '{:s}_{:s}_{:s}'.format(
+                size, args.camera, args.binning))
+            raw_path = os.path.join(night_path, 'raw')
+            generate_night(raw_path, size, args.camera, binning)
+            report = run_redccd(raw_path=raw_path,
+                                red_path=os.path.join(night_path, 'RED'),
+                                report_file=os.path.join(night_path,
+                                                         'report.json'),
+                                extra_args=extra_args)
+            results[size] = summarize(report)
+            print('{:8s} {:4d} frames {:8.2f}s {:6.2f} frames/s peak '
+                  '{:.0f}MB'.format(size,
+                                    results[size]['frames'] or 0,
+                                    results[size]['wall_seconds'],
+                                    results[size]['frames_per_second'],
+                                    (results[size]['peak_rss_bytes'] or 0)
+                                    / 1e6))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    run = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'host': platform.node(),
+           'python': sys.version.split()[0],
+           'camera': args.camera,
+           'binning': args.binning,
+           'redccd_args': args.redccd_args,
+           'results': results}
+
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            json.dump(run, output, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as output:
+            json.dump(run, output, indent=2, sort_keys=True)
+        print('Baseline saved to {:s}'.format(args.baseline))
+        sys.exit(0)
+
+    if not os.path.isfile(args.baseline):
+        print('No baseline found at {:s}, record one with '
+              '--save-baseline'.format(args.baseline))
+        sys.exit(0)
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline['host'] != run['host']:
+        print('WARNING: the baseline was recorded on {:s}, measurements are '
+              'not comparable between machines'.format(baseline['host']))
+    for key in ['camera', 'binning', 'redccd_args']:
+        if baseline.get(key) != run[key]:
+            print('WARNING: baseline {:s} is {!r}, this run used '
+                  '{!r}'.format(key, baseline.get(key), run[key]))
+
+    regressions = []
+    for size in args.sizes:
+        if size not in baseline['results']:
+            print('{:s}: not in the baseline'.format(size))
+            continue
+        print('{:s}:'.format(size))
+        regressions += ['{:s} {:s}'.format(size, name) for name in
+                        compare(results[size],
+                                baseline['results'][size],
+                                args.tolerance)]
+
+    if regressions:
+        print('Regressions beyond {:.0%}: {:s}'.format(args.tolerance,
+                                                      ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
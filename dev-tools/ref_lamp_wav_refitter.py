@@ -10,7 +10,6 @@ from ccdproc import CCDData
 from astropy import units as u
 import numpy as np
 import re
-import cPickle as pickle
 
 from goodman_spec.wsbuilder import ReadWavelengthSolution, WavelengthFitter
 from goodman_spec.linelist import ReferenceData
@@ -36,15 +35,15 @@ class ReFitWavelengthSolution(object):
                 ccd.header['OBJECT'])
 
             file_name = lfile.split('/')[-1]
-            pickle_file_name = re.sub('.fits', '_list.pkl', file_name)
+            list_file_name = re.sub('.fits', '_list.npz', file_name)
 
             manager = plt.get_current_fig_manager()
             manager.window.showMaximized()
-            if os.path.isfile(pickle_file_name):
-                with open(pickle_file_name, 'rb') as pickled_file:
-                    line_list = pickle.load(pickled_file)
-                    for ref_line in line_list:
-                        self.ax.axvline(ref_line, color='r', alpha=1)
+            if os.path.isfile(list_file_name):
+                with np.load(list_file_name) as stored_list:
+                    line_list = stored_list['wavelength']
+                for ref_line in line_list:
+                    self.ax.axvline(ref_line, color='r', alpha=1)
             else:
                 for ref_line in self.line_list:
                     self.ax.axvline(ref_line, color='r', alpha=.4)
@@ -61,10 +60,8 @@ class ReFitWavelengthSolution(object):
 
             if self.cleaned_list != []:
 
-                with open(pickle_file_name, 'wb') as list_file:
-                    pickle.dump(self.cleaned_list,
-                                list_file,
-                                protocol=pickle.HIGHEST_PROTOCOL)
+                np.savez(list_file_name,
+                         wavelength=np.array(self.cleaned_list, dtype=float))
 
     def on_click(self, event):
         print(event)
@@ -0,0 +1,109 @@
+"""Measures the startup time of redccd, redspec and goodman-reduce
+
+Runs ``<program> --help`` several times in a fresh interpreter and reports the
+best and median wall time, then checks which heavy modules got imported on the
+way. Exits with status 1 when the startup budget is exceeded or when a module
+that should be loaded lazily is imported while parsing the arguments.
+
+Usage:
+    python dev-tools/startup-time.py [--budget 0.5] [--repeat 5]
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROGRAMS = {'redccd': 'goodman_ccd',
+            'redspec': 'goodman_spec',
+            'goodman-reduce': 'goodman_spec.reduce'}
+
+# modules that must not be imported just to parse the command line.
+HEAVY_MODULES = ['matplotlib.pyplot',
+                 'mpl_toolkits.mplot3d',
+                 'astroplan',
+                 'scipy.signal',
+                 'ccdproc',
+                 'pandas']
+
+MODULE_CHECK = """
+import sys
+import {package:s}
+try:
+    {package:s}.MainApp()
+except SystemExit:
+    pass
+print(' '.join(sorted(m for m in {heavy!r} if m in sys.modules)))
+"""
+
+
+def time_help(program, repeat):
+    """Runs `program --help` `repeat` times and returns the elapsed times"""
+    script = os.path.join(REPO_PATH, 'bin', program)
+    env = dict(os.environ, PYTHONPATH=REPO_PATH)
+    elapsed = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.call([sys.executable, script, '--help'],
+                            stdout=devnull,
+                            stderr=devnull,
+                            env=env)
+            elapsed.append(time.time() - start)
+    return sorted(elapsed)
+
+
+def heavy_modules_loaded(package):
+    """Returns the heavy modules imported by parsing --help"""
+    code = MODULE_CHECK.format(package=package,
+                               heavy=[str(name) for name in HEAVY_MODULES])
+    env = dict(os.environ, PYTHONPATH=REPO_PATH)
+    output = subprocess.check_output([sys.executable, '-c', code, '--help'],
+                                     env=env,
+                                     stderr=open(os.devnull, 'w'))
+    # the help text is printed first, the module list is the last line.
+    return output.decode('utf-8').splitlines()[-1].split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--budget',
+                        action='store',
+                        type=float,
+                        default=0.5,
+                        metavar='<seconds>',
+                        help='Maximum acceptable best time. Default 0.5s')
+    parser.add_argument('--repeat',
+                        action='store',
+                        type=int,
+                        default=5,
+                        metavar='<n>',
+                        help='Number of runs per program. Default 5')
+    args = parser.parse_args()
+
+    failed = False
+    for program in sorted(PROGRAMS):
+        elapsed = time_help(program, args.repeat)
+        best = elapsed[0]
+        median = elapsed[len(elapsed) // 2]
+        loaded = heavy_modules_loaded(PROGRAMS[program])
+        status = 'OK'
+        if best > args.budget or loaded:
+            status = 'FAIL'
+            failed = True
+        print('{:14s} --help: best {:.3f}s median {:.3f}s budget {:.3f}s '
+              '[{:s}]'.format(program, best, median, args.budget, status))
+        if loaded:
+            print('    heavy modules imported: {:s}'.format(', '.join(loaded)))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
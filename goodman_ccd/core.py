@@ -9,27 +9,48 @@ import random
 import logging
 import ccdproc
 import numpy as np
-import numpy.ma as ma
-import matplotlib
 import shutil
 import subprocess
 from threading import Timer
 
-matplotlib.use('Qt4Agg')
-from matplotlib import pyplot as plt
 from ccdproc import CCDData, ImageFileCollection
 from astropy.coordinates import EarthLocation
 from astropy.time import Time, TimeDelta
 from astropy.stats import sigma_clip
-from astroplan import Observer
 from astropy import units as u
 from astropy.io import fits
+from astropy.nddata import StdDevUncertainty
 from astropy.modeling import (models, fitting, Model)
-from scipy import signal
+
+from . import optimal_extraction, tracing
+from .instrumentation import instrumentation
+from .lazy_import import LazyModule, plt
 
 log_ccd = logging.getLogger('goodmanccd.core')
 log_spec = logging.getLogger('redspec.core')
 
+signal = LazyModule('scipy.signal')
+
+# results of get_twilight_time by first and last date of the night
+_TWILIGHT_CACHE = {}
+
+# header keywords used to classify spectroscopic data
+SPECTROSCOPY_KEYWORDS = ['date',
+                         'slit',
+                         'date-obs',
+                         'obstype',
+                         'object',
+                         'exptime',
+                         'obsra',
+                         'obsdec',
+                         'grating',
+                         'cam_targ',
+                         'grt_targ',
+                         'filter',
+                         'filter2',
+                         'gain',
+                         'rdnoise']
+
 
 def convert_time(in_time):
     """Converts time to seconds since epoch
@@ -158,7 +179,7 @@ def print_spacers(message):
     return True
 
 
-def print_progress(current, total):
+def print_progress(current, total, start_time=None):
     """Prints the percentage of a progress
 
     It works for FOR loops, requires to know the full length of the loop.
@@ -170,12 +191,24 @@ def print_progress(current, total):
     Args:
         current (int): Current value in the range of the loop.
         total (int): The length of the loop.
+        start_time (float): Time in seconds since epoch when the loop started.
+            If given, the elapsed time and an estimate of the remaining time
+            are printed too.
 
     """
+    message = "Progress {:.2%}".format(1.0 * current / total)
+    if start_time is not None and current > 0:
+        elapsed = time.time() - start_time
+        remaining = elapsed * (total - current) / current
+        message += " ({:d}/{:d}) Elapsed {:s} ETA {:s}".format(
+            current,
+            total,
+            time.strftime('%H:%M:%S', time.gmtime(elapsed)),
+            time.strftime('%H:%M:%S', time.gmtime(remaining)))
     if current == total:
-        sys.stdout.write("Progress {:.2%}\n".format(1.0 * current / total))
+        sys.stdout.write("\r" + message + "\n")
     else:
-        sys.stdout.write("\rProgress {:.2%}".format(1.0 * current / total))
+        sys.stdout.write("\r" + message)
     sys.stdout.flush()
     return
 
@@ -199,6 +232,14 @@ def get_twilight_time(date_obs):
             'YYYY-MM-DDTHH:MM:SS.SS'
 
     """
+    # the same night is classified again by every run of a long lived process
+    key = (min(date_obs), max(date_obs))
+    if key in _TWILIGHT_CACHE:
+        return _TWILIGHT_CACHE[key]
+
+    # astroplan is slow to import and only needed here.
+    from astroplan import Observer
+
     # observatory(str): Observatory name.
     observatory = 'SOAR Telescope'
     geodetic_location = ['-70d44m01.11s', '-30d14m16.41s', 2748]
@@ -245,7 +286,11 @@ def get_twilight_time(date_obs):
     log_ccd.debug('Sun Set ' + sun_set_time)
     log_ccd.debug('Sun Rise ' + sun_rise_time)
 
-    return twilight_evening, twilight_morning, sun_set_time, sun_rise_time
+    _TWILIGHT_CACHE[key] = (twilight_evening,
+                            twilight_morning,
+                            sun_set_time,
+                            sun_rise_time)
+    return _TWILIGHT_CACHE[key]
 
 
 def image_overscan(ccd, overscan_region, add_keyword=False):
@@ -269,10 +314,11 @@ def image_overscan(ccd, overscan_region, add_keyword=False):
 
     """
     log_ccd.debug('Applying overscan Correction: {:s}'.format(overscan_region))
-    ccd = ccdproc.subtract_overscan(ccd=ccd,
-                                    median=True,
-                                    fits_section=overscan_region,
-                                    add_keyword=add_keyword)
+    with instrumentation.stage('overscan', frames=1):
+        ccd = ccdproc.subtract_overscan(ccd=ccd,
+                                        median=True,
+                                        fits_section=overscan_region,
+                                        add_keyword=add_keyword)
 
     ccd.header.add_history('Applied overscan correction ' + overscan_region)
     return ccd
@@ -296,9 +342,10 @@ def image_trim(ccd, trim_section, add_keyword=False):
         ccd (object): Trimmed ccdproc.CCDData instance
 
     """
-    ccd = ccdproc.trim_image(ccd=ccd,
-                             fits_section=trim_section,
-                             add_keyword=add_keyword)
+    with instrumentation.stage('trim', frames=1):
+        ccd = ccdproc.trim_image(ccd=ccd,
+                                 fits_section=trim_section,
+                                 add_keyword=add_keyword)
     ccd.header.add_history('Trimmed image to ' + trim_section)
 
     return ccd
@@ -569,7 +616,8 @@ def lacosmic_cosmicray_rejection(ccd, mask_only=False):
 
 
 def call_cosmic_rejection(ccd, image_name, out_prefix, red_path,
-                          dcr_par, keep_files=False, prefix='c', method='dcr'):
+                          dcr_par, keep_files=False, prefix='c', method='dcr',
+                          save=True):
     """Call for the appropriate cosmic ray rejection method
 
     There are three options when dealing with cosmic ray rejection in this
@@ -591,6 +639,13 @@ def call_cosmic_rejection(ccd, image_name, out_prefix, red_path,
             name.
         method (str): Method to use for cosmic ray rejection. There are three
             options: dcr, lacosmic and none.
+        save (bool): Write the resulting image to `red_path`. dcr works on
+            files so it always writes it.
+
+    Returns:
+        A tuple with the ccdproc.CCDData instance, None for dcr since the
+        cleaned image only exists on disk, and the file name of the resulting
+        image, None if the method is not recognized.
 
     """
 
@@ -599,37 +654,42 @@ def call_cosmic_rejection(ccd, image_name, out_prefix, red_path,
                         'the mask use --keep-cosmic-files')
         full_path = os.path.join(red_path, out_prefix + image_name)
         ccd.write(full_path, clobber=True)
+        instrumentation.record_write(full_path)
         log_ccd.info('Saving image: {:s}'.format(full_path))
 
         in_file = out_prefix + image_name
 
-        dcr_cosmicray_rejection(data_path=red_path,
-                                in_file=in_file,
-                                prefix=prefix,
-                                dcr_par_dir=dcr_par,
-                                delete=keep_files)
+        with instrumentation.stage('cosmic_rays', frames=1):
+            dcr_cosmicray_rejection(data_path=red_path,
+                                    in_file=in_file,
+                                    prefix=prefix,
+                                    dcr_par_dir=dcr_par,
+                                    delete=keep_files)
+        return None, prefix + in_file
 
     elif method == 'lacosmic':
         log_ccd.warning('LACosmic does not apply the correction to images '
                         'instead it updates the mask attribute for CCDData '
                         'objects. For saved files the mask is a fits extension')
 
-        ccd = lacosmic_cosmicray_rejection(ccd=ccd)
+        with instrumentation.stage('cosmic_rays', frames=1):
+            ccd = lacosmic_cosmicray_rejection(ccd=ccd)
 
         out_prefix = prefix + out_prefix
-        full_path = os.path.join(red_path, out_prefix + image_name)
-
-        ccd.write(full_path, clobber=True)
-        log_ccd.info('Saving image: {:s}'.format(full_path))
 
     elif method == 'none':
-        full_path = os.path.join(red_path, out_prefix + image_name)
         log_ccd.warning("--cosmic set to 'none'")
-        ccd.write(full_path, clobber=True)
-        log_ccd.info('Saving image: {:s}'.format(full_path))
 
     else:
         log_ccd.error('Unrecognized Cosmic Method {:s}'.format(method))
+        return None, None
+
+    if save:
+        full_path = os.path.join(red_path, out_prefix + image_name)
+        ccd.write(full_path, clobber=True)
+        instrumentation.record_write(full_path)
+        log_ccd.info('Saving image: {:s}'.format(full_path))
+    return ccd, out_prefix + image_name
 
 
 def get_best_flat(flat_name):
@@ -666,6 +726,7 @@ def get_best_flat(flat_name):
         #     master_flat_name =
 
         master_flat = CCDData.read(master_flat_name, unit=u.adu)
+        instrumentation.record_read(master_flat_name)
         log_ccd.debug('Found suitable master flat: {:s}'.format(master_flat_name))
         return master_flat, master_flat_name
     else:
@@ -793,6 +854,7 @@ def normalize_master_flat(master, name, method='simple', order=15):
 
     # write normalized flat to a file
     master.write(norm_name, clobber=True)
+    instrumentation.record_write(norm_name)
 
     return master
 
@@ -898,10 +960,9 @@ def classify_spectroscopic_data(path, search_pattern):
     This functions uses ImageFileCollection from ccdproc. First it creates a
     collection of information regarding the images located in *path* that match
     the pattern *search_pattern*
-    The information obtained are all keywords listed in the list *keywords*
-    The ImageFileCollection is translated into pandas.DataFrame and then is used
-    much like an SQL database to select and filter values and in that way put
-    them in groups that are pandas.DataFrame instances.
+    The information obtained are all keywords listed in the list
+    SPECTROSCOPY_KEYWORDS. The ImageFileCollection is translated into
+    pandas.DataFrame and then grouped, see `group_spectroscopic_data`.
 
 
     Args:
@@ -924,30 +985,36 @@ def classify_spectroscopic_data(path, search_pattern):
         sys.exit('Please use the argument --search-pattern to define the '
                  'common prefix for the files to be processed.')
 
+    with instrumentation.stage('header_scan', frames=len(file_list)):
+        ifc = ImageFileCollection(path,
+                                  keywords=SPECTROSCOPY_KEYWORDS,
+                                  filenames=file_list)
+
+        pifc = ifc.summary.to_pandas()
+
+    return group_spectroscopic_data(path=path, pifc=pifc)
+
+
+def group_spectroscopic_data(path, pifc):
+    """Groups spectroscopic data by pointing and instrument configuration
+
+    The table of keywords is used much like an SQL database to select and
+    filter values and in that way put them in groups that are
+    pandas.DataFrame instances.
+
+    Args:
+        path (str): Path to data location
+        pifc (object): pandas.DataFrame with a `file` column and one column
+            per keyword in SPECTROSCOPY_KEYWORDS.
+
+    Returns:
+        data_container (object): Instance of NightDataContainer
+
+    """
     data_container = NightDataContainer(path=path,
                                         instrument=str('Red'),
                                         technique=str('Spectroscopy'))
 
-    keywords = ['date',
-                'slit',
-                'date-obs',
-                'obstype',
-                'object',
-                'exptime',
-                'obsra',
-                'obsdec',
-                'grating',
-                'cam_targ',
-                'grt_targ',
-                'filter',
-                'filter2',
-                'gain',
-                'rdnoise']
-
-    ifc = ImageFileCollection(path, keywords=keywords, filenames=file_list)
-
-    pifc = ifc.summary.to_pandas()
-
     pifc['radeg'] = ''
     pifc['decdeg'] = ''
     for i in pifc.index.tolist():
@@ -982,21 +1049,33 @@ def classify_spectroscopic_data(path, search_pattern):
                            (pifc['gain'] == confs.iloc[i]['gain']) &
                            (pifc['rdnoise'] == confs.iloc[i]['rdnoise']))]
 
-        group_obstype = spec_group.obstype.unique()
-
-        if 'COMP' in group_obstype and len(group_obstype) == 1:
-            log_spec.debug('Adding COMP group')
-            data_container.add_comp_group(comp_group=spec_group)
-        elif 'OBJECT' in group_obstype and len(group_obstype) == 1:
-            log_spec.debug('Adding OBJECT group')
-            data_container.add_object_group(object_group=spec_group)
-        else:
-            log_spec.debug('Adding OBJECT-COMP group')
-            data_container.add_spec_group(spec_group=spec_group)
+        add_spectroscopic_group(data_container=data_container,
+                                spec_group=spec_group)
 
     return data_container
 
 
+def add_spectroscopic_group(data_container, spec_group):
+    """Adds a group to the data container according to its obstypes
+
+    Args:
+        data_container (object): Instance of NightDataContainer.
+        spec_group (object): pandas.DataFrame with the frames of the group.
+
+    """
+    group_obstype = spec_group.obstype.unique()
+
+    if 'COMP' in group_obstype and len(group_obstype) == 1:
+        log_spec.debug('Adding COMP group')
+        data_container.add_comp_group(comp_group=spec_group)
+    elif 'OBJECT' in group_obstype and len(group_obstype) == 1:
+        log_spec.debug('Adding OBJECT group')
+        data_container.add_object_group(object_group=spec_group)
+    else:
+        log_spec.debug('Adding OBJECT-COMP group')
+        data_container.add_spec_group(spec_group=spec_group)
+
+
 def search_comp_group(object_group, comp_groups):
     """Search for a suitable comparison lamp group
 
@@ -1046,7 +1125,8 @@ def spectroscopic_extraction(ccd, extraction,
                              comp_list=None,
                              nfind=3,
                              n_sigma_extract=10,
-                             plots=False):
+                             plots=False,
+                             trace_cache=None):
     """This function does not do the actual extraction but prepares the data
 
     There are several steps involved in a spectroscopic extraction, this
@@ -1059,6 +1139,10 @@ def spectroscopic_extraction(ccd, extraction,
         nfind (int): Maximum number of targets to be returned
         n_sigma_extract (int): Number of sigmas to be used for extraction
         plots (bool): If plots will be shown or not.
+        trace_cache (object): Optional goodman_ccd.tracing.TraceCache instance
+            shared by the exposures of the same pointing. Targets and traces
+            are taken from it when the exposure matches the previous one and
+            stored in it otherwise.
 
     Returns:
         extracted (list): List of ccdproc.CCDData instances
@@ -1079,22 +1163,40 @@ def spectroscopic_extraction(ccd, extraction,
         comp_list = []
     # print(comp_list)
 
-    iccd = remove_background_by_median(ccd=ccd)
+    with instrumentation.stage('target_identification', frames=1):
+        cached = None
+        if trace_cache is not None:
+            cached = trace_cache.lookup(data=ccd.data)
 
-    profile_model = identify_targets(ccd=iccd, nfind=nfind, plots=plots)
-    del (iccd)
+        if cached is None:
+            iccd = remove_background_by_median(ccd=ccd)
+
+            profile_model = identify_targets(ccd=iccd, nfind=nfind, plots=plots)
+            del (iccd)
+        else:
+            log_spec.info('Using targets and traces of the previous exposure')
+            profile_model, traces = cached
 
     if profile_model is None:
         log_spec.critical('Target identification FAILED!')
         raise NoTargetException
     else:
-        background_image = create_background_image(ccd=ccd,
-                                                   profile_model=profile_model,
-                                                   nsigma=n_sigma_extract,
-                                                   separation=5)
+        background_rows = get_background_rows(ccd=ccd,
+                                              profile_model=profile_model,
+                                              nsigma=n_sigma_extract,
+                                              separation=5)
 
     if isinstance(profile_model, Model):
-        traces = trace_targets(ccd=ccd, profile=profile_model, plots=plots)
+        if cached is None:
+            with instrumentation.stage('tracing', frames=1):
+                traces = trace_targets(ccd=ccd,
+                                       profile=profile_model,
+                                       plots=plots)
+            # stored before get_extraction_zone modifies the models
+            if trace_cache is not None:
+                trace_cache.store(data=ccd.data,
+                                  profile_model=profile_model,
+                                  traces=traces)
         # extract(ccd=ccd,
         #         spatial_profile=profile_model,
         #         n_sigma_extract=10,
@@ -1131,17 +1233,19 @@ def spectroscopic_extraction(ccd, extraction,
                     comp_zones.append(comp_zone)
 
                 background_level = get_background_value(
-                    background_image=background_image,
+                    ccd=ccd,
+                    background_rows=background_rows,
                     zone=zone)
 
-                extracted_ccd = extract(ccd=ccd,
-                                        trace=ntrace,
-                                        spatial_profile=model,
-                                        extraction=extraction,
-                                        zone=zone,
-                                        background_level=background_level,
-                                        sampling_step=10,
-                                        plots=plots)
+                with instrumentation.stage('extraction', frames=1):
+                    extracted_ccd = extract(ccd=ccd,
+                                            trace=ntrace,
+                                            spatial_profile=model,
+                                            extraction=extraction,
+                                            zone=zone,
+                                            background_level=background_level,
+                                            sampling_step=10,
+                                            plots=plots)
                 extracted.append(extracted_ccd)
 
                 # if plots:
@@ -1176,17 +1280,19 @@ def spectroscopic_extraction(ccd, extraction,
                 comp_zones.append(comp_zone)
 
             background_level = get_background_value(
-                background_image=background_image,
+                ccd=ccd,
+                background_rows=background_rows,
                 zone=zone)
 
-            extracted_ccd = extract(ccd=ccd,
-                                    trace=ntrace,
-                                    spatial_profile=profile_model,
-                                    extraction=extraction,
-                                    zone=zone,
-                                    background_level=background_level,
-                                    sampling_step=10,
-                                    plots=plots)
+            with instrumentation.stage('extraction', frames=1):
+                extracted_ccd = extract(ccd=ccd,
+                                        trace=ntrace,
+                                        spatial_profile=profile_model,
+                                        extraction=extraction,
+                                        zone=zone,
+                                        background_level=background_level,
+                                        sampling_step=10,
+                                        plots=plots)
 
             extracted.append(extracted_ccd)
 
@@ -1434,12 +1540,35 @@ def identify_targets(ccd, nfind=3, plots=False):
             return profile_model
 
 
+def fit_trace(sampling_axis, sample_values, good, trace_model, fitter):
+    """Fits a trace model to the samples of a trace
+
+    Args:
+        sampling_axis (array): First column of every sampled block.
+        sample_values (array): Trace position of every block.
+        good (array): Boolean array, False for samples to be left out. They
+            are only used when there are not enough good samples.
+        trace_model (object): An astropy.modeling.Model instance, usually a low
+            order polynomial.
+        fitter (object): An astropy.modeling.fitting.Fitter instance.
+
+    Returns:
+        An astropy.modeling.Model instance, that defines the trace of the
+            spectrum.
+
+    """
+    if np.sum(good) < len(trace_model.parameters):
+        log_spec.warning('Not enough good samples to fit the trace, using '
+                         'all of them')
+        good = np.ones(len(sample_values), dtype=bool)
+    return fitter(trace_model, sampling_axis[good], sample_values[good])
+
+
 def trace(ccd, model, trace_model, fitter, sampling_step, nsigmas=2):
     """Find the trace of a spectrum
 
     This function is called by the `trace_targets` targets, the difference is
-    that it only takes single models only not CompoundModels so this function
-    is called for every single target.
+    that it only takes single models only not CompoundModels.
 
     Notes:
         This method forces the trace to go withing a rectangular region of
@@ -1465,76 +1594,18 @@ def trace(ccd, model, trace_model, fitter, sampling_step, nsigmas=2):
             spectrum.
 
     """
-    spatial_length, dispersion_length = ccd.data.shape
-
-    sampling_axis = range(0, dispersion_length, sampling_step)
-    sample_values = []
-
-    model_stddev = model.stddev.value
-    model_mean = model.mean.value
-
-    sample_center = float(model_mean)
-
-    for point in sampling_axis:
-
-        lower_limit = int(sample_center - nsigmas * model_stddev)
-        upper_limit = int(sample_center + nsigmas * model_stddev)
-
-        # print(sample_center, nsigmas, model_stddev, lower_limit, upper_limit)
-
-        sample = ccd.data[lower_limit:upper_limit, point:point + sampling_step]
-        sample_median = np.median(sample, axis=1)
-
-        try:
-            sample_peak = np.argmax(sample_median)
-            # print(sample_peak + lower_limit)
-        except ValueError:
-            # plt.plot(model(range(spatial_length)))
-            # plt.plot(ccd.data[:,point])
-            # plt.show()
-            print('Nsigmas ', nsigmas)
-            print('Model Stddev ', model_stddev)
-            print('sample_center ', sample_center)
-            print('sample ', sample)
-            print('sample_median ', sample_median)
-            print('lower_limit ', lower_limit)
-            print('upper_limit ', upper_limit)
-            print('point ', point)
-            print('point + sampling_step ', point + sampling_step)
-            print(spatial_length, dispersion_length)
-            sys.exit()
-
-        sample_values.append(sample_peak + lower_limit)
-
-        if np.abs(sample_peak + lower_limit - model_mean) < nsigmas * model_stddev:
-            sample_center = int(sample_peak + lower_limit)
-        else:
-            # print(np.abs(sample_peak + lower_limit - model_mean), nsigmas * model_stddev)
-            sample_center = float(model_mean)
-
-    fitted_trace = fitter(trace_model, sampling_axis, sample_values)
-
-    if False:
-        plt.title(ccd.header['OFNAME'])
-        plt.imshow(ccd.data, clim=(30, 200))
-        plt.plot(sampling_axis, sample_values, color='y', marker='o')
-        plt.axhspan(lower_limit,
-                    upper_limit,
-                    alpha=0.4,
-                    color='g')
-        plt.plot(fitted_trace(range(dispersion_length)), color='c')
-        # plt.plot(model(range(spatial_length)))
-        if plt.isinteractive():
-            plt.draw()
-            plt.pause(2)
-        else:
-            plt.show()
-        # print(dispersion_length)
-        # print(sampling_axis)
-
-    # fitted_trace = None
+    sampling_axis, sample_values, good = tracing.sample_traces(
+        data=ccd.data,
+        means=[model.mean.value],
+        stddevs=[model.stddev.value],
+        sampling_step=sampling_step,
+        nsigmas=nsigmas)
 
-    return fitted_trace
+    return fit_trace(sampling_axis=sampling_axis,
+                     sample_values=sample_values[0],
+                     good=good[0],
+                     trace_model=trace_model,
+                     fitter=fitter)
 
 
 def trace_targets(ccd, profile, sampling_step=5, pol_deg=2, plots=True):
@@ -1542,15 +1613,14 @@ def trace_targets(ccd, profile, sampling_step=5, pol_deg=2, plots=True):
 
     This function defines a low order polynomial that trace the location of the
     spectrum. The attributes pol_deg and sampling_step define the polynomial
-    degree and the spacing in pixels for the samples. For every sample a
-    gaussian model is fitted and the center (mean) is recorded and since
-    spectrum traces vary smoothly this value is used as a new center for the
-    base model used to fit the spectrum profile.
+    degree and the spacing in pixels for the samples. For every sample the
+    peak of the median spatial profile is recorded and since spectrum traces
+    vary smoothly the samples are used to center the search of the following
+    ones.
 
     Notes:
-        This doesn't work for extended sources. Also this calls for the function
-        trace for doing the actual trace, the difference is that this method is
-        at a higher level.
+        This doesn't work for extended sources. All the targets are sampled
+        together, see `goodman_ccd.tracing.sample_traces`.
 
     Args:
         ccd (object): Instance of ccdproc.CCDData
@@ -1576,56 +1646,34 @@ def trace_targets(ccd, profile, sampling_step=5, pol_deg=2, plots=True):
     # Initialize the model to fit the traces
     trace_model = models.Polynomial1D(degree=pol_deg)
 
-    # List that will contain all the Model instances corresponding to traced
-    # targets
-    all_traces = None
-
     if 'CompoundModel' in profile.__class__.name:
         log_spec.debug(profile.__class__.name)
         # TODO (simon): evaluate if targets are too close together.
+        target_models = [profile[submodel_name]
+                         for submodel_name in profile.submodel_names]
+        nsigmas = 2
+    else:
+        target_models = [profile]
+        nsigmas = 10
 
-        stddev_keys = [key for key in profile._param_names if 'stddev' in key]
-
-        mean_keys = [key for key in profile._param_names if 'mean' in key]
-
-        stddev_values = [
-            profile.__getattribute__(key).value for key in stddev_keys]
-
-        mean_values = [
-            profile.__getattribute__(key).value for key in mean_keys]
-
-        # if len(mean_values) == 1:
-        #     nsigmas = 20
-        # else:
-        #     # get maximum width
-        #     for i in range(len(mean_values)-1):
-
-
-        for m in range(len(profile.submodel_names)):
-            submodel_name = profile.submodel_names[m]
-
-            model = profile[submodel_name]
-
-            single_trace = trace(ccd=ccd,
-                                 model=model,
-                                 trace_model=trace_model,
-                                 fitter=model_fitter,
-                                 sampling_step=sampling_step)
+    sampling_axis, sample_values, good = tracing.sample_traces(
+        data=ccd.data,
+        means=[model.mean.value for model in target_models],
+        stddevs=[model.stddev.value for model in target_models],
+        sampling_step=sampling_step,
+        nsigmas=nsigmas)
 
-            if all_traces is None:
-                all_traces = [single_trace]
-            else:
-                all_traces.append(single_trace)
+    # List that will contain all the Model instances corresponding to traced
+    # targets
+    all_traces = []
+    for m in range(len(target_models)):
+        all_traces.append(fit_trace(sampling_axis=sampling_axis,
+                                    sample_values=sample_values[m],
+                                    good=good[m],
+                                    trace_model=trace_model,
+                                    fitter=model_fitter))
 
-        return all_traces
-    else:
-        single_trace = trace(ccd=ccd,
-                             model=profile,
-                             trace_model=trace_model,
-                             fitter=model_fitter,
-                             sampling_step=sampling_step,
-                             nsigmas=10)
-        return [single_trace]
+    return all_traces
 
 
 def get_extraction_zone(ccd,
@@ -1662,23 +1710,19 @@ def get_extraction_zone(ccd,
         zone (list): Low and high limits to extract
 
     Returns:
-        nccd (object): Instance of ccdproc.CCDData that contains only the region
-            extracted from the full image. The header is updated with a new HISTORY
-            keyword that contain the region of the original image extracted.
-        model (object): Instance of astropy.modeling.Model with an updated mean
-            to match the new center in pixel units.
-        zone (list): Low and high limits of extraction zone
+        zone (list): Low and high limits of extraction zone, when `zone` is
+            not given. Otherwise an instance of ccdproc.CCDData whose data is a
+            view of the region of the full image within `zone`. The header is
+            updated with a new HISTORY keyword that contain the region of the
+            original image extracted.
 
     """
-    # make a copy of the ccd image
-    nccd = ccd.copy()
-
     if zone is None and extraction is not None:
         assert (model is not None) and (n_sigma_extract is not None)
         assert isinstance(trace, Model)
         log_spec.debug('Extracting zone centered at: {:.3f}'.format(model.mean.value))
 
-        spatial_length, dispersion_length = nccd.data.shape
+        spatial_length, dispersion_length = ccd.data.shape
 
         # get maximum variation in spatial direction
         trace_array = trace(range(dispersion_length))
@@ -1703,15 +1747,6 @@ def get_extraction_zone(ccd,
         log_spec.debug('Zone: low {:d}, high {:d}'.format(low_lim, hig_lim))
         zone = [low_lim, hig_lim]
 
-        # This is to define the APNUM1 Keyword for the header.
-
-        apnum_1 = '{:d} {:d} {:d} {:d}'.format(trace_index + 1,
-                                              1,
-                                              low_lim,
-                                              hig_lim)
-
-        nccd.header['APNUM1'] = apnum_1
-
         # this is necessary since we are cutting a piece of the full ccd.
         trace.c0.value -= low_lim
         log_spec.debug('Changing attribute c0 from trace, this is to adjust it to '
@@ -1720,15 +1755,6 @@ def get_extraction_zone(ccd,
         log_spec.debug('Changing attribute mean of profile model')
         model.mean.value = extract_width
 
-
-
-        nccd.data = nccd.data[low_lim:hig_lim, :]
-        if nccd.mask is not None:
-            log_spec.debug('Trimming mask')
-            nccd.mask = nccd.mask[low_lim:hig_lim, :]
-        nccd.header['HISTORY'] = 'Subsection of CCD ' \
-                                 '[{:d}:{:d}, :]'.format(low_lim, hig_lim)
-
         if plots:
             plt.imshow(ccd.data, clim=(0, 60))
             plt.axhspan(low_lim, hig_lim, color='r', alpha=0.2)
@@ -1746,13 +1772,13 @@ def get_extraction_zone(ccd,
                                                low_lim,
                                                hig_lim)
 
-        nccd = ccd.copy()
-        nccd.header['APNUM1'] = apnum_1
-
-        nccd.data = nccd.data[low_lim:hig_lim, :]
-        if nccd.mask is not None:
+        # slicing rows gives views, the full image is not copied
+        mask = None
+        if ccd.mask is not None:
             log_spec.debug('Trimming mask')
-            nccd.mask = nccd.mask[low_lim:hig_lim, :]
+            mask = ccd.mask[low_lim:hig_lim, :]
+        nccd = ccd_view(ccd=ccd, data=ccd.data[low_lim:hig_lim, :], mask=mask)
+        nccd.header['APNUM1'] = apnum_1
         nccd.header['HISTORY'] = 'Subsection of CCD ' \
                                  '[{:d}:{:d}, :]'.format(low_lim, hig_lim)
         return nccd
@@ -1796,6 +1822,29 @@ def add_wcs_keys(header):
         log_spec.debug(err)
 
 
+def ccd_view(ccd, data, mask=None):
+    """Creates a ccdproc.CCDData instance that shares data with another one
+
+    `ccdproc.CCDData.copy` duplicates the data, the mask and the uncertainty,
+    which is wasteful when only a few rows, or a 1D spectrum, are going to be
+    kept. The new instance holds the given array without copying it, only the
+    header is copied.
+
+    Args:
+        ccd (object): A ccdproc.CCDData instance, provides header and unit.
+        data (array): Data of the new instance, usually a view of `ccd.data`.
+        mask (array): Optional mask of the new instance.
+
+    Returns:
+        A new ccdproc.CCDData instance.
+
+    """
+    return CCDData(data=data,
+                   mask=mask,
+                   header=ccd.header.copy(),
+                   unit=ccd.unit)
+
+
 def remove_background_by_median(ccd, plots=False):
     """Remove Background of a ccd spectrum image
 
@@ -1807,34 +1856,41 @@ def remove_background_by_median(ccd, plots=False):
         ccd (object): A ccdproc.CCDData instance.
 
     Returns:
-        ccd (object): The modified ccdproc.CCDData instance.
+        ccd (object): A new ccdproc.CCDData instance with the median of every
+            column subtracted. Invalid pixels are set to -inf.
 
     """
-    new_ccd = ccd.copy()
-    data = ma.masked_invalid(new_ccd.data)
-    # x, y = ccd.data.shape
-    median = ma.median(data, axis=0)
+    # this is the only full size buffer, the median is computed in place
+    data = np.array(ccd.data, dtype=float)
+    invalid = ~np.isfinite(data)
+    if invalid.any():
+        data[invalid] = np.nan
+        with np.errstate(invalid='ignore'):
+            median = np.nanmedian(data, axis=0)
+    else:
+        median = np.median(data, axis=0)
 
     data -= median
-    data.set_fill_value(-np.inf)
-    new_ccd.data = data.filled()
+    data[np.isnan(data)] = -np.inf
 
-    # ccd.write('/user/simon/dummy_{:d}.fits'.format(g), clobber=True)
-    return new_ccd
+    return ccd_view(ccd=ccd, data=data)
 
 
-def get_background_value(background_image, zone_sep=0.5, zone=None):
+def get_background_value(ccd, background_rows, zone_sep=0.5, zone=None):
     """finds background value for each dispersion line
 
-    A background image is an image whose spectrum has been masked with zeros,
-    the spectrum zone is retrieved by analyzing the pixels values and then two
+    The rows of the image that belong to any target are marked as False in
+    `background_rows`, the spectrum zone is retrieved from them and then two
     background zones are defined at a distance from the edges of the target zone
     defined by zone_sep, the width of the background zone is the same as the
-    target's. After validating the background zone they averaged by median along
-    the spatial direction. If there are two zones they are averaged as well.
+    target's. Target rows that fall inside the background zones are left out.
+    After validating the background zone they averaged by median along the
+    spatial direction. If there are two zones they are averaged as well.
 
     Args:
-        background_image (object): ccdproc.CCDData instance. Spectra are masked.
+        ccd (object): ccdproc.CCDData instance, the full 2D spectrum.
+        background_rows (array): Boolean array with one element per row of
+            `ccd`, False where there is a target. See `get_background_rows`.
         zone_sep (float): How far the background zone should be from the edges
             of the target zone. Default 0.5.
         zone (list): Alternative you could parse the zone as a list with each
@@ -1845,11 +1901,9 @@ def get_background_value(background_image, zone_sep=0.5, zone=None):
         A 1D array the same length of the dispersion length.
 
     """
-    spatial_length, dispersion_length = background_image.data.shape
+    spatial_length, dispersion_length = ccd.data.shape
     if zone is None:
-        background_profile = np.median(background_image.data, axis=1)
-
-        target_zones_points = np.where(background_profile == 0)[0]
+        target_zones_points = np.where(~background_rows)[0]
 
         target_zones = [i + 1 for i in range(len(target_zones_points) - 1) \
                         if
@@ -1883,15 +1937,19 @@ def get_background_value(background_image, zone_sep=0.5, zone=None):
 
     zone_width = zone[1] - zone[0]
 
+    # only the rows without targets are read, indexing them copies just the
+    # background zone
+    rows = np.arange(spatial_length)
+
     # first background zone
     back_first_low = int(zone[0] - (1 + zone_sep) * zone_width)
     back_first_high = int(zone[0] - zone_sep * zone_width)
-    if 0 < back_first_low < back_first_high:
+    if 0 < back_first_low < back_first_high and \
+            background_rows[back_first_low:back_first_high].any():
 
-        first_background = np.median(background_image.data[
-                                     back_first_low:back_first_high,
-                                     :],
-                                     axis=0)
+        first_rows = rows[back_first_low:back_first_high][
+            background_rows[back_first_low:back_first_high]]
+        first_background = np.median(ccd.data[first_rows, :], axis=0)
     else:
         log_spec.debug('Zone [{:d}:{:d}] is forbidden'.format(
             back_first_low,
@@ -1900,12 +1958,12 @@ def get_background_value(background_image, zone_sep=0.5, zone=None):
     # second background zone
     back_second_low = int(zone[-1] + zone_sep * zone_width)
     back_second_high = int(zone[-1] + (1 + zone_sep) * zone_width)
-    if back_second_low < back_second_high < spatial_length:
+    if back_second_low < back_second_high < spatial_length and \
+            background_rows[back_second_low:back_second_high].any():
 
-        second_background = np.mean(background_image.data[
-                                    back_second_low:back_second_high,
-                                    :],
-                                    axis=0)
+        second_rows = rows[back_second_low:back_second_high][
+            background_rows[back_second_low:back_second_high]]
+        second_background = np.mean(ccd.data[second_rows, :], axis=0)
     else:
         log_spec.debug('Zone [{:d}:{:d}] is forbidden'.format(
             back_second_low,
@@ -1925,8 +1983,8 @@ def get_background_value(background_image, zone_sep=0.5, zone=None):
         return 0
 
 
-def create_background_image(ccd, profile_model, nsigma, separation):
-    """Creates a background-only image
+def get_background_rows(ccd, profile_model, nsigma, separation):
+    """Finds the rows of an image that contain only background
 
     Using a profile model and assuming the spectrum is misaligned only a little
     bit (i.e. a couple of pixels from end to end) with respect to the lines of
@@ -1943,11 +2001,12 @@ def create_background_image(ccd, profile_model, nsigma, separation):
             target zone.
 
     Returns:
-        A ccdproc.CCDData instance with the spectrum masked.
+        A boolean array with one element per row, False for the rows covered
+        by a target.
 
     """
-    background_ccd = ccd.copy()
-    spatial_length, dispersion_length = background_ccd.data.shape
+    spatial_length, dispersion_length = ccd.data.shape
+    background_rows = np.ones(spatial_length, dtype=bool)
     target_profiles = []
     if 'CompoundModel' in profile_model.__class__.name:
         log_spec.debug(profile_model.submodel_names)
@@ -1962,20 +2021,15 @@ def create_background_image(ccd, profile_model, nsigma, separation):
         target_mean = target.mean.value
         target_stddev = target.stddev.value
 
-        data_low_lim = np.max(
-            [0, target_mean - (nsigma / 2. + separation) * target_stddev])
+        data_low_lim = int(np.max(
+            [0, target_mean - (nsigma / 2. + separation) * target_stddev]))
 
         data_high_lim = np.min([spatial_length, int(
             target_mean + (nsigma / 2. + separation) * target_stddev)])
 
-        background_ccd.data[data_low_lim:data_high_lim, :] = 0
+        background_rows[data_low_lim:data_high_lim] = False
 
-    if False:
-        plt.title('Background Image')
-        plt.imshow(background_ccd.data, clim=(0, 50))
-        plt.show()
-
-    return background_ccd
+    return background_rows
 
 
 def extract(ccd,
@@ -1992,7 +2046,10 @@ def extract(ccd,
     simple sum in the spatial direction and an optimal extraction.
 
     Notes:
-        For the beta release the optimal extraction is not implemented.
+        The optimal extraction follows Horne (1986), see
+        `goodman_ccd.optimal_extraction`. It uses a gaussian profile that
+        follows the trace when `spatial_profile` is a Gaussian1D model and an
+        empirical profile otherwise.
 
     Args:
         ccd (object): Instance of ccdproc.CCDData containing a 2D spectrum
@@ -2001,109 +2058,64 @@ def extract(ccd,
         spatial_profile (object): Instance of astropy.modeling.Model, a Gaussian
             model previously fitted to the spatial profile of the 2D spectrum
             contained in the ccd object.
-        extraction (str): Extraction type, can be `simple` or `optimal` for the
-            beta release the optimal extraction is not implemented yet.
-        zone (list):
-        background_level (array):
-        sampling_step (int): The optimal extraction needs to sample the spatial
-            profile, this value defines the intervals at which get such
-            sampling.
+        extraction (str): Extraction type, can be `simple` or `optimal`.
+        zone (list): Low and high limits of the extraction zone.
+        background_level (array): Background of every column in ADU per pixel.
+        sampling_step (int): Not used, kept for compatibility.
         plots (bool): Determines whether display plots or not.
 
     Returns:
         ccd (object): Instance of ccdproc.CCDData containing a 1D spectrum. The
             attribute 'data' is replaced by the 1D array resulted from the
-            extraction process.
-
-    Raises:
-        NotImplementedError: When `extraction` is optimal, this is valid for the
-            beta release
+            extraction process. The optimal extraction also sets the attribute
+            'uncertainty', a StdDevUncertainty instance.
 
     """
     assert isinstance(ccd, CCDData)
     assert isinstance(trace, Model)
 
-    nccd = ccd.copy()
-
-    spatial_length, dispersion_length = nccd.data.shape
+    spatial_length, dispersion_length = ccd.data.shape
 
     apnum1 = '{:d} {:d} {:d} {:d}'.format(1, 1, zone[0], zone[1])
     log_spec.debug('APNUM1 Keyword: {:s}'.format(apnum1))
 
-    # create variance model
-    rdnoise = float(nccd.header['RDNOISE'])
-    gain = float(nccd.header['GAIN'])
-    log_spec.debug('Original Name {:s}'.format(nccd.header['OFNAME']))
-
-    variance_2d = (rdnoise + np.absolute(nccd.data) * gain) / gain
-    cr_mask = np.ones(nccd.data.shape, dtype=int)
-    # if nccd.mask is None and nccd.header['OBSTYPE'] == 'OBJECT':
-    #     log_spec.debug('Finding cosmic rays to create mask')
-    #     cr_mask = cosmicray_rejection(ccd=ccd, mask_only=True)
-    #     cr_mask = np.log_spec.cal_not(cr_mask).astype(int)
-    # elif nccd.mask is None and nccd.header['OBSTYPE'] != 'OBJECT':
-    #     log_spec.debug('Only OBSTYPE == OBJECT get cosmic ray rejection.')
-    #     cr_mask = np.ones(nccd.data.shape, dtype=int)
-    # else:
-    #     log_spec.debug('Cosmic ray mask already exists.')
-    #     cr_mask = np.logical_not(nccd.mask).astype(int)
+    # spectrum zone limit, everything below works on views of these rows
+    low_lim, high_lim = zone
+    zone_data = ccd.data[low_lim:high_lim, :]
 
-    model_fitter = fitting.LevMarLSQFitter()
+    # create variance model
+    rdnoise = float(ccd.header['RDNOISE'])
+    gain = float(ccd.header['GAIN'])
+    log_spec.debug('Original Name {:s}'.format(ccd.header['OFNAME']))
 
-    # print(spatial_profile.mean.value)
-    # print(trace.c0.value)
-
-    if isinstance(spatial_profile, models.Gaussian1D):
-        amplitude = spatial_profile.amplitude.value
-        mean = spatial_profile.mean.value
-        stddev = spatial_profile.stddev.value
-        new_model = models.Gaussian1D(amplitude=amplitude,
-                                      mean=mean,
-                                      stddev=stddev)
-        # print('Fixed ', new_model.mean.fixed)
-    else:
-        raise NotImplementedError
-    log_spec.debug('nccd.data is a masked array: '
-              '{:s}'.format(str(np.ma.isMaskedArray(nccd.data))))
+    log_spec.debug('ccd.data is a masked array: '
+              '{:s}'.format(str(np.ma.isMaskedArray(ccd.data))))
 
-    nccd.data = np.ma.masked_invalid(nccd.data)
-    # print(np.ma.isMaskedArray(nccd.data))
-    np.ma.set_fill_value(nccd.data, 0)
+    # the result is a new instance, the input image is never copied
+    nccd = ccd_view(ccd=ccd, data=np.zeros(dispersion_length))
+    nccd.header['APNUM1'] = apnum1
 
     if extraction == 'simple':
 
-
-        # print(indexes)
         if plots:
-            indexes = np.argwhere(cr_mask == 0)
             fig = plt.figure(1)
             ax1 = fig.add_subplot(111)
-            for index in indexes:
-                x, y = index
-                ax1.plot(y, x, marker='o', color='r')
-
-            ax1.imshow(nccd.data, interpolation='none')
+            ax1.imshow(zone_data, interpolation='none')
             if plt.isinteractive():
                 plt.draw()
                 plt.pause(1)
             else:
                 plt.show()
 
-        # print(np.ma.isMaskedArray(nccd.data))
-        # spectrum zone limit
-        low_lim, high_lim = zone
-        spectrum_masked = nccd.data * cr_mask
-        # plt.imshow(spectrum_masked, clim=(10, 70))
-        # plt.show()
+        # invalid pixels do not contribute to the sum
         # TODO (simon): Add fractional pixel
-        spectrum_sum = np.ma.sum(spectrum_masked[low_lim:high_lim, :], axis=0)
+        spectrum_sum = np.sum(np.where(np.isfinite(zone_data), zone_data, 0),
+                              axis=0)
 
         background_sum = np.abs(high_lim - low_lim) * background_level
 
         nccd.data = spectrum_sum - background_sum
 
-        nccd.header['APNUM1'] = apnum1
-
         if plots:
             fig = plt.figure()
             fig.canvas.set_window_title('Simple Extraction')
@@ -2131,82 +2143,58 @@ def extract(ccd,
                 plt.show()
 
     elif extraction == 'optimal':
-        raise NotImplementedError
-        # out_spectrum = np.empty(dispersion_length)
-        # for i in range(0, dispersion_length, sampling_step):
-        #     # force the model to follow the trace
-        #     new_model.mean.value = trace(i)
-        #
-        #     # warn if the difference of the spectrum position in the trace at the
-        #     # extremes of the sampling range is larger than 1 pixel.
-        #     if np.abs(trace(i) - trace(i + sampling_step)) > 1:
-        #         log_spec.warning('Sampling step might be too large')
-        #
-        #     sample = np.median(nccd.data[:, i:i + sampling_step], axis=1)
-        #     fitted_profile = model_fitter(model=new_model,
-        #                                   x=range(len(sample)),
-        #                                   y=sample)
-        #
-        #     profile = fitted_profile(range(sample.size))
-        #
-        #     # enforce positivity
-        #     pos_profile = np.array([np.max([0, x]) for x in profile])
-        #
-        #     # enforce normalization
-        #     nor_profile = np.array([x / pos_profile.sum() for x in pos_profile])
-        #
-        #     if sampling_step > 1:
-        #         # TODO (simon): Simplify to Pythonic way
-        #         right = min((i + sampling_step), dispersion_length)
-        #
-        #         for e in range(i, right, 1):
-        #             mask = cr_mask[:, e]
-        #             data = ma.masked_invalid(nccd.data[:, e])
-        #             # print(ma.isMaskedArray(data))
-        #             V = variance_2d[:, e]
-        #             P = nor_profile
-        #             a = [(P[z] / V[z]) / np.sum(P ** 2 / V) for z in
-        #                  range(P.size)]
-        #             weights = (nor_profile / variance_2d[:, e]) / np.sum(
-        #                 nor_profile ** 2 / variance_2d[:, e])
-        #             # print('SUMN ', np.sum(a), np.sum(weights), np.sum(nor_profile), np.sum(P * weights))
-        #
-        #
-        #
-        #             # if e in range(5, 4001, 500):
-        #             #     plt.plot(nor_profile * data.max()/ nor_profile.max(), label=str(e))
-        #             #     plt.plot(data, label='Data')
-        #             #     plt.legend(loc='best')
-        #             #     plt.show()
-        #
-        #             out_spectrum[e] = np.sum(data * mask * nor_profile)
-        # nccd.data = out_spectrum
-        # if plots:
-        #     fig = plt.figure()
-        #     fig.canvas.set_window_title('Optimal Extraction')
-        #     # ax = fig.add_subplot(111)
-        #     manager = plt.get_current_fig_manager()
-        #
-        #     if plt.get_backend() == u'GTK3Agg':
-        #         manager.window.maximize()
-        #     elif plt.get_backend() == u'Qt4Agg':
-        #         manager.window.showMaximized()
-        #
-        #     plt.title(nccd.header['OBJECT'])
-        #     plt.xlabel('Dispersion Axis (Pixels)')
-        #     plt.ylabel('Intensity (Counts)')
-        #     # plt.plot(simple_sum, label='Simple Sum', color='k', alpha=0.5)
-        #     plt.plot(nccd.data, color='k',
-        #              label='Optimal Extracted')
-        #     plt.xlim((0, len(nccd.data)))
-        #     plt.legend(loc='best')
-        #     if plt.isinteractive():
-        #         plt.draw()
-        #         plt.pause(1)
-        #     else:
-        #         plt.show()
-
-    # nccd.data = out_spectrum
+        # CCD noise model in ADU squared
+        variance_2d = (rdnoise / gain) ** 2 + np.absolute(zone_data) / gain
+
+        if isinstance(spatial_profile, models.Gaussian1D):
+            # the trace was shifted to the rows of the zone
+            profile = optimal_extraction.gaussian_profile(
+                trace=trace,
+                stddev=spatial_profile.stddev.value,
+                shape=zone_data.shape)
+        else:
+            log_spec.debug('Using empirical profile for optimal extraction')
+            profile = optimal_extraction.empirical_profile(
+                data=zone_data,
+                background=background_level)
+
+        spectrum, variance, rejected = optimal_extraction.extract_optimal(
+            data=zone_data,
+            profile=profile,
+            background=background_level,
+            variance=variance_2d,
+            rdnoise=rdnoise,
+            gain=gain)
+
+        nccd.data = spectrum
+        nccd.uncertainty = StdDevUncertainty(np.sqrt(variance))
+        nccd.header['HISTORY'] = 'Optimal extraction, {:d} pixels ' \
+                                 'rejected'.format(int(np.sum(rejected)))
+
+        if plots:
+            fig = plt.figure()
+            fig.canvas.set_window_title('Optimal Extraction')
+            manager = plt.get_current_fig_manager()
+
+            if plt.get_backend() == u'GTK3Agg':
+                manager.window.maximize()
+            elif plt.get_backend() == u'Qt4Agg':
+                manager.window.showMaximized()
+
+            plt.title(nccd.header['OBJECT'])
+            plt.xlabel('Dispersion Axis (Pixels)')
+            plt.ylabel('Intensity (Counts)')
+            plt.plot(nccd.data, color='k',
+                     label='Optimal Extracted')
+            plt.plot(np.sqrt(variance), color='r', label='Standard Deviation')
+            plt.xlim((0, len(nccd.data)))
+            plt.legend(loc='best')
+            if plt.isinteractive():
+                plt.draw()
+                plt.pause(1)
+            else:
+                plt.show()
+
     return nccd
 
 
@@ -5,6 +5,7 @@ import numpy as np
 import random
 from ccdproc import ImageFileCollection
 from .core import fix_duplicated_keywords, remove_conflictive_keywords
+from .instrumentation import instrumentation
 
 log = logging.getLogger('goodmanccd.dataclassifier')
 
@@ -84,8 +85,9 @@ class DataClassifier(object):
         """
         while True:
             try:
-                ifc = ImageFileCollection(night_folder)
-                self.image_collection = ifc.summary.to_pandas()
+                with instrumentation.stage('header_scan'):
+                    ifc = ImageFileCollection(night_folder)
+                    self.image_collection = ifc.summary.to_pandas()
 
                 self.objects_collection = self.image_collection[
                     self.image_collection.obstype != 'BIAS']
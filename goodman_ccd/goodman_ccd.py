@@ -5,12 +5,9 @@ import shutil
 import argparse
 import glob
 import logging
-import matplotlib
-matplotlib.use('Qt4Agg')
 
-from .data_classifier import DataClassifier
-from .night_organizer import NightOrganizer
-from .image_processor import ImageProcessor
+from .instrumentation import instrumentation
+from .memory_budget import memory_budget, parse_memory_size
 
 __author__ = 'David Sanmartim'
 __date__ = '2016-07-15'
@@ -42,7 +39,18 @@ def get_args(arguments=None):
             attributes
 
     """
+    parser = get_parser()
+    args = parser.parse_args(args=arguments)
+    return check_args(parser=parser, args=args)
+
 
+def get_parser():
+    """Creates the parser of the command line arguments
+
+    Returns:
+        An argparse.ArgumentParser instance.
+
+    """
     parser = argparse.ArgumentParser(
         description="Goodman CCD Reduction - CCD reductions for Goodman "
                     "spectroscopic data.")
@@ -123,6 +131,24 @@ def get_args(arguments=None):
                              "deleted each time you run this "
                              "program".format(LOG_FILENAME))
 
+    parser.add_argument('--max-memory',
+                        action='store',
+                        dest='max_memory',
+                        metavar='<size>',
+                        type=parse_memory_size,
+                        default=None,
+                        help="Memory budget, i.e. 4G or 512M. When the frames "
+                             "to combine into a master bias or flat do not "
+                             "fit in it they are combined from disk instead. "
+                             "Default is no limit.")
+
+    parser.add_argument('--memory-profile',
+                        action='store_true',
+                        dest='memory_profile',
+                        help="Record the peak memory used by every processing "
+                             "stage. It is added to the --timing-report file "
+                             "or logged at the end of the run.")
+
     parser.add_argument('--raw-path',
                         action='store',
                         metavar='<raw_path>',
@@ -144,8 +170,29 @@ def get_args(arguments=None):
                         metavar='<value>',
                         help="Saturation limit. Default to 65.000 ADU (counts)")
 
-    args = parser.parse_args(args=arguments)
+    parser.add_argument('--timing-report',
+                        action='store',
+                        dest='timing_report',
+                        metavar='<report_file>',
+                        default=None,
+                        help="Time every processing stage, count frames and "
+                             "bytes read and written, show a progress line "
+                             "and write a JSON report to <report_file>.")
+
+    return parser
+
+
+def check_args(parser, args):
+    """Validates the arguments and sets up logging
 
+    Args:
+        parser (object): The argparse.ArgumentParser that parsed `args`.
+        args (object): argparse.Namespace instance.
+
+    Returns:
+        The argparse.Namespace instance with full paths.
+
+    """
     # define log file
     # the log file will be stored in the same directory that the program
     # is called
@@ -219,6 +266,14 @@ class MainApp(object):
         Any subdirectory will be ignored.
 
         """
+        # the processing modules pull in ccdproc, astropy and pandas. They are
+        # imported here so that parsing arguments (e.g. --help) stays fast.
+        from .data_classifier import DataClassifier
+        from .night_organizer import NightOrganizer
+
+        memory_budget.set_limit(self.args.max_memory)
+        if self.args.timing_report is not None or self.args.memory_profile:
+            instrumentation.enable(track_memory=self.args.memory_profile)
 
         folders = glob.glob(os.path.join(self.args.raw_path, '*'))
         if any('.fits' in item for item in folders):
@@ -305,8 +360,25 @@ class MainApp(object):
                 if self.data_container is None or self.data_container is None:
                     log.error('Discarding night ' + str(night))
                     break
-                process_images = ImageProcessor(self.args, self.data_container)
-                process_images()
+                self.process_night(self.data_container)
+
+        if self.args.timing_report is not None:
+            instrumentation.write_report(self.args.timing_report)
+        elif self.args.memory_profile:
+            instrumentation.log_report()
+
+    def process_night(self, data_container):
+        """Runs the CCD reduction of a night
+
+        Args:
+            data_container (object): NightDataContainer instance with the
+                classified data of the night.
+
+        """
+        from .image_processor import ImageProcessor
+
+        process_images = ImageProcessor(self.args, data_container)
+        process_images()
 
 
 if __name__ == '__main__':
@@ -10,6 +10,8 @@ import random
 import re
 import os
 import pandas
+import shutil
+import tempfile
 
 from astropy import units as u
 from ccdproc import CCDData
@@ -21,10 +23,16 @@ from .core import (image_overscan,
                    normalize_master_flat,
                    call_cosmic_rejection)
 
+from .instrumentation import instrumentation
+from .manifest import Manifest
+from .memory_budget import memory_budget
 from .wavmode_translator import SpectroscopicMode
 
 log = logging.getLogger('goodmanccd.imageprocessor')
 
+# ccdproc.combine needs about this many times the size of the input frames
+COMBINE_MEMORY_FACTOR = 2
+
 
 class ImageProcessor(object):
     """Image processing class
@@ -34,13 +42,16 @@ class ImageProcessor(object):
 
     """
 
-    def __init__(self, args, data_container):
+    def __init__(self, args, data_container, products=None):
         """Init method for ImageProcessor class
 
         Args:
             args (object): argparse instance
             data_container (object): Contains relevant information of the night
                 and the data itself.
+            products (object): A ProductStore instance where the calibrated
+                spectroscopic frames are handed over instead of being written,
+                or None.
         """
         # TODO (simon): Check how inheritance could be used here.
         self.args = args
@@ -61,7 +72,10 @@ class ImageProcessor(object):
         self.overscan_region = self.get_overscan_region()
         self.spec_mode = SpectroscopicMode()
         self.master_bias = None
+        self.master_bias_name = None
         self.out_prefix = None
+        self.products = products
+        self.manifest = Manifest()
 
     def __call__(self):
         """Call method for ImageProcessor class
@@ -71,6 +85,16 @@ class ImageProcessor(object):
 
         """
 
+        n_frames = 0
+        for group in [self.bias,
+                      self.day_flats,
+                      self.dome_flats,
+                      self.sky_flats,
+                      self.data_groups]:
+            if group is not None:
+                n_frames += sum([len(sub_group) for sub_group in group])
+        instrumentation.start_progress(total=n_frames)
+
         for group in [self.bias,
                       self.day_flats,
                       self.dome_flats,
@@ -96,6 +120,11 @@ class ImageProcessor(object):
                         else:
                             log.info('Processing Imaging Science Data')
                             self.process_imaging_science(sub_group)
+        # the manifest is only useful when the products are on disk
+        if len(self.manifest) > 0 and \
+                (self.products is None or self.products.save):
+            self.manifest.write(self.args.red_path)
+
         # print('data groups ', len(self.data_groups))
         if self.queue is not None:
             if len(self.queue) > 1:
@@ -140,6 +169,7 @@ class ImageProcessor(object):
                 sample_image = os.path.join(self.args.raw_path,
                                             random.choice(image_list))
                 ccd = CCDData.read(sample_image, unit=u.adu)
+                instrumentation.record_read(sample_image)
 
                 # serial binning - dispersion binning
                 # parallel binngin - spatial binning
@@ -209,6 +239,7 @@ class ImageProcessor(object):
                                             random.choice(image_list))
                 log.debug('Overscan Sample File ' + sample_image)
                 ccd = CCDData.read(sample_image, unit=u.adu)
+                instrumentation.record_read(sample_image)
 
                 # Image height - spatial direction
                 h = ccd.data.shape[0]
@@ -297,6 +328,7 @@ class ImageProcessor(object):
             new_bias_name = default_bias_name
         # TODO (simon): Review whether it is necessary to discriminate by
         # TODO technique
+        spill_dir = None
         if self.technique == 'Spectroscopy':
             master_bias_list = []
             log.info('Creating master bias')
@@ -305,21 +337,29 @@ class ImageProcessor(object):
                 image_full_path = os.path.join(self.args.raw_path, image_file)
                 log.debug('Overscan Region: {:s}'.format(self.overscan_region))
                 ccd = CCDData.read(image_full_path, unit=u.adu)
+                instrumentation.record_read(image_full_path)
+                instrumentation.advance()
                 log.debug('Loading bias image: ' + image_full_path)
                 ccd = image_overscan(ccd, overscan_region=self.overscan_region)
                 ccd = image_trim(ccd, trim_section=self.trim_section)
-                master_bias_list.append(ccd)
+                if not master_bias_list:
+                    spill_dir = self.get_combine_spill_dir(
+                        ccd=ccd,
+                        n_images=len(bias_file_list))
+                master_bias_list.append(
+                    self.keep_for_combine(ccd=ccd,
+                                          spill_dir=spill_dir,
+                                          name=image_file))
 
             # combine bias for spectroscopy
-            self.master_bias = ccdproc.combine(master_bias_list,
-                                               method='median',
-                                               sigma_clip=True,
-                                               sigma_clip_low_thresh=3.0,
-                                               sigma_clip_high_thresh=3.0,
-                                               add_keyword=False)
+            self.master_bias = self.combine_data(image_list=master_bias_list,
+                                                 sigma_clip_thresh=3.0,
+                                                 spill_dir=spill_dir)
 
             # write master bias to file
             self.master_bias.write(new_bias_name, clobber=True)
+            instrumentation.record_write(new_bias_name)
+            self.master_bias_name = new_bias_name
             log.info('Created master bias: ' + new_bias_name)
 
         elif self.technique == 'Imaging':
@@ -328,20 +368,27 @@ class ImageProcessor(object):
             for image_file in bias_file_list:
                 image_full_path = os.path.join(self.args.raw_path, image_file)
                 ccd = CCDData.read(image_full_path, unit=u.adu)
+                instrumentation.record_read(image_full_path)
+                instrumentation.advance()
                 log.debug('Loading bias image: {:s}'.format(image_full_path))
                 ccd = image_trim(ccd, trim_section=self.trim_section)
-                master_bias_list.append(ccd)
+                if not master_bias_list:
+                    spill_dir = self.get_combine_spill_dir(
+                        ccd=ccd,
+                        n_images=len(bias_file_list))
+                master_bias_list.append(
+                    self.keep_for_combine(ccd=ccd,
+                                          spill_dir=spill_dir,
+                                          name=image_file))
 
             # combine bias for imaging
-            self.master_bias = ccdproc.combine(master_bias_list,
-                                               method='median',
-                                               sigma_clip=True,
-                                               sigma_clip_low_thresh=3.0,
-                                               sigma_clip_high_thresh=3.0,
-                                               add_keyword=False)
+            self.master_bias = self.combine_data(image_list=master_bias_list,
+                                                 sigma_clip_thresh=3.0,
+                                                 spill_dir=spill_dir)
 
             # write master bias to file
             self.master_bias.write(new_bias_name, clobber=True)
+            instrumentation.record_write(new_bias_name)
             log.info('Created master bias: ' + new_bias_name)
 
     def create_master_flats(self, flat_group, target_name=''):
@@ -367,11 +414,14 @@ class ImageProcessor(object):
         flat_file_list = flat_group.file.tolist()
         master_flat_list = []
         master_flat_name = None
+        spill_dir = None
         log.info('Creating Master Flat')
         for flat_file in flat_file_list:
             # print(f_file)
             image_full_path = os.path.join(self.args.raw_path, flat_file)
             ccd = CCDData.read(image_full_path, unit=u.adu)
+            instrumentation.record_read(image_full_path)
+            instrumentation.advance()
             log.debug('Loading flat image: ' + image_full_path)
             if master_flat_name is None:
 
@@ -394,9 +444,10 @@ class ImageProcessor(object):
                 # plt.show()
             elif self.technique == 'Imaging':
                 ccd = image_trim(ccd, trim_section=self.trim_section)
-                ccd = ccdproc.subtract_bias(ccd,
-                                            self.master_bias,
-                                            add_keyword=False)
+                with instrumentation.stage('bias', frames=1):
+                    ccd = ccdproc.subtract_bias(ccd,
+                                                self.master_bias,
+                                                add_keyword=False)
             else:
                 log.error('Unknown observation technique: ' + self.technique)
             # TODO (simon): Improve this part. One hot pixel could rule out a
@@ -411,15 +462,20 @@ class ImageProcessor(object):
                 # print(ccd.data.max())
                 continue
             else:
-                master_flat_list.append(ccd)
+                if spill_dir is None and not master_flat_list:
+                    spill_dir = self.get_combine_spill_dir(
+                        ccd=ccd,
+                        n_images=len(flat_file_list))
+                master_flat_list.append(
+                    self.keep_for_combine(ccd=ccd,
+                                          spill_dir=spill_dir,
+                                          name=flat_file))
         if master_flat_list != []:
-            master_flat = ccdproc.combine(master_flat_list,
-                                          method='median',
-                                          sigma_clip=True,
-                                          sigma_clip_low_thresh=1.0,
-                                          sigma_clip_high_thresh=1.0,
-                                          add_keyword=False)
+            master_flat = self.combine_data(image_list=master_flat_list,
+                                            sigma_clip_thresh=1.0,
+                                            spill_dir=spill_dir)
             master_flat.write(master_flat_name, clobber=True)
+            instrumentation.record_write(master_flat_name)
             # plt.imshow(master_flat.data, clim=(-100,0))
             # plt.show()
             log.info('Created Master Flat: ' + master_flat_name)
@@ -430,6 +486,86 @@ class ImageProcessor(object):
                       'saturation limit.')
             return None, None
 
+    def get_combine_spill_dir(self, ccd, n_images):
+        """Decides whether frames to be combined must be kept on disk
+
+        Holding all the preprocessed frames in memory is the fastest option,
+        but when the memory budget (--max-memory) can not hold them plus the
+        space ccdproc.combine needs, they are written to a temporary directory
+        and combined from there.
+
+        Args:
+            ccd (object): First preprocessed frame, a ccdproc.CCDData instance.
+            n_images (int): Number of frames that will be combined.
+
+        Returns:
+            Full path to a new temporary directory or None if the frames can
+            be kept in memory.
+
+        """
+        frames_bytes = ccd.data.nbytes * n_images
+        if memory_budget.fits(frames_bytes * COMBINE_MEMORY_FACTOR):
+            return None
+        spill_dir = tempfile.mkdtemp(prefix='combine_', dir=self.args.red_path)
+        log.info('Combining {:d} frames from disk to stay within the memory '
+                 'budget'.format(n_images))
+        return spill_dir
+
+    @staticmethod
+    def keep_for_combine(ccd, spill_dir, name):
+        """Keeps a preprocessed frame to be combined later
+
+        Args:
+            ccd (object): Preprocessed frame, a ccdproc.CCDData instance.
+            spill_dir (str): Temporary directory returned by
+                `get_combine_spill_dir` or None to keep the frame in memory.
+            name (str): File name of the frame.
+
+        Returns:
+            The ccdproc.CCDData instance itself or the full path of the
+            temporary file where it was written.
+
+        """
+        if spill_dir is None:
+            return ccd
+        spill_name = os.path.join(spill_dir, name)
+        ccd.write(spill_name, clobber=True)
+        instrumentation.record_write(spill_name)
+        return spill_name
+
+    @staticmethod
+    def combine_data(image_list, sigma_clip_thresh, spill_dir=None):
+        """Median combine of frames with symmetric sigma clipping
+
+        The memory used by ccdproc.combine is limited according to the memory
+        budget.
+
+        Args:
+            image_list (list): ccdproc.CCDData instances or file names.
+            sigma_clip_thresh (float): Low and high sigma clipping threshold.
+            spill_dir (str): Temporary directory holding the files in
+                `image_list`, it is removed after combining.
+
+        Returns:
+            The combined ccdproc.CCDData instance.
+
+        """
+        try:
+            with instrumentation.stage('master_combine',
+                                       frames=len(image_list)):
+                combined = ccdproc.combine(
+                    image_list,
+                    method='median',
+                    sigma_clip=True,
+                    sigma_clip_low_thresh=sigma_clip_thresh,
+                    sigma_clip_high_thresh=sigma_clip_thresh,
+                    mem_limit=memory_budget.combine_limit(),
+                    add_keyword=False)
+        finally:
+            if spill_dir is not None:
+                shutil.rmtree(spill_dir, ignore_errors=True)
+        return combined
+
     def name_master_flats(self, header, group, target_name='', get=False):
         """Defines the name of a master flat or what master flat is compatible
         with a given data
@@ -587,6 +723,7 @@ class ImageProcessor(object):
 
                 # read the random chosen file
                 ccd = CCDData.read(random_image_full, unit=u.adu)
+                instrumentation.record_read(random_image_full)
 
                 if not self.args.ignore_flats:
                     # define the master flat name
@@ -623,6 +760,16 @@ class ImageProcessor(object):
                 except AttributeError:
                     master_bias = None
 
+            # master calibrations applied to the group, for the manifest
+            calibrations = {'bias': None, 'flat': None}
+            if self.master_bias_name is not None and \
+                    not self.args.ignore_bias:
+                calibrations['bias'] = os.path.basename(self.master_bias_name)
+            if master_flat is not None and master_flat_name is not None and \
+                    not self.args.ignore_flats:
+                calibrations['flat'] = os.path.basename(master_flat_name)
+            group = self.manifest.new_group()
+
             norm_master_flat = None
             for science_image in object_group.file.tolist():
                 self.out_prefix = ''
@@ -633,6 +780,8 @@ class ImageProcessor(object):
 
                 # load image
                 ccd = CCDData.read(image_full_path, unit=u.adu)
+                instrumentation.record_read(image_full_path)
+                instrumentation.advance()
 
                 # apply overscan
                 ccd = image_overscan(ccd, overscan_region=self.overscan_region)
@@ -643,6 +792,7 @@ class ImageProcessor(object):
                                              self.out_prefix + science_image)
 
                     ccd.write(full_path, clobber=True)
+                    instrumentation.record_write(full_path)
 
                 if slit_trim is not None:
                     # There is a double trimming of the image, this is to match
@@ -658,6 +808,7 @@ class ImageProcessor(object):
                             self.out_prefix + science_image)
 
                         ccd.write(full_path, clobber=True)
+                        instrumentation.record_write(full_path)
 
                 else:
                     ccd = image_trim(ccd=ccd, trim_section=self.trim_section)
@@ -669,13 +820,15 @@ class ImageProcessor(object):
                             self.out_prefix + science_image)
 
                         ccd.write(full_path, clobber=True)
+                        instrumentation.record_write(full_path)
 
                 if not self.args.ignore_bias:
                     # TODO (simon): Add check that bias is compatible
 
-                    ccd = ccdproc.subtract_bias(ccd=ccd,
-                                                master=master_bias,
-                                                add_keyword=False)
+                    with instrumentation.stage('bias', frames=1):
+                        ccd = ccdproc.subtract_bias(ccd=ccd,
+                                                    master=master_bias,
+                                                    add_keyword=False)
 
                     self.out_prefix = 'z' + self.out_prefix
                     ccd.header.add_history('Bias subtracted image')
@@ -686,6 +839,7 @@ class ImageProcessor(object):
                             self.out_prefix + science_image)
 
                         ccd.write(full_path, clobber=True)
+                        instrumentation.record_write(full_path)
                 else:
                     log.warning('Ignoring bias correction by request.')
                 if master_flat is None or master_flat_name is None:
@@ -696,15 +850,17 @@ class ImageProcessor(object):
                 else:
                     if norm_master_flat is None:
 
-                        norm_master_flat = normalize_master_flat(
-                            master=master_flat,
-                            name=master_flat_name,
-                            method=self.args.flat_normalize,
-                            order=self.args.norm_order)
+                        with instrumentation.stage('flat_normalize'):
+                            norm_master_flat = normalize_master_flat(
+                                master=master_flat,
+                                name=master_flat_name,
+                                method=self.args.flat_normalize,
+                                order=self.args.norm_order)
 
-                    ccd = ccdproc.flat_correct(ccd=ccd,
-                                               flat=norm_master_flat,
-                                               add_keyword=False)
+                    with instrumentation.stage('flat', frames=1):
+                        ccd = ccdproc.flat_correct(ccd=ccd,
+                                                   flat=norm_master_flat,
+                                                   add_keyword=False)
 
                     self.out_prefix = 'f' + self.out_prefix
 
@@ -717,14 +873,28 @@ class ImageProcessor(object):
                             self.out_prefix + science_image)
 
                         ccd.write(full_path, clobber=True)
-
-                call_cosmic_rejection(ccd=ccd,
-                                      image_name=science_image,
-                                      out_prefix=self.out_prefix,
-                                      red_path=self.args.red_path,
-                                      dcr_par=self.args.dcr_par_dir,
-                                      keep_files=self.args.keep_cosmic_files,
-                                      method=self.args.clean_cosmic)
+                        instrumentation.record_write(full_path)
+
+                header = ccd.header
+                save = self.products is None or self.products.save
+                ccd, product_name = call_cosmic_rejection(
+                    ccd=ccd,
+                    image_name=science_image,
+                    out_prefix=self.out_prefix,
+                    red_path=self.args.red_path,
+                    dcr_par=self.args.dcr_par_dir,
+                    keep_files=self.args.keep_cosmic_files,
+                    method=self.args.clean_cosmic,
+                    save=save)
+                if product_name is None:
+                    continue
+
+                self.manifest.add(file_name=product_name,
+                                  group=group,
+                                  header=header,
+                                  calibrations=calibrations)
+                if self.products is not None:
+                    self.products.add(product_name, ccd=ccd, on_disk=save)
 
                 # print(science_group)
         elif 'FLAT' in obstype:
@@ -751,6 +921,7 @@ class ImageProcessor(object):
         random_image = random.choice(imaging_group.file.tolist())
         path_random_image = os.path.join(self.args.raw_path, random_image)
         sample_file = CCDData.read(path_random_image, unit=u.adu)
+        instrumentation.record_read(path_random_image)
 
         master_flat_name = self.name_master_flats(header=sample_file.header,
                                                   group=imaging_group,
@@ -769,23 +940,27 @@ class ImageProcessor(object):
 
                 image_full_path = os.path.join(self.args.raw_path, image_file)
                 ccd = CCDData.read(image_full_path, unit=u.adu)
+                instrumentation.record_read(image_full_path)
+                instrumentation.advance()
 
                 # Trim image
                 ccd = image_trim(ccd, trim_section=self.trim_section)
                 self.out_prefix = 't_'
                 if not self.args.ignore_bias:
 
-                    ccd = ccdproc.subtract_bias(ccd,
-                                                self.master_bias,
-                                                add_keyword=False)
+                    with instrumentation.stage('bias', frames=1):
+                        ccd = ccdproc.subtract_bias(ccd,
+                                                    self.master_bias,
+                                                    add_keyword=False)
 
                     self.out_prefix = 'z' + self.out_prefix
                     ccd.header.add_history('Bias subtracted image')
 
                 # apply flat correction
-                ccd = ccdproc.flat_correct(ccd,
-                                           master_flat,
-                                           add_keyword=False)
+                with instrumentation.stage('flat', frames=1):
+                    ccd = ccdproc.flat_correct(ccd,
+                                               master_flat,
+                                               add_keyword=False)
 
                 self.out_prefix = 'f' + self.out_prefix
 
@@ -794,7 +969,8 @@ class ImageProcessor(object):
                     '{:s}'.format(master_flat_name.split('/')[-1]))
 
                 if self.args.clean_cosmic:
-                    ccd = lacosmic_cosmicray_rejection(ccd=ccd)
+                    with instrumentation.stage('cosmic_rays', frames=1):
+                        ccd = lacosmic_cosmicray_rejection(ccd=ccd)
                     self.out_prefix = 'c' + self.out_prefix
                 else:
                     print('Clean Cosmic ' + str(self.args.clean_cosmic))
@@ -802,6 +978,7 @@ class ImageProcessor(object):
                 final_name = os.path.join(self.args.red_path,
                                           self.out_prefix + image_file)
                 ccd.write(final_name, clobber=True)
+                instrumentation.record_write(final_name)
                 log.info('Created science file: {:s}'.format(final_name))
         else:
             log.error('Can not process data without a master flat')
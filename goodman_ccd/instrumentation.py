@@ -0,0 +1,418 @@
+"""Per-stage timing and throughput instrumentation
+
+The reduction steps are wrapped in context managers provided by the module
+level `instrumentation` object::
+
+    with instrumentation.stage('overscan', frames=1):
+        ...
+
+When instrumentation is disabled, which is the default, `stage` returns a
+shared do-nothing context manager so the cost is a single attribute lookup.
+When enabled, each stage accumulates the number of calls, elapsed time,
+frames and bytes read and written, and a JSON report can be written at the end
+of the run. A progress line with the estimated time of arrival (ETA) is printed
+as frames are processed.
+
+Memory tracking is optional since it is more expensive. It records the peak
+resident set size (RSS) of the process at the end of every stage and, where
+the tracemalloc module is available (python 3), the peak of memory allocated
+by python and numpy during each top level stage.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import timeit
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+log = logging.getLogger('goodmanccd.instrumentation')
+
+_clock = timeit.default_timer
+
+# stage statistics that are combined by taking the maximum, see merge
+_MAXIMUM_STATS = ['max_seconds',
+                  'peak_rss_bytes',
+                  'rss_growth_bytes',
+                  'traced_peak_bytes']
+
+
+def get_peak_rss():
+    """Returns the peak resident set size of the process in bytes
+
+    Returns:
+        The peak RSS in bytes or None if it can not be determined.
+
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def get_current_rss():
+    """Returns the current resident set size of the process in bytes
+
+    Returns:
+        The current RSS in bytes, or the peak RSS if the current value is not
+        available in this platform.
+
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf(str('SC_PAGE_SIZE'))
+    except (IOError, OSError, ValueError, IndexError):
+        return get_peak_rss()
+
+
+class _NullStage(object):
+    """Context manager that does nothing, used when disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    """Context manager that times one execution of a stage"""
+
+    def __init__(self, instrumentation, name, frames):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.frames = frames
+        self.start = None
+
+    def __enter__(self):
+        if self.instrumentation.track_memory:
+            self.instrumentation._memory_enter(self)
+        self.instrumentation._stack.append(self.name)
+        self.start = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = _clock() - self.start
+        self.instrumentation._stack.pop()
+        stats = self.instrumentation._get_stats(self.name)
+        stats['calls'] += 1
+        stats['seconds'] += elapsed
+        stats['min_seconds'] = min(stats['min_seconds'], elapsed)
+        stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+        stats['frames'] += self.frames
+        if self.instrumentation.track_memory:
+            self.instrumentation._memory_exit(self, stats)
+        return False
+
+
+class Instrumentation(object):
+    """Collects timing and throughput statistics of the reduction stages
+
+    Stage timing is inclusive, i.e. the time of a stage that runs inside
+    another one is also counted in the outer stage.
+
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.show_progress = False
+        self.track_memory = False
+        self.reset()
+
+    def reset(self):
+        """Discards all the collected statistics"""
+        self.stages = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.files_read = 0
+        self.files_written = 0
+        self.start_time = _clock()
+        self._stack = []
+        self._progress_total = 0
+        self._progress_current = 0
+        self._progress_start = None
+
+    def enable(self, show_progress=True, track_memory=False):
+        """Starts collecting statistics
+
+        Args:
+            show_progress (bool): Print a progress and ETA line to the standard
+                output.
+            track_memory (bool): Record peak memory usage of every stage.
+
+        """
+        self.reset()
+        self.enabled = True
+        self.show_progress = show_progress
+        self.track_memory = track_memory
+        if track_memory and tracemalloc is not None and \
+                not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        """Stops collecting statistics"""
+        self.enabled = False
+        self.show_progress = False
+        if self.track_memory and tracemalloc is not None and \
+                tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.track_memory = False
+
+    def stage(self, name, frames=0):
+        """Returns a context manager that times a stage
+
+        Args:
+            name (str): Stage name, i.e. 'overscan' or 'extraction'.
+            frames (int): Number of frames processed by this execution of the
+                stage.
+
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, frames)
+
+    def record_read(self, file_name):
+        """Accounts for a file that has been read
+
+        Args:
+            file_name (str): Full path to the file.
+
+        """
+        if self.enabled:
+            self._record_io(file_name, 'bytes_read')
+            self.files_read += 1
+
+    def record_write(self, file_name):
+        """Accounts for a file that has been written
+
+        Args:
+            file_name (str): Full path to the file.
+
+        """
+        if self.enabled:
+            self._record_io(file_name, 'bytes_written')
+            self.files_written += 1
+
+    def start_progress(self, total):
+        """Sets the number of frames expected for the progress line
+
+        Args:
+            total (int): Number of frames that will be processed.
+
+        """
+        self._progress_total = total
+        self._progress_current = 0
+        self._progress_start = time.time()
+
+    def advance(self, frames=1):
+        """Reports processed frames and updates the progress line
+
+        Args:
+            frames (int): Number of frames processed since last call.
+
+        """
+        if not self.enabled:
+            return
+        self._progress_current += frames
+        if self.show_progress and self._progress_total > 0:
+            from .core import print_progress
+            print_progress(min(self._progress_current, self._progress_total),
+                           self._progress_total,
+                           start_time=self._progress_start)
+
+    def report(self):
+        """Builds the run report
+
+        Returns:
+            A dictionary with run-level totals and per stage statistics.
+
+        """
+        wall_time = _clock() - self.start_time
+        stages = {}
+        for name, stats in self.stages.items():
+            stage = dict(stats)
+            if stage['calls'] == 0:
+                stage['min_seconds'] = 0.
+            stage['mean_seconds'] = stage['seconds'] / max(stage['calls'], 1)
+            if stage['seconds'] > 0:
+                stage['frames_per_second'] = stage['frames'] / stage['seconds']
+                stage['mb_read_per_second'] = \
+                    stage['bytes_read'] / 1e6 / stage['seconds']
+                stage['mb_written_per_second'] = \
+                    stage['bytes_written'] / 1e6 / stage['seconds']
+            stages[name] = stage
+
+        report = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'command': ' '.join(sys.argv),
+                'host': platform.node(),
+                'python': platform.python_version(),
+                'wall_seconds': wall_time,
+                'frames': self._progress_current,
+                'frames_per_second': self._progress_current / wall_time
+                if wall_time > 0 else 0.,
+                'files_read': self.files_read,
+                'files_written': self.files_written,
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+                'stages': stages}
+
+        if self.track_memory:
+            report['peak_rss_bytes'] = get_peak_rss()
+            report['top_allocations'] = self._top_allocations()
+        return report
+
+    def collect(self):
+        """Returns the statistics collected so far and discards them
+
+        Worker processes use it to send their statistics to the main process,
+        which adds them to its own with `merge`.
+
+        Returns:
+            A dictionary with the input/output totals and the per stage
+            statistics.
+
+        """
+        collected = {'stages': self.stages,
+                     'bytes_read': self.bytes_read,
+                     'bytes_written': self.bytes_written,
+                     'files_read': self.files_read,
+                     'files_written': self.files_written}
+        self.stages = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.files_read = 0
+        self.files_written = 0
+        return collected
+
+    def merge(self, collected):
+        """Adds statistics collected by another process
+
+        The times of a stage are summed over processes, therefore they can
+        exceed the wall time of the run.
+
+        Args:
+            collected (dict): Statistics as returned by `collect`.
+
+        """
+        if not self.enabled or not collected:
+            return
+        for key in ['bytes_read', 'bytes_written', 'files_read',
+                    'files_written']:
+            setattr(self, key, getattr(self, key) + collected[key])
+        for name, other in collected['stages'].items():
+            stats = self._get_stats(name)
+            for key, value in other.items():
+                if key == 'min_seconds':
+                    stats[key] = min(stats[key], value)
+                elif key in _MAXIMUM_STATS:
+                    stats[key] = max(stats.get(key, 0), value)
+                else:
+                    stats[key] = stats.get(key, 0) + value
+
+    def write_report(self, file_name):
+        """Writes the run report as a JSON file
+
+        Args:
+            file_name (str): Full path to the report file.
+
+        """
+        with open(file_name, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2, sort_keys=True)
+        log.info('Instrumentation report written to {:s}'.format(file_name))
+
+    def log_report(self):
+        """Logs a one line summary of every stage"""
+        report = self.report()
+        for name in sorted(report['stages']):
+            stage = report['stages'][name]
+            message = '{:s}: {:d} calls {:.3f}s'.format(name,
+                                                       stage['calls'],
+                                                       stage['seconds'])
+            if 'peak_rss_bytes' in stage:
+                message += ' peak RSS {:.1f}MB'.format(
+                    stage['peak_rss_bytes'] / 1e6)
+            if 'traced_peak_bytes' in stage:
+                message += ' traced peak {:.1f}MB'.format(
+                    stage['traced_peak_bytes'] / 1e6)
+            log.info(message)
+
+    def _get_stats(self, name):
+        try:
+            return self.stages[name]
+        except KeyError:
+            stats = {'calls': 0,
+                     'seconds': 0.,
+                     'min_seconds': float('inf'),
+                     'max_seconds': 0.,
+                     'frames': 0,
+                     'bytes_read': 0,
+                     'bytes_written': 0}
+            self.stages[name] = stats
+            return stats
+
+    def _memory_enter(self, stage):
+        stage.rss_at_start = get_peak_rss()
+        # the tracemalloc peak can only be reset (python >= 3.9) for stages
+        # that are not nested, otherwise the outer stage would lose its peak.
+        if tracemalloc is not None and tracemalloc.is_tracing() and \
+                not self._stack and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def _memory_exit(self, stage, stats):
+        peak_rss = get_peak_rss()
+        if peak_rss is not None:
+            stats['peak_rss_bytes'] = max(stats.get('peak_rss_bytes', 0),
+                                          peak_rss)
+            stats['rss_growth_bytes'] = max(stats.get('rss_growth_bytes', 0),
+                                            peak_rss - stage.rss_at_start)
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            stats['traced_peak_bytes'] = max(stats.get('traced_peak_bytes', 0),
+                                             peak)
+
+    @staticmethod
+    def _top_allocations(limit=10):
+        """Largest allocations by source line from a tracemalloc snapshot"""
+        if tracemalloc is None or not tracemalloc.is_tracing():
+            return []
+        snapshot = tracemalloc.take_snapshot()
+        return [{'location': str(statistic.traceback),
+                 'bytes': statistic.size,
+                 'count': statistic.count}
+                for statistic in snapshot.statistics('lineno')[:limit]]
+
+    def _record_io(self, file_name, key):
+        try:
+            size = os.path.getsize(file_name)
+        except OSError as error:
+            log.debug(error)
+            return
+        setattr(self, key, getattr(self, key) + size)
+        # bytes are accounted to every stage that is running
+        for name in set(self._stack):
+            self._get_stats(name)[key] += size
+
+
+instrumentation = Instrumentation()
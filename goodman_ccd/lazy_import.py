@@ -0,0 +1,74 @@
+"""Deferred imports for heavy and GUI-only dependencies
+
+Importing matplotlib's pyplot (with an interactive backend), scipy.signal or
+astroplan takes a noticeable fraction of a second each, and most runs of
+`redccd` or `redspec` never need some of them, `--help` being the extreme
+case. The objects defined here stand in for those modules and import them on
+first attribute access.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import importlib
+import logging
+
+log = logging.getLogger('goodmanccd.lazyimport')
+
+PLOT_BACKEND = 'Qt4Agg'
+
+
+class LazyModule(object):
+    """Proxy to a module that is only imported when it is first used
+
+    The proxy behaves like the module for attribute access, therefore it can
+    replace a module level ``import`` statement without changing the code that
+    uses it. i.e. ``plt = LazyModule('matplotlib.pyplot')`` followed by
+    ``plt.plot(...)``.
+
+    Args:
+        name (str): Full name of the module to import.
+        setup (function): Optional function without arguments that is called
+            right before the module is imported for the first time.
+
+    """
+
+    def __init__(self, name, setup=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_setup'] = setup
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        """Imports the module, only the first call does the actual work"""
+        if self._module is None:
+            if self._setup is not None:
+                self._setup()
+            log.debug('Importing module {:s}'.format(self._name))
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __setattr__(self, key, value):
+        setattr(self._load(), key, value)
+
+    def __repr__(self):
+        if self._module is None:
+            return '<lazy module {:s} (not loaded)>'.format(self._name)
+        return repr(self._module)
+
+
+def select_plot_backend():
+    """Sets the matplotlib backend before pyplot is imported
+
+    The backend can only be changed before pyplot is loaded, this used to be
+    done at import time of several modules.
+
+    """
+    import matplotlib
+    matplotlib.use(PLOT_BACKEND)
+
+
+plt = LazyModule('matplotlib.pyplot', setup=select_plot_backend)
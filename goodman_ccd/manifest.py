@@ -0,0 +1,174 @@
+# -*- coding: utf8 -*-
+"""Handoff manifest from the CCD reduction to the spectroscopic reduction
+
+redccd writes MANIFEST_NAME to the reduced data directory. It describes every
+calibrated spectroscopic frame: its file name, the group it was reduced with,
+its obstype, the header keywords used to classify spectroscopic data and the
+master calibrations applied to it. redspec reads it instead of scanning the
+headers of every file that matches --search-pattern, and keeps the groups
+made by redccd instead of rebuilding them.
+
+The manifest is a JSON file with the format version and the list of products,
+file names are relative to the directory that contains it.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import logging
+import os
+
+import pandas
+
+from .core import (SPECTROSCOPY_KEYWORDS,
+                   NightDataContainer,
+                   add_spectroscopic_group)
+
+log = logging.getLogger('goodmanccd.manifest')
+
+MANIFEST_NAME = 'goodman_manifest.json'
+
+# increased whenever the content changes in an incompatible way
+MANIFEST_VERSION = 1
+
+
+def json_value(value):
+    """Header value that can be written to JSON"""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return '{!s}'.format(value)
+
+
+class Manifest(object):
+    """Calibrated spectroscopic frames of a night
+
+    Attributes:
+        products (list): One dictionary per frame with the keys `file`,
+            `group`, `obstype`, `keywords` and `calibrations`.
+
+    """
+
+    def __init__(self):
+        self.products = []
+        self.n_groups = 0
+
+    def __len__(self):
+        return len(self.products)
+
+    def new_group(self):
+        """Returns the identifier of a new group of frames"""
+        self.n_groups += 1
+        return self.n_groups
+
+    def add(self, file_name, group, header, calibrations=None):
+        """Adds a calibrated frame
+
+        Args:
+            file_name (str): File name of the product.
+            group (int): Identifier of its group, see `new_group`.
+            header (object): astropy.io.fits.Header of the product.
+            calibrations (dict): File names of the master calibrations
+                applied, i.e. `bias` and `flat`.
+
+        """
+        keywords = dict([(keyword, json_value(header.get(keyword)))
+                         for keyword in SPECTROSCOPY_KEYWORDS])
+        self.products.append({'file': file_name,
+                              'group': group,
+                              'obstype': keywords['obstype'],
+                              'keywords': keywords,
+                              'calibrations': calibrations or {}})
+
+    def write(self, path):
+        """Writes the manifest to MANIFEST_NAME in `path`
+
+        Args:
+            path (str): Reduced data directory.
+
+        """
+        full_path = os.path.join(path, MANIFEST_NAME)
+        temporary_path = full_path + '.tmp'
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump({'version': MANIFEST_VERSION,
+                       'products': self.products},
+                      manifest_file,
+                      indent=1,
+                      sort_keys=True)
+        os.rename(temporary_path, full_path)
+        log.info('Wrote manifest of {:d} products: {:s}'.format(
+            len(self.products), full_path))
+
+
+def read_manifest(path):
+    """Reads the manifest of a reduced data directory
+
+    Args:
+        path (str): Reduced data directory.
+
+    Returns:
+        The list of products, see `Manifest`, or None if there is no usable
+        manifest.
+
+    """
+    full_path = os.path.join(path, MANIFEST_NAME)
+    if not os.path.isfile(full_path):
+        return None
+    try:
+        with open(full_path) as manifest_file:
+            content = json.load(manifest_file)
+    except ValueError as error:
+        log.warning('Ignoring invalid manifest {:s}: {:s}'.format(full_path,
+                                                                  str(error)))
+        return None
+    if content.get('version') != MANIFEST_VERSION:
+        log.warning('Ignoring manifest {:s}, it has an unsupported '
+                    'version'.format(full_path))
+        return None
+    return content['products']
+
+
+def classify_manifest(path, products, search_pattern='', check_files=True):
+    """Groups the products of a manifest as pandas.DataFrame instances
+
+    Every group made by redccd becomes a group of the data container, see
+    `goodman_ccd.core.add_spectroscopic_group`.
+
+    Args:
+        path (str): Directory of the products.
+        products (list): Products as returned by `read_manifest`.
+        search_pattern (str): Only products whose file name starts with it are
+            used.
+        check_files (bool): Skip the products whose file does not exist.
+
+    Returns:
+        data_container (object): Instance of NightDataContainer, empty when
+            no product was selected.
+
+    """
+    data_container = NightDataContainer(path=path,
+                                        instrument=str('Red'),
+                                        technique=str('Spectroscopy'))
+    rows = []
+    for product in products:
+        file_name = product['file']
+        if not file_name.startswith(search_pattern):
+            continue
+        if check_files and not os.path.isfile(os.path.join(path, file_name)):
+            log.warning('Product listed in the manifest does not exist: '
+                        '{:s}'.format(file_name))
+            continue
+        row = dict(product['keywords'])
+        row['file'] = file_name
+        row['group'] = product['group']
+        rows.append(row)
+    if rows == []:
+        return data_container
+
+    pifc = pandas.DataFrame(rows,
+                            columns=['file', 'group'] + SPECTROSCOPY_KEYWORDS)
+    for _, spec_group in pifc.groupby('group', sort=True):
+        add_spectroscopic_group(data_container=data_container,
+                                spec_group=spec_group)
+    return data_container
@@ -0,0 +1,157 @@
+"""Memory budget governor
+
+A global memory budget can be set with the `--max-memory` argument. Stages
+that can trade speed for memory consult the module level `memory_budget`
+object to decide how many frames to keep in memory at once or how many worker
+processes to start, instead of exhausting the memory of the node.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import re
+
+from .instrumentation import get_current_rss
+
+log = logging.getLogger('goodmanccd.memorybudget')
+
+_UNITS = {'': 1,
+          'B': 1,
+          'K': 1024,
+          'M': 1024 ** 2,
+          'G': 1024 ** 3,
+          'T': 1024 ** 4}
+
+
+def parse_memory_size(value):
+    """Converts a memory size string into bytes
+
+    Args:
+        value (str): Size with an optional unit suffix, K, M, G or T (powers of
+            1024), e.g. '512M', '4G' or '2.5G'. A plain number is taken as
+            bytes.
+
+    Returns:
+        The size in bytes (int).
+
+    Raises:
+        ValueError: If the value can not be interpreted.
+
+    """
+    match = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*([KMGTB]?)B?\s*$',
+                     str(value).upper())
+    if match is None:
+        raise ValueError('Invalid memory size: {:s}'.format(str(value)))
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+class MemoryBudget(object):
+    """Keeps the memory budget of the process
+
+    Without a limit every method returns the most memory hungry choice, i.e.
+    the behavior the pipeline had before the budget existed.
+
+    Args:
+        max_bytes (int): Maximum memory the process should use, in bytes.
+            None means unlimited.
+
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+
+    @property
+    def limited(self):
+        return self.max_bytes is not None
+
+    def set_limit(self, max_bytes):
+        """Sets the budget
+
+        Args:
+            max_bytes (int): Maximum memory in bytes, None for unlimited.
+
+        """
+        self.max_bytes = max_bytes
+        if max_bytes is not None:
+            log.info('Memory budget set to {:.1f}MB'.format(max_bytes / 1e6))
+
+    def available(self):
+        """Memory left in the budget considering what is already in use
+
+        Returns:
+            Available bytes or None if there is no limit.
+
+        """
+        if self.max_bytes is None:
+            return None
+        in_use = get_current_rss() or 0
+        return max(self.max_bytes - in_use, 0)
+
+    def fits(self, n_bytes):
+        """Whether `n_bytes` more can be allocated within the budget"""
+        available = self.available()
+        return available is None or n_bytes <= available
+
+    def chunk_size(self, item_bytes, n_items, minimum=1):
+        """Number of items that can be held in memory at the same time
+
+        Args:
+            item_bytes (int): Memory required by each item.
+            n_items (int): Total number of items.
+            minimum (int): Minimum chunk size returned even if the budget is
+                smaller.
+
+        Returns:
+            The number of items per chunk, between `minimum` and `n_items`.
+
+        """
+        available = self.available()
+        if available is None or item_bytes <= 0:
+            return n_items
+        return int(max(minimum, min(n_items, available // item_bytes)))
+
+    def workers(self, requested, worker_bytes):
+        """Number of worker processes that fit in the budget
+
+        Args:
+            requested (int): Number of workers requested by the user.
+            worker_bytes (int): Estimated memory used by each worker.
+
+        Returns:
+            The number of workers, between 1 and `requested`. If `requested`
+            is zero or negative it is returned unchanged.
+
+        """
+        if requested < 1:
+            return requested
+        allowed = self.chunk_size(worker_bytes, requested)
+        if allowed < requested:
+            log.warning('Memory budget allows only {:d} of {:d} '
+                        'workers'.format(allowed, requested))
+        return allowed
+
+    def combine_limit(self, default=16e9, minimum=64 * 1024 ** 2):
+        """Memory limit to pass to ccdproc.combine
+
+        ccdproc splits the combination in tiles so that the working space does
+        not exceed this limit.
+
+        Args:
+            default (float): Value used when there is no budget. It is
+                ccdproc's default.
+            minimum (float): Smallest limit returned, too small tiles make the
+                combination extremely slow.
+
+        Returns:
+            Memory limit in bytes.
+
+        """
+        available = self.available()
+        if available is None:
+            return default
+        return max(available, minimum)
+
+
+memory_budget = MemoryBudget()
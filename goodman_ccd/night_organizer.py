@@ -1,21 +1,13 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
-import os
 import sys
 import time
-import re
 import pandas
 import logging
-import matplotlib.pyplot as plt
-import numpy as np
 from ccdproc import ImageFileCollection
-from mpl_toolkits.mplot3d import Axes3D
-from astropy.coordinates import EarthLocation
-from astropy.time import Time, TimeDelta
-from astroplan import Observer
-from astropy import units as u
-from .core import convert_time, get_twilight_time, ra_dec_to_deg
+from .core import get_twilight_time, ra_dec_to_deg
 from .core import NightDataContainer
+from .instrumentation import instrumentation
 
 log = logging.getLogger('goodmanccd.nightorganizer')
 
@@ -80,8 +72,9 @@ class NightOrganizer(object):
 
         """
 
-        ifc = ImageFileCollection(self.path, self.keywords)
-        self.file_collection = ifc.summary.to_pandas()
+        with instrumentation.stage('header_scan'):
+            ifc = ImageFileCollection(self.path, self.keywords)
+            self.file_collection = ifc.summary.to_pandas()
         # add two columns that will contain the ra and dec in degrees
 
         self.file_collection['radeg'] = ''
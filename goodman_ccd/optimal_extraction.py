@@ -0,0 +1,160 @@
+# -*- coding: utf8 -*-
+"""Optimal extraction of spectra
+
+Implements the algorithm described by Horne (1986, PASP 98, 609). Every pixel
+of the extraction zone is weighted by the normalized spatial profile divided
+by its variance, which maximizes the signal to noise ratio of the extracted
+spectrum. The variance of every pixel comes from the CCD noise model, read
+noise plus photon noise of the model of the data, and it is refined as the
+spectrum converges.
+
+Cosmic rays and other outliers are rejected iteratively, at each iteration
+the worst pixel of every column is masked if it exceeds the model by more than
+`sigma_clip` standard deviations. All the columns are processed at once with
+whole array operations, there are no loops over columns or rows.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+import numpy as np
+
+from scipy.ndimage import median_filter
+
+log = logging.getLogger('redspec.optimalextraction')
+
+# rejection threshold for cosmic rays in standard deviations
+CR_SIGMA_CLIP = 5.
+
+# maximum number of rejection iterations, at most one pixel per column is
+# rejected in each one
+MAX_ITERATIONS = 10
+
+# columns used to smooth the empirical profile along the dispersion axis
+EMPIRICAL_SMOOTHING = 31
+
+
+def normalize_profile(profile):
+    """Normalizes a spatial profile so that every column adds up to one
+
+    Args:
+        profile (array): 2D array, spatial axis first.
+
+    Returns:
+        The normalized profile, columns without signal are set to zero.
+
+    """
+    total = np.sum(profile, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total > 0, profile / total, 0.)
+
+
+def gaussian_profile(trace, stddev, shape):
+    """Spatial profile of a gaussian that follows a trace
+
+    Args:
+        trace (object): astropy.modeling.Model instance, center of the
+            profile in every column, in the rows of the extraction zone.
+        stddev (float): Standard deviation of the profile in pixels.
+        shape (tuple): Shape of the extraction zone.
+
+    Returns:
+        A normalized profile with the given shape.
+
+    """
+    rows = np.arange(shape[0])[:, np.newaxis]
+    centers = trace(np.arange(shape[1]))[np.newaxis, :]
+    profile = np.exp(-0.5 * ((rows - centers) / stddev) ** 2)
+    return normalize_profile(profile)
+
+
+def empirical_profile(data, background, size=EMPIRICAL_SMOOTHING):
+    """Spatial profile measured on the data
+
+    The fraction of the flux of every column in each pixel is smoothed along
+    the dispersion axis with a median filter, negative values are clipped.
+
+    Args:
+        data (array): Extraction zone, spatial axis first.
+        background (array): Background level of every column, or a scalar.
+        size (int): Number of columns of the median filter.
+
+    Returns:
+        A normalized profile with the shape of `data`.
+
+    """
+    net = np.asarray(data, dtype=float) - background
+    net = np.where(np.isfinite(net), net, 0.)
+    total = np.sum(net, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.where(total > 0, net / total, 0.)
+    profile = median_filter(fraction, size=(1, size), mode='nearest')
+    return normalize_profile(np.clip(profile, 0., None))
+
+
+def extract_optimal(data, profile, background, variance, rdnoise, gain,
+                    sigma_clip=CR_SIGMA_CLIP,
+                    max_iterations=MAX_ITERATIONS):
+    """Optimal extraction of a 2D spectrum
+
+    Args:
+        data (array): Extraction zone in ADU, spatial axis first.
+        profile (array): Normalized spatial profile with the shape of `data`.
+        background (array): Background level of every column in ADU per
+            pixel, or a scalar.
+        variance (array): Initial variance of every pixel in ADU squared,
+            computed from the data with the same noise model.
+        rdnoise (float): Read noise in electrons.
+        gain (float): Gain in electrons per ADU.
+        sigma_clip (float): Rejection threshold in standard deviations.
+        max_iterations (int): Maximum number of rejection iterations.
+
+    Returns:
+        A tuple with the extracted spectrum, its variance and a boolean array
+        with the shape of `data` that is True for the rejected pixels.
+
+    """
+    data = np.asarray(data, dtype=float)
+    background = np.asarray(background, dtype=float)
+    valid = np.isfinite(data)
+    net = np.where(valid, data - background, 0.)
+
+    # CCD noise model in ADU squared
+    read_variance = (rdnoise / gain) ** 2
+    variance = np.where(valid, variance, read_variance)
+
+    good = valid.copy()
+    columns = np.arange(data.shape[1])
+    for iteration in range(max_iterations + 1):
+        weights = np.where(good, profile / variance, 0.)
+        normalization = np.sum(weights * profile, axis=0)
+        usable = normalization > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            spectrum = np.where(usable,
+                                np.sum(weights * net, axis=0) / normalization,
+                                0.)
+            spectrum_variance = np.where(
+                usable,
+                np.sum(np.where(good, profile, 0.), axis=0) / normalization,
+                0.)
+
+        model = spectrum * profile
+        variance = read_variance + np.abs(model + background) / gain
+        if iteration == max_iterations:
+            break
+
+        # only positive deviations, cosmic rays add flux
+        deviation = np.where(good, (net - model) / np.sqrt(variance), 0.)
+        worst = np.argmax(deviation, axis=0)
+        reject = deviation[worst, columns] > sigma_clip
+        if not np.any(reject):
+            break
+        good[worst[reject], columns[reject]] = False
+
+    rejected = valid & ~good
+    log.debug('Optimal extraction rejected {:d} pixels in {:d} '
+              'iterations'.format(int(np.sum(rejected)), iteration))
+    return spectrum, spectrum_variance, rejected
@@ -0,0 +1,156 @@
+# -*- coding: utf8 -*-
+"""Calibrated frames handed from the CCD reduction to the extraction
+
+goodman-reduce runs the CCD reduction and the spectroscopic reduction in the
+same process. Instead of writing every calibrated frame and reading it back
+afterwards, the frames are kept in a `ProductStore` and the extraction takes
+them from there.
+
+Frames are written to the reduced data directory only when the user asks for
+it, when they do not fit in the memory budget (--max-memory) or, without a
+budget, in STORE_MAX_BYTES, or when they are needed by worker processes, see
+`ProductStore.spill`. dcr cleans files, its products are always on disk.
+
+A frame is released once it has been taken as many times as expected, see
+`ProductStore.expect_reads`, so science frames leave the store when they are
+extracted and comparison lamps after the last group that uses them.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import os
+
+from astropy import units as u
+from ccdproc import CCDData
+
+from .instrumentation import instrumentation
+from .memory_budget import memory_budget
+
+log = logging.getLogger('goodmanccd.productstore')
+
+# room left for processing a frame for every frame kept in memory
+STORE_MEMORY_FACTOR = 2
+
+# frames kept in memory without a memory budget, in bytes
+STORE_MAX_BYTES = 2 * 1024 ** 3
+
+
+class ProductStore(object):
+    """Calibrated frames of a night, in memory or in the reduced data directory
+
+    Args:
+        path (str): Reduced data directory.
+        save (bool): Write every product to `path` too, as redccd does.
+        max_bytes (int): Frames kept in memory when there is no memory
+            budget, in bytes.
+
+    Attributes:
+        frames (dict): ccdproc.CCDData instances kept in memory by file name.
+        on_disk (set): File names of the products written to `path`.
+        reads (dict): Number of times every frame will be taken, see
+            `expect_reads`.
+
+    """
+
+    def __init__(self, path, save=False, max_bytes=STORE_MAX_BYTES):
+        self.path = path
+        self.save = save
+        self.max_bytes = max_bytes
+        self.frames = {}
+        self.on_disk = set()
+        self.reads = {}
+        self.stored_bytes = 0
+
+    def add(self, file_name, ccd=None, on_disk=False):
+        """Adds a calibrated frame
+
+        The frame is kept in memory if it fits in the memory budget, or in
+        `max_bytes` when there is none, otherwise it is written to `path`.
+
+        Args:
+            file_name (str): File name of the product, including the prefixes
+                of the processes applied to it.
+            ccd (object): ccdproc.CCDData instance or None when the product
+                only exists in `path`.
+            on_disk (bool): Whether the product was written to `path` already.
+
+        """
+        if ccd is None or on_disk:
+            self.on_disk.add(file_name)
+        if ccd is None:
+            return
+
+        if memory_budget.limited:
+            keep = memory_budget.fits(ccd.data.nbytes * STORE_MEMORY_FACTOR)
+        else:
+            keep = self.stored_bytes + ccd.data.nbytes <= self.max_bytes
+
+        if keep:
+            self._release(file_name)
+            self.frames[file_name] = ccd
+            self.stored_bytes += ccd.data.nbytes
+        elif not on_disk:
+            log.debug('Memory budget exceeded, writing {:s}'.format(file_name))
+            self._write(file_name, ccd)
+
+    def expect_reads(self, file_names):
+        """Sets how many times every frame will be taken with `get`
+
+        Args:
+            file_names (list): File names, once for every time the frame will
+                be taken. Frames not listed are taken once.
+
+        """
+        self.reads = {}
+        for file_name in file_names:
+            self.reads[file_name] = self.reads.get(file_name, 0) + 1
+
+    def get(self, file_name):
+        """Returns a calibrated frame
+
+        Frames kept in memory are released the last time they are taken,
+        before that they are copied, comparison lamps are shared by several
+        groups and the extraction modifies them.
+
+        Args:
+            file_name (str): File name of the product.
+
+        Returns:
+            A ccdproc.CCDData instance.
+
+        """
+        if file_name in self.frames:
+            remaining = self.reads.pop(file_name, 1) - 1
+            if remaining > 0:
+                self.reads[file_name] = remaining
+                return self.frames[file_name].copy()
+            ccd = self.frames[file_name]
+            self._release(file_name)
+            return ccd
+        full_path = os.path.join(self.path, file_name)
+        ccd = CCDData.read(full_path, unit=u.adu)
+        instrumentation.record_read(full_path)
+        return ccd
+
+    def spill(self):
+        """Writes the frames kept in memory to `path` and releases them"""
+        for file_name in sorted(self.frames):
+            if file_name not in self.on_disk:
+                self._write(file_name, self.frames[file_name])
+        self.frames = {}
+        self.stored_bytes = 0
+
+    def _release(self, file_name):
+        ccd = self.frames.pop(file_name, None)
+        if ccd is not None:
+            self.stored_bytes -= ccd.data.nbytes
+
+    def _write(self, file_name, ccd):
+        full_path = os.path.join(self.path, file_name)
+        ccd.write(full_path, clobber=True)
+        instrumentation.record_write(full_path)
+        log.info('Saving image: {:s}'.format(full_path))
+        self.on_disk.add(file_name)
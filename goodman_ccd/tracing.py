@@ -0,0 +1,298 @@
+# -*- coding: utf8 -*-
+"""Sampling of the traces of spectra
+
+A trace is sampled by taking the median of every block of `sampling_step`
+columns around the target and finding the peak of the resulting spatial
+profile in each block. The medians of all blocks are computed with a single
+call on a reshaped view of the rows that contain the targets, then the peaks of
+all the targets in all the blocks are found at once with a masked ``argmax``
+and refined to sub pixel precision with a parabola.
+
+The search window of every block is centered on the target, twice: first at
+the mean of its spatial profile and then following the running median of the
+first samples, as long as it stays within the allowed distance from the mean.
+This replaces the sample by sample update of the window center and keeps the
+window from wandering away with a single bad sample. Samples that depart from
+the running median by more than the width of the profile are flagged.
+
+Exposures of the same pointing reuse the targets and traces of the previous
+one when their spatial profiles match, see `TraceCache`.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+import numpy as np
+
+from scipy.ndimage import median_filter
+
+log = logging.getLogger('redspec.tracing')
+
+# number of consecutive samples in the running median used to follow the trace
+CONTINUITY_SIZE = 5
+
+# columns skipped when comparing the spatial profiles of two exposures
+PROFILE_COLUMN_STEP = 4
+
+# largest offset in pixels between exposures for reusing traces
+MAX_TRACE_SHIFT = 3
+
+# smallest normalized correlation of the spatial profiles for reusing traces
+MIN_PROFILE_CORRELATION = 0.9
+
+
+def block_medians(data, low, high, sampling_step):
+    """Median spatial profile of every block of columns
+
+    Args:
+        data (array): 2D image, spatial axis first.
+        low (int): First row to use.
+        high (int): Row after the last one to use.
+        sampling_step (int): Number of columns in every block.
+
+    Returns:
+        A (high - low, n_blocks) array. The last block is shorter when the
+        number of columns is not a multiple of `sampling_step`.
+
+    """
+    band = data[low:high, :]
+    n_rows, n_columns = band.shape
+    n_full = n_columns // sampling_step
+    full_columns = n_full * sampling_step
+
+    medians = np.median(
+        band[:, :full_columns].reshape(n_rows, n_full, sampling_step),
+        axis=2)
+    if full_columns < n_columns:
+        remainder = np.median(band[:, full_columns:], axis=1)
+        medians = np.column_stack([medians, remainder])
+    return medians
+
+
+def window_peaks(medians, first_row, centers, half_width):
+    """Peak of the profile of every block within a window
+
+    Args:
+        medians (array): Block medians as returned by `block_medians`.
+        first_row (int): Row of the image that corresponds to the first row
+            of `medians`.
+        centers (array): (n_targets, n_blocks) center of the windows, in
+            image rows.
+        half_width (array): Half width of the window of every target.
+
+    Returns:
+        A tuple with a (n_targets, n_blocks) array of peak positions, in
+        image rows and with sub pixel precision, and a boolean array of the
+        same shape that is False for empty windows.
+
+    """
+    n_rows, n_blocks = medians.shape
+    half_width = np.asarray(half_width, dtype=float)[:, np.newaxis]
+    lower = (centers - half_width).astype(int) - first_row
+    upper = (centers + half_width).astype(int) - first_row
+
+    rows = np.arange(n_rows)[np.newaxis, :, np.newaxis]
+    inside = (rows >= lower[:, np.newaxis, :]) & \
+             (rows < upper[:, np.newaxis, :])
+    finite = np.where(np.isfinite(medians), medians, -np.inf)
+    windowed = np.where(inside, finite[np.newaxis], -np.inf)
+
+    peak = np.argmax(windowed, axis=1)
+    target_index, block_index = np.indices(peak.shape)
+    peak_value = windowed[target_index, peak, block_index]
+    valid = np.isfinite(peak_value)
+
+    # vertex of the parabola through the peak and its two neighbours
+    previous = windowed[target_index, np.maximum(peak - 1, 0), block_index]
+    following = windowed[target_index,
+                         np.minimum(peak + 1, n_rows - 1),
+                         block_index]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        curvature = previous - 2 * peak_value + following
+        offset = 0.5 * (previous - following) / curvature
+    refine = valid & np.isfinite(offset) & (curvature < 0) & \
+        (peak > 0) & (peak < n_rows - 1)
+    positions = peak + np.where(refine, offset, 0.) + first_row
+    return positions, valid
+
+
+def sample_traces(data, means, stddevs, sampling_step, nsigmas):
+    """Samples the traces of several targets at once
+
+    Args:
+        data (array): 2D image, spatial axis first.
+        means (list): Spatial position of every target.
+        stddevs (list): Standard deviation of the spatial profile of every
+            target.
+        sampling_step (int): Number of columns in every block.
+        nsigmas (float): Half width of the search window in units of stddev.
+            The trace is allowed to move this far from the mean.
+
+    Returns:
+        A tuple with the first column of every block, a (n_targets,
+        n_blocks) array with the trace positions and a boolean array of the
+        same shape, False for the samples that should not be fitted.
+
+    """
+    spatial_length, dispersion_length = data.shape
+    means = np.asarray(means, dtype=float)
+    half_width = nsigmas * np.asarray(stddevs, dtype=float)
+
+    # the window can follow the trace up to half_width from the mean
+    low = int(max(0, np.min(means - 2 * half_width)))
+    high = int(min(spatial_length, np.max(means + 2 * half_width) + 1))
+    medians = block_medians(data, low, high, sampling_step)
+    sampling_axis = np.arange(0, dispersion_length, sampling_step)
+
+    centers = np.repeat(means[:, np.newaxis], medians.shape[1], axis=1)
+    positions, valid = window_peaks(medians, low, centers, half_width)
+
+    # continuity, the windows follow the running median of the first samples
+    filled = np.where(valid, positions, centers)
+    running = median_filter(filled, size=(1, CONTINUITY_SIZE), mode='nearest')
+    follow = np.abs(running - means[:, np.newaxis]) < \
+        half_width[:, np.newaxis]
+    centers = np.where(follow, running, centers)
+    positions, valid = window_peaks(medians, low, centers, half_width)
+
+    # outliers, samples that jump away from their neighbours
+    filled = np.where(valid, positions, centers)
+    running = median_filter(filled, size=(1, CONTINUITY_SIZE), mode='nearest')
+    outliers = np.abs(positions - running) > \
+        np.maximum(np.asarray(stddevs, dtype=float), 1.)[:, np.newaxis]
+    log.debug('Trace outliers per target: {:s}'.format(
+        str(np.sum(outliers & valid, axis=1).tolist())))
+
+    return sampling_axis, positions, valid & ~outliers
+
+
+def spatial_profile(data):
+    """Median spatial profile of an image, background subtracted
+
+    Only every PROFILE_COLUMN_STEP column is used, it is enough to compare
+    the position of the targets.
+
+    Args:
+        data (array): 2D image, spatial axis first.
+
+    Returns:
+        A 1D array with one element per row.
+
+    """
+    profile = np.median(data[:, ::PROFILE_COLUMN_STEP], axis=1)
+    profile = np.where(np.isfinite(profile), profile, 0.)
+    return profile - np.median(profile)
+
+
+def profile_shift(reference, profile, max_shift):
+    """Shift of a spatial profile with respect to a reference one
+
+    Both profiles are cross correlated for lags up to `max_shift`, the
+    correlation is normalized so that identical profiles give 1 and the peak
+    is refined with a parabola.
+
+    Args:
+        reference (array): Reference profile, see `spatial_profile`.
+        profile (array): New profile, same length as `reference`.
+        max_shift (int): Largest lag considered, in pixels.
+
+    Returns:
+        A tuple with the shift in pixels, positive when the targets of
+        `profile` are at larger rows, and the normalized correlation at that
+        shift.
+
+    """
+    norm = np.sqrt(np.sum(reference ** 2) * np.sum(profile ** 2))
+    if len(reference) != len(profile) or norm == 0:
+        return 0., 0.
+    size = len(reference)
+    max_shift = int(min(max_shift, size - 1))
+    correlation = np.correlate(profile, reference, mode='full')[
+        size - 1 - max_shift:size + max_shift] / norm
+
+    peak = int(np.argmax(correlation))
+    shift = float(peak - max_shift)
+    if 0 < peak < len(correlation) - 1:
+        previous, following = correlation[peak - 1], correlation[peak + 1]
+        curvature = previous - 2 * correlation[peak] + following
+        if curvature < 0:
+            shift += 0.5 * (previous - following) / curvature
+    return shift, float(correlation[peak])
+
+
+class TraceCache(object):
+    """Targets and traces of the previous exposure of a pointing
+
+    Consecutive exposures of the same target land on the same rows of the
+    detector. The first one goes through the full detection and tracing and
+    its results are stored here together with its spatial profile. For the
+    following ones the spatial profile is cross correlated with the stored one
+    and, when they match, the stored models are returned shifted by the
+    measured offset.
+
+    Args:
+        max_shift (int): Largest offset, in pixels, accepted for reuse.
+        min_correlation (float): Smallest normalized correlation accepted for
+            reuse.
+
+    """
+
+    def __init__(self, max_shift=MAX_TRACE_SHIFT,
+                 min_correlation=MIN_PROFILE_CORRELATION):
+        self.max_shift = max_shift
+        self.min_correlation = min_correlation
+        self.profile = None
+        self.profile_model = None
+        self.traces = None
+
+    def lookup(self, data):
+        """Targets and traces for a new exposure
+
+        Args:
+            data (array): 2D image of the new exposure.
+
+        Returns:
+            A tuple with copies of the profile model and the list of traces,
+            shifted to the new exposure, or None when there is nothing stored
+            or the stored targets do not match.
+
+        """
+        if self.profile is None:
+            return None
+        shift, correlation = profile_shift(reference=self.profile,
+                                           profile=spatial_profile(data),
+                                           max_shift=2 * self.max_shift)
+        if correlation < self.min_correlation or \
+                abs(shift) > self.max_shift:
+            log.debug('Stored traces rejected: shift {:.2f} correlation '
+                      '{:.3f}'.format(shift, correlation))
+            return None
+        log.debug('Reusing stored traces: shift {:.2f} correlation '
+                  '{:.3f}'.format(shift, correlation))
+
+        profile_model = self.profile_model.copy()
+        for name in profile_model.param_names:
+            if name.startswith('mean'):
+                getattr(profile_model, name).value += shift
+        traces = [single_trace.copy() for single_trace in self.traces]
+        for single_trace in traces:
+            single_trace.c0.value += shift
+        return profile_model, traces
+
+    def store(self, data, profile_model, traces):
+        """Stores the targets and traces found in an exposure
+
+        Args:
+            data (array): 2D image of the exposure.
+            profile_model (object): An astropy.modeling.Model instance, the
+                spatial profile of the targets.
+            traces (list): astropy.modeling.Model instances, one trace per
+                target.
+
+        """
+        self.profile = spatial_profile(data)
+        self.profile_model = profile_model.copy()
+        self.traces = [single_trace.copy() for single_trace in traces]
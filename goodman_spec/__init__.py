@@ -2,4 +2,4 @@
 
 """
 
-from redspec import MainApp
+from .redspec import MainApp
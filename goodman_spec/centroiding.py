@@ -0,0 +1,200 @@
+# -*- coding: utf8 -*-
+"""Centroids of emission lines in comparison lamps
+
+Lines are first found as local maxima, then recentered using the data around
+them. All the lines of a lamp are processed at once with numpy operations,
+there are no loops over lines or pixels.
+
+Narrow lines use a "center of mass" within limits found by detecting where
+the data stops decreasing away from the peak, see `recenter_lines`. Broad
+lines, observed with wide slits, are recentered by fitting a parabola to the
+logarithm of the data around each peak, which is equivalent to fitting a
+gaussian, see `recenter_broad_lines`.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+import numpy as np
+
+from astropy.convolution import convolve, Gaussian1DKernel
+
+log = logging.getLogger('redspec.centroiding')
+
+# standard deviation of the kernel that smooths lamps with broad lines
+BROAD_LINES_STDDEV = 2.
+
+# lines whose left and right heights differ more than this ratio are not
+# recentered, the centroid would be pulled towards a blended neighbour
+MAX_ASYMMETRY = 2.
+
+
+def line_limits(data, lines, median=None):
+    """Finds where every line stops decreasing at both sides
+
+    Walking away from the peak, a line ends at the first pixel where the data
+    rises for two consecutive pixels or falls below the median. Those pixels
+    are found for the whole array at once and every line takes the nearest
+    one at each side.
+
+    Args:
+        data (array): Lamp data.
+        lines (array): Integer pixel position of the peaks.
+        median (float): Median of the data, computed if not given.
+
+    Returns:
+        A tuple of four arrays, the left and right limits of every line and
+        the last pixel scanned at each side. The latter is one pixel beyond
+        the limit, or the peak itself when there is no room to scan.
+
+    """
+    data = np.asarray(data, dtype=float)
+    lines = np.asarray(lines, dtype=int)
+    x_size = len(data)
+    if median is None:
+        median = np.median(data)
+    index = np.arange(x_size)
+
+    below_median = data < median
+
+    # rising towards the left, data[i - 2] > data[i - 1] > data[i]
+    left_stop = below_median.copy()
+    left_stop[2:] |= (data[1:-1] > data[2:]) & (data[:-2] > data[1:-1])
+    left_stop[:3] = False
+    last_stop = np.maximum.accumulate(np.where(left_stop, index, -1))
+
+    # rising towards the right, data[i + 2] > data[i + 1] > data[i]
+    right_stop = below_median.copy()
+    right_stop[:-2] |= (data[1:-1] > data[:-2]) & (data[2:] > data[1:-1])
+    right_stop[max(x_size - 3, 0):] = False
+    next_stop = np.minimum.accumulate(
+        np.where(right_stop, index, x_size)[::-1])[::-1]
+
+    left_limit = np.where(last_stop[lines] >= 0, last_stop[lines], 3)
+    left_index = left_limit - 1
+    no_room = lines <= 2
+    left_limit[no_room] = 0
+    left_index[no_room] = lines[no_room]
+
+    right_limit = np.where(next_stop[lines] < x_size,
+                           next_stop[lines],
+                           x_size - 4)
+    right_index = right_limit + 1
+    no_room = lines >= x_size - 3
+    right_limit[no_room] = 1
+    right_index[no_room] = lines[no_room]
+
+    return left_limit, right_limit, left_index, right_index
+
+
+def recenter_lines(data, lines):
+    """Centroids of narrow emission lines
+
+    The centroid of every line is computed over a window symmetric around the
+    peak that reaches the nearest of its limits, see `line_limits`. Lines whose
+    heights over the left and right limits differ by a factor of
+    MAX_ASYMMETRY or more keep the peak position.
+
+    Args:
+        data (array): Lamp data.
+        lines (array): Integer pixel position of the peaks.
+
+    Returns:
+        An array with the recentered line positions, counting pixels from one.
+
+    """
+    data = np.asarray(data, dtype=float)
+    lines = np.asarray(lines, dtype=int)
+    if len(lines) == 0:
+        return np.array([])
+
+    left_limit, right_limit, left_index, right_index = line_limits(data,
+                                                                   lines)
+
+    half_width = np.minimum(np.abs(lines - left_index),
+                            np.abs(lines - right_index))
+
+    # window sums from cumulative sums, zero prepended for empty prefixes
+    weight_sum = np.concatenate([[0.], np.cumsum(data)])
+    moment_sum = np.concatenate([[0.], np.cumsum(np.arange(len(data)) * data)])
+    low = lines - half_width
+    high = lines + half_width + 1
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centroid = (moment_sum[high] - moment_sum[low]) / \
+                   (weight_sum[high] - weight_sum[low])
+
+        left_height = np.abs(data[lines] - data[left_limit])
+        right_height = np.abs(data[lines] - data[right_limit])
+        asymmetric = np.maximum(left_height, right_height) / \
+            np.minimum(left_height, right_height) >= MAX_ASYMMETRY
+
+    return np.where(asymmetric, lines, centroid) + 1
+
+
+def recenter_broad_lines(data, lines, order):
+    """Centers of broad emission lines
+
+    The data is smoothed and for every line a parabola is fitted to the
+    logarithm of the data within `order` pixels of the peak, minus the
+    minimum of that window. The fit is weighted by the squared data, the
+    weights of a gaussian fit, and all lines are solved at once. Lines where
+    the fit is not a maximum keep their peak position.
+
+    Args:
+        data (array): Lamp data.
+        lines (array): Integer pixel position of the peaks.
+        order (int): Rough estimate of the FWHM of the lines in pixels.
+
+    Returns:
+        An array with the recentered line positions.
+
+    """
+    data = np.asarray(data, dtype=float)
+    lines = np.asarray(lines, dtype=int)
+    if len(lines) == 0:
+        return np.array([])
+    order = max(int(order), 1)
+
+    smoothed = convolve(data, Gaussian1DKernel(stddev=BROAD_LINES_STDDEV))
+
+    offsets = np.arange(-order, order)
+    columns = lines[:, np.newaxis] + offsets
+    inside = (columns >= 0) & (columns < len(smoothed))
+    samples = np.where(inside,
+                       smoothed[np.clip(columns, 0, len(smoothed) - 1)],
+                       np.nan)
+    samples -= np.nanmin(samples, axis=1)[:, np.newaxis]
+
+    valid = inside & (samples > 0)
+    weights = np.where(valid, samples, 0.) ** 2
+    log_samples = np.log(np.where(valid, samples, 1.))
+
+    # weighted least squares of log(y) = a + b * x + c * x ** 2 with x
+    # relative to the peak, normal equations solved for all lines at once
+    x = offsets.astype(float)
+    powers = [np.sum(weights * x ** k, axis=1) for k in range(5)]
+    normal_matrix = np.array([[powers[0], powers[1], powers[2]],
+                              [powers[1], powers[2], powers[3]],
+                              [powers[2], powers[3], powers[4]]])
+    normal_matrix = np.moveaxis(normal_matrix, -1, 0)
+    right_side = np.array([np.sum(weights * log_samples * x ** k, axis=1)
+                           for k in range(3)]).T
+
+    centers = lines.astype(float)
+    solvable = np.abs(np.linalg.det(normal_matrix)) > 0
+    if np.any(solvable):
+        coefficients = np.linalg.solve(normal_matrix[solvable],
+                                       right_side[solvable][..., np.newaxis])
+        b = coefficients[:, 1, 0]
+        c = coefficients[:, 2, 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vertex = -b / (2 * c)
+        good = (c < 0) & (np.abs(vertex) <= order)
+        fitted = centers[solvable]
+        fitted[good] += vertex[good]
+        centers[solvable] = fitted
+    return centers
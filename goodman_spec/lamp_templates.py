@@ -0,0 +1,164 @@
+# -*- coding: utf8 -*-
+"""Preprocessed reference lamp templates
+
+Reference lamps never change, but solving every new comparison lamp used to
+read the reference FITS file, parse its wavelength solution and evaluate the
+wavelength axis. A `LampTemplate` holds all that preprocessed data, plus the
+downsampled and normalized flux the lamps are registered against, see
+`registration.global_registration`. Templates are built once per process and
+stored on disk as ``.npz`` files in a ``.template_cache`` directory inside the
+reference directory, they are rebuilt when the reference lamp changes.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import logging
+import os
+
+import numpy as np
+
+from astropy.io import fits
+
+from .registration import registration_flux
+from .wsbuilder import ReadMathFunctions, ReadWavelengthSolution
+
+log = logging.getLogger('redspec.lamptemplates')
+
+CACHE_DIR_NAME = '.template_cache'
+TEMPLATE_VERSION = 2
+
+# templates already loaded in this process, by full path of the reference lamp
+_TEMPLATE_CACHE = {}
+
+
+class LampTemplate(object):
+    """A reference lamp ready to be compared with new lamps
+
+    Attributes:
+        file_name (str): Full path of the reference lamp.
+        wav_axis (array): Wavelength of every pixel in angstrom.
+        flux (array): Reference lamp flux.
+        registration_flux (array): `flux` downsampled and normalized for
+            `registration.global_registration`.
+        wcs_dict (dict): Wavelength solution parameters as read by
+            ReadWavelengthSolution.
+        math_model (object): Callable wavelength solution, pixel to angstrom.
+
+    """
+
+    def __init__(self, file_name, wav_axis, flux, wcs_dict):
+        self.file_name = file_name
+        self.wav_axis = np.asarray(wav_axis, dtype=float)
+        self.flux = np.asarray(flux, dtype=float)
+        self.registration_flux = registration_flux(self.flux)
+        self.wcs_dict = wcs_dict
+        self.math_model = ReadMathFunctions(wcs_dict).get_solution()
+
+    @classmethod
+    def from_fits(cls, file_name):
+        """Builds a template reading a reference lamp
+
+        Args:
+            file_name (str): Full path to the reference lamp.
+
+        Returns:
+            A LampTemplate instance.
+
+        """
+        data, header = fits.getdata(file_name, header=True)
+        read_wsolution = ReadWavelengthSolution(header=header, data=data)
+        wav_axis, flux = read_wsolution()
+        return cls(file_name=file_name,
+                   wav_axis=wav_axis,
+                   flux=flux,
+                   wcs_dict=read_wsolution.wcs_dict)
+
+    @classmethod
+    def from_npz(cls, cache_file, file_name):
+        """Loads a template from its cache file
+
+        Args:
+            cache_file (str): Full path to the .npz file.
+            file_name (str): Full path of the reference lamp it belongs to.
+
+        Returns:
+            A LampTemplate instance or None if the cache is outdated.
+
+        """
+        stat = os.stat(file_name)
+        with np.load(cache_file) as stored:
+            if int(stored['version']) != TEMPLATE_VERSION or \
+                    float(stored['mtime']) != stat.st_mtime or \
+                    int(stored['size']) != stat.st_size:
+                return None
+            return cls(file_name=file_name,
+                       wav_axis=stored['wav_axis'],
+                       flux=stored['flux'],
+                       wcs_dict=json.loads(str(stored['wcs_dict'])))
+
+    def save(self, cache_file):
+        """Writes the template to a .npz file
+
+        The registration flux is not stored, it is cheaper to compute than to
+        read.
+
+        Args:
+            cache_file (str): Full path to the .npz file.
+
+        """
+        stat = os.stat(self.file_name)
+        np.savez(cache_file,
+                 version=TEMPLATE_VERSION,
+                 mtime=stat.st_mtime,
+                 size=stat.st_size,
+                 wav_axis=self.wav_axis,
+                 flux=self.flux,
+                 wcs_dict=json.dumps(self.wcs_dict))
+
+
+def get_lamp_template(file_name):
+    """Returns the template of a reference lamp
+
+    Looks for it in memory, then in the cache directory and builds it from the
+    FITS file as a last resort, writing the cache file if possible.
+
+    Args:
+        file_name (str): Full path to the reference lamp.
+
+    Returns:
+        A LampTemplate instance, shared by the whole process and therefore
+        read-only.
+
+    """
+    key = os.path.abspath(file_name)
+    try:
+        return _TEMPLATE_CACHE[key]
+    except KeyError:
+        pass
+
+    cache_dir = os.path.join(os.path.dirname(key), CACHE_DIR_NAME)
+    cache_file = os.path.join(
+        cache_dir, os.path.splitext(os.path.basename(key))[0] + '.npz')
+
+    template = None
+    if os.path.isfile(cache_file):
+        try:
+            template = LampTemplate.from_npz(cache_file, file_name)
+        except (IOError, OSError, ValueError, KeyError) as error:
+            log.debug('Unable to read {:s}: {:s}'.format(cache_file,
+                                                         str(error)))
+    if template is None:
+        log.debug('Building template for {:s}'.format(file_name))
+        template = LampTemplate.from_fits(file_name)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            template.save(cache_file)
+        except (IOError, OSError) as error:
+            log.debug('Template cache not saved: {:s}'.format(str(error)))
+
+    _TEMPLATE_CACHE[key] = template
+    return template
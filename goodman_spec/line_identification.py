@@ -0,0 +1,326 @@
+# -*- coding: utf8 -*-
+"""Identification of comparison lamp lines without a reference lamp
+
+Most instrument configurations have no reference lamp, so the automatic
+wavelength solution can not register the new lamp against one. Instead, the
+detected lines are identified by the pattern of their spacings, as triplets
+are matched in astrometry:
+
+  - Every three detected lines close to each other form a triplet. Its ratio
+    (x2 - x1) / (x3 - x1) does not change with a shift or a scale of the
+    wavelength axis, so the corresponding reference lines have the same one.
+  - The triplets are sorted by their span in pixels. For every pair of
+    reference lines, the triplets whose span agrees with the dispersion
+    predicted from the grating equation are found with a binary search, and
+    their ratio is checked looking up the middle line in the sorted
+    reference lines.
+  - Every matching triplet gives a linear solution, the ones whose
+    wavelength range disagrees with the predicted one are discarded.
+  - The remaining solutions are the hypotheses of a RANSAC, the one that
+    brings most of the detected lines onto a reference line wins. Its
+    matches are refined with a low order polynomial.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+import numpy as np
+
+from scipy.stats import binom
+
+from .linelist import match_lines, nearest_lines
+
+log = logging.getLogger('redspec.lineidentification')
+
+# triplets are made with detected lines up to this many positions apart
+DETECTED_NEIGHBOURS = 4
+
+# brightest detected lines used to make triplets
+MAX_PATTERN_LINES = 40
+
+# largest distance in pixels between the middle line of a triplet and the
+# reference line it is matched with
+MIDDLE_TOLERANCE = 1.
+
+# largest relative difference between the dispersion of a hypothesis and the
+# predicted one
+DISPERSION_TOLERANCE = 0.1
+
+# largest difference between the wavelength range of a hypothesis and the
+# predicted one, as a fraction of the predicted range
+RANGE_TOLERANCE = 0.1
+
+# hypotheses scored, a random sample when there are more
+MAX_HYPOTHESES = 5000
+
+# a line is an inlier when it falls closer than this number of pixels to a
+# reference line, linear hypotheses need a wider window than the refinement
+HYPOTHESIS_TOLERANCE = 5.
+REFINEMENT_TOLERANCE = 3.
+
+# degree of the polynomial used to refine the matches, and its iterations
+REFINEMENT_DEGREE = 2
+REFINEMENT_ITERATIONS = 3
+
+# fewer matched lines than this is not an identification
+MIN_IDENTIFIED_LINES = 6
+
+# lines closer than this number of pixels to their reference line are the
+# evidence of an identification, it is rejected if the probability of
+# matching as many lines by chance, for all the hypotheses tried, is larger
+# than MAX_FALSE_ALARM
+EVIDENCE_TOLERANCE = 1.
+MAX_FALSE_ALARM = 1e-3
+
+
+def triplets(positions, neighbours):
+    """Triplets of a sorted list of positions and their ratios
+
+    Args:
+        positions (array): Sorted positions, pixels or wavelengths.
+        neighbours (int): Largest distance in positions between the first and
+            the last line of a triplet.
+
+    Returns:
+        A tuple with the indices of the first, middle and last line of every
+        triplet and its ratio (middle - first) / (last - first).
+
+    """
+    first, middle, last = [], [], []
+    for i in range(len(positions)):
+        for k in range(i + 2, min(len(positions), i + neighbours + 1)):
+            for j in range(i + 1, k):
+                first.append(i)
+                middle.append(j)
+                last.append(k)
+    first = np.array(first, dtype=int)
+    middle = np.array(middle, dtype=int)
+    last = np.array(last, dtype=int)
+    ratio = (positions[middle] - positions[first]) / \
+        (positions[last] - positions[first])
+    return first, middle, last, ratio
+
+
+def nearest_distance(values, sorted_lines):
+    """Distance of every value to the closest line of a sorted array"""
+    return np.abs(values - nearest_lines(values, sorted_lines))
+
+
+def expand_ranges(starts, stops):
+    """Rows and positions of every element of a set of ranges
+
+    Args:
+        starts (array): First position of every range.
+        stops (array): Position after the last one of every range.
+
+    Returns:
+        Two arrays, the range every element belongs to and its position.
+
+    """
+    counts = np.maximum(stops - starts, 0)
+    rows = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+    return rows, starts[rows] + offsets
+
+
+def hypotheses(pixels, reference_lines, dispersion, blue, red):
+    """Linear solutions from the triplets matched to reference lines
+
+    Args:
+        pixels (array): Sorted positions of the lines used for the patterns.
+        reference_lines (array): Sorted reference lines.
+        dispersion (float): Predicted dispersion in angstrom per pixel.
+        blue (float): Predicted wavelength of the first pixel.
+        red (float): Predicted wavelength of the last pixel.
+
+    Returns:
+        Two arrays, the dispersion and the wavelength of the first pixel of
+        every hypothesis.
+
+    """
+    empty = np.array([]), np.array([])
+    if len(pixels) < 3 or len(reference_lines) < 3:
+        return empty
+
+    first, middle, last, ratio = triplets(pixels, DETECTED_NEIGHBOURS)
+    span = pixels[last] - pixels[first]
+    order = np.argsort(span, kind='mergesort')
+    sorted_span = span[order]
+
+    # pairs of reference lines with at least one line in between, as wide
+    # as the widest triplet
+    max_span = sorted_span[-1] * dispersion * (1 + DISPERSION_TOLERANCE)
+    ref_first, ref_last = expand_ranges(
+        starts=np.arange(len(reference_lines)) + 2,
+        stops=np.searchsorted(reference_lines, reference_lines + max_span,
+                              side='right'))
+    ref_span = reference_lines[ref_last] - reference_lines[ref_first]
+
+    # triplets with the span of every pair for the predicted dispersion
+    pair, position = expand_ranges(
+        starts=np.searchsorted(
+            sorted_span,
+            ref_span / (dispersion * (1 + DISPERSION_TOLERANCE)),
+            side='left'),
+        stops=np.searchsorted(
+            sorted_span,
+            ref_span / (dispersion * (1 - DISPERSION_TOLERANCE)),
+            side='right'))
+    if len(pair) == 0:
+        return empty
+    triplet = order[position]
+
+    slope = ref_span[pair] / span[triplet]
+    w_first = reference_lines[ref_first[pair]]
+    intercept = w_first - slope * pixels[first[triplet]]
+
+    # the middle line must fall on a reference line
+    w_middle = w_first + ratio[triplet] * ref_span[pair]
+    valid = nearest_distance(w_middle, reference_lines) <= \
+        MIDDLE_TOLERANCE * slope
+    valid &= np.abs(intercept - blue) <= RANGE_TOLERANCE * (red - blue)
+    return slope[valid], intercept[valid]
+
+
+def identify_lines(pixels, length, reference_lines, center_wavelength,
+                   dispersion, intensities=None, seed=0):
+    """Identifies the lines of a lamp without a reference lamp
+
+    Args:
+        pixels (array): Position of the lines detected in the lamp.
+        length (int): Number of pixels of the lamp.
+        reference_lines (array): Sorted lines of the elements in the lamp.
+        center_wavelength (float): Predicted wavelength of the central pixel.
+        dispersion (float): Predicted dispersion in angstrom per pixel.
+        intensities (array): Intensity of every detected line, the brightest
+            MAX_PATTERN_LINES are used to make triplets. All if None.
+        seed (int): Seed of the random sample of hypotheses, the
+            identification is reproducible.
+
+    Returns:
+        Two arrays, the pixels of the identified lines and the wavelength of
+        their reference lines. Both are empty if the lines were not
+        identified.
+
+    """
+    empty = np.array([]), np.array([])
+    pixels = np.asarray(pixels, dtype=float)
+    reference_lines = np.asarray(reference_lines, dtype=float)
+    if len(pixels) < MIN_IDENTIFIED_LINES:
+        return empty
+
+    blue = center_wavelength - dispersion * length / 2.
+    red = center_wavelength + dispersion * length / 2.
+    margin = RANGE_TOLERANCE * (red - blue)
+    reference_lines = reference_lines[(reference_lines >= blue - margin) &
+                                      (reference_lines <= red + margin)]
+    if len(reference_lines) < MIN_IDENTIFIED_LINES:
+        log.debug('Not enough reference lines between {:.1f} and '
+                  '{:.1f}'.format(blue - margin, red + margin))
+        return empty
+
+    pattern_pixels = pixels
+    if intensities is not None and len(pixels) > MAX_PATTERN_LINES:
+        brightest = np.argsort(intensities)[::-1][:MAX_PATTERN_LINES]
+        pattern_pixels = pixels[np.sort(brightest)]
+    pattern_pixels = np.sort(pattern_pixels)
+
+    slope, intercept = hypotheses(pixels=pattern_pixels,
+                                  reference_lines=reference_lines,
+                                  dispersion=dispersion,
+                                  blue=blue,
+                                  red=red)
+    log.debug('{:d} hypotheses from matching triplets'.format(len(slope)))
+    if len(slope) == 0:
+        return empty
+    if len(slope) > MAX_HYPOTHESES:
+        sample = np.random.RandomState(seed).choice(len(slope),
+                                                    MAX_HYPOTHESES,
+                                                    replace=False)
+        slope = slope[sample]
+        intercept = intercept[sample]
+
+    # consensus of every hypothesis, all at once
+    predicted = intercept[:, np.newaxis] + slope[:, np.newaxis] * pixels
+    distance = nearest_distance(predicted.ravel(), reference_lines).reshape(
+        predicted.shape) / slope[:, np.newaxis]
+    inliers = distance <= HYPOTHESIS_TOLERANCE
+    n_inliers = inliers.sum(axis=1)
+    # every inlier counts less the farther it is from its reference line, so
+    # the lines that fall close to a reference line by chance in a dense line
+    # list weigh less
+    score = np.where(inliers,
+                     1 - (distance / HYPOTHESIS_TOLERANCE) ** 2,
+                     0).sum(axis=1)
+    best = np.argmax(score)
+    log.debug('Best hypothesis: {:.4f} A/pixel from {:.1f} A, {:d} '
+              'inliers'.format(slope[best], intercept[best],
+                               int(n_inliers[best])))
+    if n_inliers[best] < MIN_IDENTIFIED_LINES:
+        return empty
+
+    model = np.polynomial.Polynomial([intercept[best], slope[best]])
+    matched_pixels, matched_lines = match_lines(
+        pixels=pixels,
+        model=model,
+        sorted_lines=reference_lines,
+        tolerance=HYPOTHESIS_TOLERANCE)
+    for _ in range(REFINEMENT_ITERATIONS):
+        if len(matched_pixels) <= REFINEMENT_DEGREE:
+            return empty
+        model = np.polynomial.Polynomial.fit(matched_pixels,
+                                             matched_lines,
+                                             REFINEMENT_DEGREE)
+        matched_pixels, matched_lines = match_lines(
+            pixels=pixels,
+            model=model,
+            sorted_lines=reference_lines,
+            tolerance=REFINEMENT_TOLERANCE)
+
+    if len(matched_pixels) < MIN_IDENTIFIED_LINES:
+        return empty
+
+    false_alarm = false_alarm_probability(
+        pixels=pixels,
+        model=model,
+        reference_lines=reference_lines,
+        n_hypotheses=len(slope))
+    log.debug('Identified {:d} lines, false alarm probability '
+              '{:.2g}'.format(len(matched_pixels), false_alarm))
+    if false_alarm > MAX_FALSE_ALARM:
+        return empty
+    return matched_pixels, matched_lines
+
+
+def false_alarm_probability(pixels, model, reference_lines, n_hypotheses):
+    """Probability of matching as many lines by chance
+
+    A line falls closer than EVIDENCE_TOLERANCE to a reference line by chance
+    with a probability given by the density of reference lines, so the number
+    of lines matched by chance follows a binomial distribution.
+
+    Args:
+        pixels (array): Position of the detected lines.
+        model (callable): Converts pixels to angstrom.
+        reference_lines (array): Sorted reference lines in the range of the
+            lamp.
+        n_hypotheses (int): Number of hypotheses tried.
+
+    Returns:
+        The probability, for the best of `n_hypotheses` random solutions, of
+        matching at least as many lines as `model`.
+
+    """
+    predicted = model(pixels)
+    dispersion = np.abs(model(pixels + 0.5) - model(pixels - 0.5))
+    n_matched = np.sum(nearest_distance(predicted, reference_lines) <=
+                       EVIDENCE_TOLERANCE * dispersion)
+    density = len(reference_lines) / (reference_lines[-1] -
+                                      reference_lines[0])
+    chance = min(1., 2 * EVIDENCE_TOLERANCE * np.mean(dispersion) * density)
+    return min(1., binom.sf(n_matched - 1, len(pixels), chance) *
+               max(n_hypotheses, 1))
@@ -0,0 +1,141 @@
+# -*- coding: utf8 -*-
+"""Linearization of spectra sharing a wavelength solution
+
+A spectrum is linearized by fitting an interpolating cubic spline to the flux
+as a function of wavelength and evaluating it on a linear wavelength axis.
+The spline is linear in the flux, so everything that depends only on the
+wavelength axis is computed once: the B-spline collocation matrix, stored in
+banded form, and the four non zero basis functions at every new wavelength.
+Linearizing a stack of spectra is then a single banded solve and a weighted
+sum, instead of one ``splrep``/``splev`` per spectrum.
+
+The splines have not-a-knot end conditions, the ones used by
+``scipy.interpolate.splrep`` with ``s=0``, so results are the same within
+rounding errors.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+import numpy as np
+
+from scipy.linalg import solve_banded
+from scipy.ndimage import median_filter
+
+log = logging.getLogger('redspec.linearization')
+
+# the splines are cubic
+DEGREE = 3
+
+# size of the median filter applied to the linearized spectra
+MEDIAN_FILTER_SIZE = 3
+
+
+def bspline_basis(knots, points):
+    """Non zero cubic B-spline basis functions at a set of points
+
+    Uses the Cox-de Boor recursion for all points at once.
+
+    Args:
+        knots (array): Non decreasing knot vector.
+        points (array): Points within the base interval of the knots.
+
+    Returns:
+        A tuple with the index of the first non zero basis function at every
+        point and a (len(points), 4) array with the values of the four non
+        zero basis functions.
+
+    """
+    n_coefficients = len(knots) - DEGREE - 1
+    interval = np.searchsorted(knots, points, side='right') - 1
+    interval = np.clip(interval, DEGREE, n_coefficients - 1)
+
+    values = np.zeros((len(points), DEGREE + 1))
+    values[:, 0] = 1.
+    left = np.zeros((len(points), DEGREE + 1))
+    right = np.zeros((len(points), DEGREE + 1))
+    for j in range(1, DEGREE + 1):
+        left[:, j] = points - knots[interval + 1 - j]
+        right[:, j] = knots[interval + j] - points
+        saved = np.zeros(len(points))
+        for r in range(j):
+            denominator = right[:, r + 1] + left[:, j - r]
+            temp = values[:, r] / denominator
+            values[:, r] = saved + right[:, r + 1] * temp
+            saved = left[:, j - r] * temp
+        values[:, j] = saved
+    return interval - DEGREE, values
+
+
+class Linearizer(object):
+    """Resamples spectra to a linear wavelength axis
+
+    Args:
+        x_axis (array): Wavelength of every pixel, strictly increasing.
+
+    Attributes:
+        x_axis (array): Wavelength of every pixel.
+        new_x_axis (array): Linear wavelength axis with the same limits and
+            number of points as `x_axis`.
+
+    """
+
+    def __init__(self, x_axis):
+        self.x_axis = np.asarray(x_axis, dtype=float)
+        size = len(self.x_axis)
+        if size < DEGREE + 2:
+            raise ValueError('At least {:d} points are needed to '
+                             'linearize'.format(DEGREE + 2))
+        self.new_x_axis = np.linspace(self.x_axis[0], self.x_axis[-1], size)
+
+        # not-a-knot: the second and second to last points are not knots
+        self.knots = np.concatenate([[self.x_axis[0]] * (DEGREE + 1),
+                                     self.x_axis[2:-2],
+                                     [self.x_axis[-1]] * (DEGREE + 1)])
+
+        # collocation matrix in the banded storage of scipy.linalg
+        first, values = bspline_basis(self.knots, self.x_axis)
+        rows = np.repeat(np.arange(size), DEGREE + 1)
+        columns = (first[:, np.newaxis] + np.arange(DEGREE + 1)).ravel()
+        values = values.ravel()
+        offsets = columns - rows
+        self.lower = int(max(0, -offsets.min()))
+        self.upper = int(max(0, offsets.max()))
+        self.banded = np.zeros((self.lower + self.upper + 1, size))
+        self.banded[self.upper + rows - columns, columns] = values
+
+        # evaluation weights on the linear axis
+        self.first, self.weights = bspline_basis(self.knots, self.new_x_axis)
+
+    def __call__(self, spectra, smooth=True):
+        """Linearizes one spectrum or a stack of them
+
+        Args:
+            spectra (array): One spectrum or a 2D array with one spectrum per
+                row, all with the length of `x_axis`.
+            smooth (bool): Apply a median filter of size MEDIAN_FILTER_SIZE,
+                as ``scipy.signal.medfilt`` does, zero padded.
+
+        Returns:
+            The linearized spectra with the same shape as `spectra`.
+
+        """
+        spectra = np.asarray(spectra, dtype=float)
+        stack = np.atleast_2d(spectra)
+
+        coefficients = solve_banded((self.lower, self.upper),
+                                    self.banded,
+                                    stack.T)
+        columns = self.first[:, np.newaxis] + np.arange(DEGREE + 1)
+        linearized = np.einsum('ij,ijk->ki',
+                               self.weights,
+                               coefficients[columns])
+        if smooth:
+            linearized = median_filter(linearized,
+                                       size=(1, MEDIAN_FILTER_SIZE),
+                                       mode='constant',
+                                       cval=0.)
+        return linearized.reshape(spectra.shape)
@@ -0,0 +1,247 @@
+# -*- coding: utf8 -*-
+"""Deferred rendering of diagnostic plots
+
+Diagnostic and quality assessment plots used to be drawn, displayed and saved
+inline, adding several seconds per target to the reduction. Here a plot is
+described by a `PlotRecord`, a lightweight picklable object with the data and
+the decorations, that can be rendered either on screen or to files by a pool of
+worker processes while the reduction goes on.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import glob
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+
+from goodman_ccd.lazy_import import plt
+
+log = logging.getLogger('redspec.plotrenderer')
+
+# approximate memory used by a rendering process, in bytes
+WORKER_MEMORY = 150e6
+
+
+class PlotRecord(object):
+    """Description of a single-axes figure
+
+    Only the data and the decorations are stored, no matplotlib object is
+    created until the record is rendered.
+
+    Args:
+        title (str): Axes title.
+        window_title (str): Title of the window when displayed on screen.
+        xlabel (str): Label of the x axis.
+        ylabel (str): Label of the y axis.
+        xlim (tuple): Limits of the x axis, None for automatic limits.
+        figsize (tuple): Figure size in inches, None for matplotlib's default.
+
+    """
+
+    def __init__(self, title='', window_title='', xlabel='', ylabel='',
+                 xlim=None, figsize=None):
+        self.title = title
+        self.window_title = window_title
+        self.xlabel = xlabel
+        self.ylabel = ylabel
+        self.xlim = xlim
+        self.figsize = figsize
+        self.lines = []
+        self.vertical_lines = []
+        self.outputs = []
+
+    def plot(self, x, y, **kwargs):
+        """Adds a line, keyword arguments are passed to `Axes.plot`"""
+        self.lines.append((np.asarray(x), np.asarray(y), kwargs))
+
+    def axvlines(self, values, **kwargs):
+        """Adds vertical lines at each of `values`
+
+        Keyword arguments are passed to `Axes.axvline`.
+
+        """
+        self.vertical_lines.append((np.asarray(values), kwargs))
+
+    def add_output(self, file_name, dpi=None):
+        """Adds a file to which the figure will be saved
+
+        The format is defined by the file extension.
+
+        Args:
+            file_name (str): Full path to the output file.
+            dpi (int): Resolution in dots per inch, None for matplotlib's
+                default.
+
+        """
+        self.outputs.append((file_name, dpi))
+
+    def draw(self, figure):
+        """Draws the record on a matplotlib figure
+
+        Args:
+            figure (object): matplotlib.figure.Figure instance.
+
+        """
+        axes = figure.add_subplot(111)
+        for values, kwargs in self.vertical_lines:
+            for value in values:
+                axes.axvline(value, **kwargs)
+        for x, y, kwargs in self.lines:
+            axes.plot(x, y, **kwargs)
+        axes.set_title(self.title)
+        axes.set_xlabel(self.xlabel)
+        axes.set_ylabel(self.ylabel)
+        if self.xlim is not None:
+            axes.set_xlim(self.xlim)
+        if any('label' in kwargs for _, _, kwargs in self.lines):
+            axes.legend(loc='best')
+        figure.tight_layout()
+
+
+def render_plot_record(record):
+    """Renders a plot record to its output files
+
+    This function does not use pyplot, therefore it does not depend on the
+    interactive backend nor does it require a display and it can run in a
+    worker process.
+
+    Args:
+        record (object): PlotRecord instance.
+
+    Returns:
+        The list of files written.
+
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=record.figsize)
+    FigureCanvasAgg(figure)
+    record.draw(figure)
+    written = []
+    for file_name, dpi in record.outputs:
+        figure.savefig(file_name, dpi=dpi)
+        written.append(file_name)
+    return written
+
+
+def show_plot_record(record, block=False, pause=2):
+    """Displays a plot record on screen
+
+    Args:
+        record (object): PlotRecord instance.
+        block (bool): If True the figure is shown until the user closes it,
+            otherwise it is displayed during `pause` seconds.
+        pause (float): Seconds to display the figure when `block` is False.
+
+    """
+    if block:
+        plt.ioff()
+    else:
+        plt.ion()
+    figure = plt.figure(figsize=record.figsize)
+    figure.canvas.set_window_title(record.window_title)
+    manager = plt.get_current_fig_manager()
+    if plt.get_backend() == u'GTK3Agg':
+        manager.window.maximize()
+    elif plt.get_backend() == u'Qt4Agg':
+        manager.window.showMaximized()
+    record.draw(figure)
+    if block:
+        plt.show()
+    else:
+        plt.draw()
+        plt.pause(pause)
+        plt.ioff()
+        plt.close(figure)
+
+
+class DeferredPlotRenderer(object):
+    """Renders plot records to files in a pool of worker processes
+
+    Records are submitted while the reduction runs and rendered in the
+    background. `close` must be called at the end to wait for the pending
+    plots. With zero processes the records are rendered in the calling process
+    as soon as they are submitted.
+
+    Args:
+        processes (int): Number of worker processes.
+
+    """
+
+    def __init__(self, processes=2):
+        self.processes = processes
+        self._pool = None
+        self._pending = []
+        self._reserved_names = set()
+
+    def submit(self, record):
+        """Schedules the rendering of a plot record
+
+        Args:
+            record (object): PlotRecord instance with at least one output.
+
+        """
+        if not record.outputs:
+            log.debug('Plot record has no outputs, nothing to render')
+            return
+        if self.processes < 1:
+            self._log_written(render_plot_record(record))
+            return
+        if self._pool is None:
+            log.debug('Starting {:d} plot rendering '
+                      'processes'.format(self.processes))
+            self._pool = multiprocessing.Pool(processes=self.processes)
+        self._pending.append(self._pool.apply_async(render_plot_record,
+                                                    (record,)))
+
+    def unique_file_name(self, path, base_name, extension):
+        """Returns a file name that is not in use nor scheduled to be written
+
+        Since the plots are written asynchronously, counting files on disk is
+        not enough to number them.
+
+        Args:
+            path (str): Directory of the file.
+            base_name (str): File name without number nor extension.
+            extension (str): File extension including the dot.
+
+        Returns:
+            Full path of the form path/base_name_NNNN.extension
+
+        """
+        file_count = len(glob.glob(os.path.join(path, base_name + '*')))
+        while True:
+            file_name = os.path.join(
+                path, '{:s}_{:04d}{:s}'.format(base_name, file_count, extension))
+            if file_name not in self._reserved_names and \
+                    not os.path.exists(file_name):
+                self._reserved_names.add(file_name)
+                return file_name
+            file_count += 1
+
+    def close(self):
+        """Waits for all pending plots and stops the worker processes"""
+        if self._pool is None:
+            return
+        log.info('Waiting for {:d} plots to be rendered'.format(
+            len(self._pending)))
+        self._pool.close()
+        for pending in self._pending:
+            try:
+                self._log_written(pending.get())
+            except Exception as error:
+                log.error('Failed to render plot: {:s}'.format(str(error)))
+        self._pool.join()
+        self._pool = None
+        self._pending = []
+
+    @staticmethod
+    def _log_written(file_names):
+        for file_name in file_names:
+            log.debug('Saved plot {:s}'.format(file_name))
@@ -17,11 +17,10 @@ import os
 import textwrap
 import argparse
 import logging
-import matplotlib
-matplotlib.use('Qt4Agg')
 import warnings
-from .wavelength import WavelengthCalibration, process_spectroscopy_data
-from goodman_ccd.core import (classify_spectroscopic_data)
+
+from goodman_ccd.instrumentation import instrumentation
+from goodman_ccd.memory_budget import memory_budget, parse_memory_size
 
 
 warnings.filterwarnings('ignore')
@@ -54,36 +53,62 @@ def get_args(arguments=None):
         system
 
     """
-    leave = False
+    parser = get_parser()
+    args = parser.parse_args(args=arguments)
+    return check_args(parser=parser, args=args)
+
+
+def get_parser(paths=True):
+    """Creates the parser of the command line arguments
+
+    Args:
+        paths (bool): Add the arguments that locate the reduced data and the
+            output directory. goodman-reduce takes them from the CCD
+            reduction.
+
+    Returns:
+        An argparse.ArgumentParser instance.
+
+    """
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description=textwrap.dedent(
             '''Extracts goodman spectra and does wavelength calibration.'''))
 
-    parser.add_argument('--data-path',
-                        action='store',
-                        default='./',
-                        type=str,
-                        metavar='<Source Path>',
-                        dest='source',
-                        help='Path for location of raw data. Default <./>')
-
-    parser.add_argument('--proc-path',
-                        action='store',
-                        default='./',
-                        type=str,
-                        metavar='<Destination Path>',
-                        dest='destiny',
-                        help='Path for destination of processed data. Default '
-                             '<./>')
-
-    parser.add_argument('--search-pattern',
-                        action='store',
-                        default='cfzsto',
-                        type=str,
-                        metavar='<Search Pattern>',
-                        dest='pattern',
-                        help="Pattern for matching the goodman's reduced data.")
+    if paths:
+        parser.add_argument('--data-path',
+                            action='store',
+                            default='./',
+                            type=str,
+                            metavar='<Source Path>',
+                            dest='source',
+                            help='Path for location of raw data. Default <./>')
+
+        parser.add_argument('--proc-path',
+                            action='store',
+                            default='./',
+                            type=str,
+                            metavar='<Destination Path>',
+                            dest='destiny',
+                            help='Path for destination of processed data. '
+                                 'Default <./>')
+
+        parser.add_argument('--search-pattern',
+                            action='store',
+                            default='cfzsto',
+                            type=str,
+                            metavar='<Search Pattern>',
+                            dest='pattern',
+                            help="Pattern for matching the goodman's reduced "
+                                 "data.")
+
+        parser.add_argument('--ignore-manifest',
+                            action='store_true',
+                            dest='ignore_manifest',
+                            help="Find and classify the reduced data by "
+                                 "reading their headers even if redccd left "
+                                 "a manifest of its products in "
+                                 "<Source Path>.")
 
     parser.add_argument('--output-prefix',
                         action='store',
@@ -112,6 +137,22 @@ def get_args(arguments=None):
                         dest='reference_dir',
                         help="Directory of Reference files location")
 
+    parser.add_argument('--solution-library',
+                        action='store',
+                        default=None,
+                        metavar='<library_file>',
+                        dest='solution_library',
+                        help="File where accepted wavelength solutions are "
+                             "saved and taken as first guess for new lamps "
+                             "in automatic mode. Default "
+                             "goodman/goodman_solution_library.json in "
+                             "$XDG_DATA_HOME or ~/.local/share.")
+
+    parser.add_argument('--no-solution-library',
+                        action='store_true',
+                        dest='no_solution_library',
+                        help="Do not use nor update the solution library.")
+
     parser.add_argument('--interactive',
                         action='store_true',
                         dest='interactive_ws',
@@ -137,18 +178,97 @@ def get_args(arguments=None):
                         help="Maximum number of targets to be found in a "
                              "single image. Default 3")
 
+    parser.add_argument('--max-memory',
+                        action='store',
+                        dest='max_memory',
+                        metavar='<size>',
+                        type=parse_memory_size,
+                        default=None,
+                        help="Memory budget, i.e. 4G or 512M. Limits the "
+                             "number of --plot-workers and --workers. Default "
+                             "is no limit.")
+
+    parser.add_argument('--max-stretch',
+                        action='store',
+                        dest='max_stretch',
+                        metavar='<fraction>',
+                        type=float,
+                        default=0.,
+                        help="Largest relative stretch, i.e. 0.01, searched "
+                             "when registering a comparison lamp against its "
+                             "reference in automatic mode. Default 0, only "
+                             "a shift is searched.")
+
+    parser.add_argument('--memory-profile',
+                        action='store_true',
+                        dest='memory_profile',
+                        help="Record the peak memory used by every processing "
+                             "stage. It is added to the --timing-report file "
+                             "or logged at the end of the run.")
+
     parser.add_argument('--save-plots',
                         action='store_true',
                         dest='save_plots',
                         help="Save all plots in a directory")
 
+    parser.add_argument('--no-pause',
+                        action='store_true',
+                        dest='no_pause',
+                        help="Never stop to display plots. Plots requested "
+                             "with --plot-results or --debug are saved to the "
+                             "plots directory instead. Useful for batch runs.")
+
     parser.add_argument('--plot-results',
                         action='store_true',
                         dest='plot_results',
                         help="Show wavelength calibrated spectrum at the end.")
 
-    args = parser.parse_args(args=arguments)
+    parser.add_argument('--plot-workers',
+                        action='store',
+                        dest='plot_workers',
+                        metavar='<plot workers>',
+                        type=int,
+                        default=2,
+                        help="Number of background processes that render "
+                             "saved plots, 0 renders them inline. Default 2")
+
+    parser.add_argument('--timing-report',
+                        action='store',
+                        dest='timing_report',
+                        metavar='<report_file>',
+                        default=None,
+                        help="Time every processing stage, count frames and "
+                             "bytes read and written, show a progress line "
+                             "and write a JSON report to <report_file>.")
+
+    parser.add_argument('--workers',
+                        action='store',
+                        dest='workers',
+                        metavar='<workers>',
+                        type=int,
+                        default=1,
+                        help="Number of processes that extract and calibrate "
+                             "groups of science frames in parallel. Not used "
+                             "with --interactive or when plots are shown on "
+                             "screen. Default 1")
+
+    return parser
+
 
+def check_args(parser, args, paths=True):
+    """Validates the arguments and sets up logging
+
+    Args:
+        parser (object): The argparse.ArgumentParser that parsed `args`.
+        args (object): argparse.Namespace instance.
+        paths (bool): Whether `args` has the source and destination
+            directories, see `get_parser`.
+
+    Returns:
+        The argparse.Namespace instance with full paths.
+
+    """
+    leave = False
     if args.log_to_file:
         log.info('Logging to file {:s}'.format(LOG_FILENAME))
         file_handler = logging.FileHandler(LOG_FILENAME)
@@ -174,11 +294,11 @@ def get_args(arguments=None):
     else:
         args.reference_dir = ref_full_path
 
-    if not os.path.isdir(args.source):
+    if paths and not os.path.isdir(args.source):
         leave = True
         log.error("Source Directory doesn't exist.")
 
-    if not os.path.isdir(args.destiny):
+    if paths and not os.path.isdir(args.destiny):
         leave = True
         log.error("Destination folder doesn't exist.")
         try:
@@ -227,11 +347,35 @@ class MainApp(object):
         spectroscopic data reduction.
 
         """
+        # imported here so that parsing arguments (e.g. --help) stays fast.
+        from goodman_ccd.core import classify_spectroscopic_data
+        from goodman_ccd.manifest import classify_manifest, read_manifest
+        from .wavelength import process_spectroscopy_data
+
+        memory_budget.set_limit(self.args.max_memory)
+        if self.args.timing_report is not None or self.args.memory_profile:
+            instrumentation.enable(track_memory=self.args.memory_profile)
 
         # data_container instance of NightDataContainer defined in core
-        data_container = classify_spectroscopic_data(
-            path=self.args.source,
-            search_pattern=self.args.pattern)
+        data_container = None
+        if not self.args.ignore_manifest:
+            products = read_manifest(self.args.source)
+            if products is not None:
+                data_container = classify_manifest(
+                    path=self.args.source,
+                    products=products,
+                    search_pattern=self.args.pattern)
+                if data_container.is_empty:
+                    log.warning('No product in the manifest matches the '
+                                'search pattern, reading headers instead.')
+                    data_container = None
+                else:
+                    log.info('Using the groups of the redccd manifest')
+
+        if data_container is None:
+            data_container = classify_spectroscopic_data(
+                path=self.args.source,
+                search_pattern=self.args.pattern)
 
         # print('data_container.bias')
         # print(data_container.bias)
@@ -251,6 +395,11 @@ class MainApp(object):
             args=self.args,
             extraction_type=self.args.extraction_type)
 
+        if self.args.timing_report is not None:
+            instrumentation.write_report(self.args.timing_report)
+        elif self.args.memory_profile:
+            instrumentation.log_report()
+
 
 if __name__ == '__main__':
     MAIN_APP = MainApp()
@@ -0,0 +1,147 @@
+# -*- coding: utf8 -*-
+"""Pipeline for GOODMAN spectroscopic data, from raw frames to spectra.
+
+Runs the CCD reduction of redccd and the extraction and wavelength calibration
+of redspec in a single process. The calibrated 2D frames are handed to the
+extraction in memory, see goodman_ccd.product_store, so they are not written
+and read back. They are extracted in the groups made by the CCD reduction,
+see goodman_ccd.manifest. Use --save-intermediate to write them anyway.
+
+It can be used from python too:
+
+    from goodman_spec.reduce import MainApp, get_args
+
+    pipeline = MainApp(args=get_args(['--raw-path', '/data/night']))
+    pipeline()
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import argparse
+import logging
+import os
+import sys
+
+from goodman_ccd import goodman_ccd
+from goodman_ccd.memory_budget import parse_memory_size
+
+from . import redspec
+
+log = logging.getLogger('redspec.reduce')
+
+
+def get_args(arguments=None):
+    """Handles the argparse library and returns the arguments
+
+    The arguments are the ones of redccd and redspec, except for the location
+    of the reduced data and the output directory that are both <red_path>.
+
+    Args:
+        arguments (list): A list containing the arguments as elements.
+
+    Returns:
+        An argparse.Namespace instance with all the arguments.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Goodman Spectroscopic Reduction - CCD reduction, "
+                    "extraction and wavelength calibration in a single run.",
+        parents=[goodman_ccd.get_parser(),
+                 redspec.get_parser(paths=False)],
+        conflict_handler='resolve')
+
+    parser.add_argument('--max-memory',
+                        action='store',
+                        dest='max_memory',
+                        metavar='<size>',
+                        type=parse_memory_size,
+                        default=None,
+                        help="Memory budget, i.e. 4G or 512M. Limits the "
+                             "frames combined in memory, the calibrated "
+                             "frames kept in memory and the number of "
+                             "--plot-workers and --workers. Default is no "
+                             "limit.")
+
+    parser.add_argument('--save-intermediate',
+                        action='store_true',
+                        dest='save_intermediate',
+                        help="Write the calibrated 2D frames to <red_path> as "
+                             "redccd does. Otherwise they are only written "
+                             "when they do not fit in --max-memory, by dcr or "
+                             "for --workers.")
+
+    args = parser.parse_args(args=arguments)
+    args = goodman_ccd.check_args(parser=parser, args=args)
+    return redspec.check_args(parser=parser, args=args, paths=False)
+
+
+class MainApp(goodman_ccd.MainApp):
+    """Reduces raw spectroscopic data in a single run
+
+    Every night found by redccd is reduced and its calibrated frames are
+    extracted and wavelength calibrated right away.
+
+    """
+
+    def __init__(self, args=None):
+        """Init method for MainApp class
+
+        Args:
+            args (object): argparse.Namespace instance that contains all the
+                arguments, see `get_args`.
+        """
+        if args is None:
+            args = get_args()
+        super(MainApp, self).__init__(args=args)
+        self.wavelength_solution_obj = None
+
+    def process_night(self, data_container):
+        """Reduces a night and extracts its spectra
+
+        Args:
+            data_container (object): NightDataContainer instance with the
+                classified data of the night.
+
+        """
+        # imported here so that parsing arguments (e.g. --help) stays fast.
+        from goodman_ccd.image_processor import ImageProcessor
+        from goodman_ccd.manifest import classify_manifest
+        from goodman_ccd.product_store import ProductStore
+        from .wavelength import process_spectroscopy_data
+
+        products = ProductStore(path=self.args.red_path,
+                                save=self.args.save_intermediate)
+        process_images = ImageProcessor(self.args,
+                                        data_container,
+                                        products=products)
+        process_images()
+
+        if data_container.technique != 'Spectroscopy':
+            return
+        if len(process_images.manifest) == 0:
+            log.warning('There are no spectra to extract in '
+                        '{:s}'.format(self.args.red_path))
+            return
+
+        # spectra are written next to the calibrated frames
+        self.args.source = self.args.red_path
+        self.args.destiny = os.path.join(self.args.red_path, '')
+
+        spec_container = classify_manifest(
+            path=self.args.red_path,
+            products=process_images.manifest.products,
+            check_files=False)
+
+        self.wavelength_solution_obj = process_spectroscopy_data(
+            data_container=spec_container,
+            args=self.args,
+            extraction_type=self.args.extraction_type,
+            products=products)
+
+
+if __name__ == '__main__':
+    MAIN_APP = MainApp()
+    try:
+        MAIN_APP()
+    except KeyboardInterrupt:
+        sys.exit(0)
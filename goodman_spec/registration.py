@@ -0,0 +1,435 @@
+# -*- coding: utf8 -*-
+"""Registration of comparison lamps against reference lamps
+
+The automatic wavelength solution measures, for every line detected in a new
+comparison lamp, the shift between a window of the new lamp around the line
+and the same window of the reference lamp. Instead of smoothing and correlating
+every window on its own, the windows are gathered in a two dimensional batch,
+smoothed with a single call and correlated with a single batched FFT.
+
+The integer shifts are the same the original one window at a time
+correlation produced, optionally refined to sub-pixel precision by fitting a
+parabola to the correlation peak.
+
+Large offsets between the lamps, caused by flexure or by a different grating
+angle, leave many of those windows without the matching reference line. For
+that reason the registration is done coarse to fine: `global_registration`
+finds the shift, and optionally a stretch, of the whole lamp with a
+downsampled FFT cross correlation, then every line is refined by `line_shifts`
+in a narrow window of the reference placed at the predicted position.
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import re
+
+import numpy as np
+
+from astropy.convolution import Box1DKernel, Gaussian1DKernel
+from scipy.ndimage import convolve1d
+
+log = logging.getLogger('redspec.registration')
+
+# plate scale in arcseconds per unbinned pixel, used to convert the slit width
+PIXEL_SCALE = 0.15
+
+# slits wider than this (arcseconds) produce lines broader than the reference
+WIDE_SLIT = 3
+
+# standard deviation of the gaussian kernel used for narrow slits
+NARROW_SLIT_STDDEV = 2.
+
+# downsampling factor of the whole lamp registration
+DOWNSAMPLE_FACTOR = 4
+
+# global registrations with a lower normalized correlation are not trusted
+MIN_REGISTRATION_QUALITY = 0.3
+
+# maximum number of stretch values tried by the global registration
+MAX_STRETCH_STEPS = 101
+
+
+def correlation_size(length):
+    """Smallest power of two that holds the full correlation of two arrays
+
+    Args:
+        length (int): Length of the arrays.
+
+    Returns:
+        The FFT size.
+
+    """
+    return int(2 ** np.ceil(np.log2(max(2 * length - 1, 1))))
+
+
+def slit_width(slit):
+    """Slit width in arcseconds from the SLIT keyword
+
+    Args:
+        slit (str): Value of the SLIT keyword, e.g. '1.0" long slit'.
+
+    Returns:
+        The slit width as a float.
+
+    """
+    return float(re.sub('[A-Za-z" ]', '', str(slit)))
+
+
+def smoothing_kernels(slit):
+    """Kernels applied to the reference and new windows before correlating
+
+    Lines observed with wide slits are broader than the reference ones, in
+    that case only the reference is smoothed, with a box as wide as the slit.
+    Otherwise both are smoothed with the same gaussian kernel.
+
+    Args:
+        slit (str): Value of the SLIT keyword of the new lamp.
+
+    Returns:
+        A tuple with the kernel for the reference windows and the kernel for
+        the new windows, the latter is None when they are not smoothed.
+
+    """
+    width = slit_width(slit)
+    if width > WIDE_SLIT:
+        box_width = width / PIXEL_SCALE
+        log.debug('BOX WIDTH: {:f}'.format(box_width))
+        return Box1DKernel(width=box_width).array, None
+    kernel = Gaussian1DKernel(stddev=NARROW_SLIT_STDDEV).array
+    return kernel, kernel
+
+
+def get_windows(data, starts, stops):
+    """Gathers windows of an array in a zero padded 2D batch
+
+    Args:
+        data (array): One dimensional array.
+        starts (array): First pixel of every window.
+        stops (array): Pixel after the last one of every window, windows that
+            go beyond the end of `data` are truncated.
+
+    Returns:
+        A tuple with the 2D array of windows, one per row, and the actual
+        length of every window.
+
+    """
+    data = np.asarray(data, dtype=float)
+    starts = np.asarray(starts, dtype=int)
+    lengths = np.clip(np.minimum(stops, len(data)) - starts, 0, None)
+    width = int(lengths.max()) if len(lengths) else 0
+    columns = np.arange(width)
+    indexes = starts[:, np.newaxis] + columns
+    inside = columns < lengths[:, np.newaxis]
+    windows = np.where(inside, data[np.clip(indexes, 0, len(data) - 1)], 0.)
+    return windows, lengths
+
+
+def smooth_windows(windows, lengths, kernel):
+    """Smooths every window of a batch on its own
+
+    Equivalent to ``astropy.convolution.convolve`` of every window with the
+    default zero filled boundary, since the padding of the batch is already
+    zero.
+
+    Args:
+        windows (array): 2D batch of windows as returned by get_windows.
+        lengths (array): Length of every window.
+        kernel (array): Normalized kernel with an odd number of elements.
+
+    Returns:
+        The smoothed batch, padding is kept at zero.
+
+    """
+    smoothed = convolve1d(windows, kernel, axis=1, mode='constant', cval=0.)
+    smoothed[np.arange(windows.shape[1]) >= lengths[:, np.newaxis]] = 0.
+    return smoothed
+
+
+def batched_correlation(reference_windows, new_windows):
+    """Full cross correlation of every pair of rows using a single FFT
+
+    Args:
+        reference_windows (array): 2D batch of reference windows.
+        new_windows (array): 2D batch of new windows, same shape.
+
+    Returns:
+        A 2D array where row i is
+        ``scipy.signal.correlate(reference_windows[i], new_windows[i])``
+        for lags -(width - 1) to width - 1.
+
+    """
+    width = reference_windows.shape[1]
+    fft_size = correlation_size(width)
+    reference_fft = np.fft.rfft(reference_windows, fft_size, axis=1)
+    new_fft = np.fft.rfft(new_windows[:, ::-1], fft_size, axis=1)
+    correlation = np.fft.irfft(reference_fft * new_fft, fft_size, axis=1)
+    return correlation[:, :2 * width - 1]
+
+
+def parabolic_peak(values, index):
+    """Sub-pixel offset of a peak by fitting a parabola to three samples
+
+    Args:
+        values (array): 2D array, one curve per row.
+        index (array): Index of the maximum of every row.
+
+    Returns:
+        Offset of the vertex from `index`, between -0.5 and 0.5. It is zero
+        for peaks at the edges, next to non finite values or with flat
+        tops.
+
+    """
+    rows = np.arange(values.shape[0])
+    inner = (index > 0) & (index < values.shape[1] - 1)
+    center = np.clip(index, 1, values.shape[1] - 2)
+    left = values[rows, center - 1]
+    middle = values[rows, center]
+    right = values[rows, center + 1]
+    valid = inner & np.isfinite(left) & np.isfinite(right)
+    denominator = np.where(valid, left - 2 * middle + right, 0.)
+    valid &= denominator < 0
+    offset = np.zeros(len(index))
+    offset[valid] = 0.5 * (left[valid] - right[valid]) / denominator[valid]
+    return np.clip(offset, -0.5, 0.5)
+
+
+def line_shifts(reference_flux, lamp_flux, starts, stops, slit,
+                subpixel=True, reference_starts=None):
+    """Shift between the reference and a new lamp in windows around lines
+
+    A positive shift means the feature is found at a larger pixel value in the
+    reference than in the new lamp. For windows of the same length in both
+    lamps the integer part of the shift is the lag of the correlation maximum,
+    windows of different length, at the red end of the lamps, keep the
+    original scaling of the lag axis.
+
+    Args:
+        reference_flux (array): Reference lamp flux.
+        lamp_flux (array): New lamp flux.
+        starts (array): First pixel of every window.
+        stops (array): Pixel after the last one of every window.
+        slit (str): Value of the SLIT keyword of the new lamp.
+        subpixel (bool): Refine the shifts with a parabola fitted to the
+            correlation peak.
+        reference_starts (array): First pixel of every window in the
+            reference lamp, by default the same as `starts`. The returned
+            shifts are relative to these windows, windows must lie within the
+            reference lamp.
+
+    Returns:
+        An array with the shift of every window in pixels.
+
+    """
+    starts = np.asarray(starts, dtype=int)
+    stops = np.asarray(stops, dtype=int)
+    if len(starts) == 0:
+        return np.array([])
+
+    reference_kernel, new_kernel = smoothing_kernels(slit)
+
+    if reference_starts is None:
+        reference_starts = starts
+    reference_starts = np.asarray(reference_starts, dtype=int)
+
+    reference_windows, reference_lengths = get_windows(
+        reference_flux,
+        reference_starts,
+        reference_starts + (stops - starts))
+    new_windows, new_lengths = get_windows(lamp_flux, starts, stops)
+
+    width = max(reference_windows.shape[1], new_windows.shape[1])
+    reference_windows = np.pad(
+        reference_windows, ((0, 0), (0, width - reference_windows.shape[1])),
+        mode='constant')
+    new_windows = np.pad(
+        new_windows, ((0, 0), (0, width - new_windows.shape[1])),
+        mode='constant')
+
+    reference_windows = smooth_windows(reference_windows,
+                                       reference_lengths,
+                                       reference_kernel)
+    if new_kernel is not None:
+        new_windows = smooth_windows(new_windows, new_lengths, new_kernel)
+
+    correlation = batched_correlation(reference_windows, new_windows)
+
+    # lags that do not overlap in the unpadded windows are excluded
+    lags = np.arange(-(width - 1), width)
+    overlap = (lags >= -(new_lengths[:, np.newaxis] - 1)) & \
+              (lags <= reference_lengths[:, np.newaxis] - 1)
+    correlation = np.where(overlap, correlation, -np.inf)
+    max_index = np.argmax(correlation, axis=1)
+
+    # the lag axis of the original implementation is
+    # np.linspace(-int(n / 2), int(n / 2), n) for n = len(correlation)
+    n_lags = reference_lengths + new_lengths - 1
+    half = n_lags // 2
+    index = max_index - (width - new_lengths)
+    step = np.where(n_lags > 1, 2. * half / np.maximum(n_lags - 1, 1), 0.)
+    shifts = -half + index * step
+
+    if subpixel:
+        shifts = shifts + step * parabolic_peak(correlation, max_index)
+    return shifts
+
+
+def downsample(flux, factor):
+    """Averages blocks of `factor` pixels, the remainder is discarded
+
+    Args:
+        flux (array): One or two dimensional array, the last axis is
+            downsampled.
+        factor (int): Number of pixels per block.
+
+    Returns:
+        The downsampled array.
+
+    """
+    flux = np.asarray(flux, dtype=float)
+    length = flux.shape[-1] // factor * factor
+    blocks = flux[..., :length].reshape(flux.shape[:-1] + (-1, factor))
+    return blocks.mean(axis=-1)
+
+
+def registration_flux(flux, factor=DOWNSAMPLE_FACTOR):
+    """Downsampled flux with zero mean and unit norm
+
+    It is what `global_registration` correlates, the last axis is processed.
+
+    Args:
+        flux (array): One or two dimensional array.
+        factor (int): Downsampling factor.
+
+    Returns:
+        The normalized downsampled array.
+
+    """
+    flux = downsample(flux, factor)
+    flux = flux - flux.mean(axis=-1)[..., np.newaxis]
+    norm = np.sqrt((flux ** 2).sum(axis=-1))[..., np.newaxis]
+    return flux / np.where(norm > 0, norm, 1.)
+
+
+def stretch_values(max_stretch, length, factor=DOWNSAMPLE_FACTOR):
+    """Stretch values tried by the global registration
+
+    The step is such that consecutive values move the ends of the lamp by
+    about one downsampled pixel.
+
+    Args:
+        max_stretch (float): Largest relative stretch, i.e. 0.01 for 1%.
+        length (int): Length of the lamp.
+        factor (int): Downsampling factor.
+
+    Returns:
+        An array of stretch values, symmetric around zero.
+
+    """
+    if max_stretch <= 0:
+        return np.array([0.])
+    n_steps = int(np.ceil(max_stretch * length / factor))
+    n_steps = min(2 * n_steps + 1, MAX_STRETCH_STEPS)
+    return np.linspace(-max_stretch, max_stretch, n_steps)
+
+
+def global_registration(reference_flux, lamp_flux, max_stretch=0.,
+                        factor=DOWNSAMPLE_FACTOR, reference=None):
+    """Finds the shift and stretch of a whole lamp against its reference
+
+    The relation between pixels is
+    ``reference = center + (lamp - center) * (1 + stretch) + shift``, where
+    center is the central pixel of the lamp. For every stretch value the lamp
+    is resampled, both lamps are downsampled and normalized and the shift is
+    the peak of their FFT cross correlation refined with a parabola.
+
+    Args:
+        reference_flux (array): Reference lamp flux.
+        lamp_flux (array): New lamp flux.
+        max_stretch (float): Largest relative stretch to try, zero only
+            searches for a shift.
+        factor (int): Downsampling factor.
+        reference (array): `registration_flux` of `reference_flux` with the
+            same factor, i.e. `LampTemplate.registration_flux`. Computed if
+            None.
+
+    Returns:
+        A tuple with the shift in pixels, the stretch and the quality of the
+        registration, the peak of the normalized correlation, between -1 and
+        1.
+
+    """
+    lamp_flux = np.asarray(lamp_flux, dtype=float)
+    center = (len(lamp_flux) - 1) / 2.
+    pixels = np.arange(len(lamp_flux))
+    stretches = stretch_values(max_stretch, len(lamp_flux), factor)
+
+    # lamp resampled as it would look with each stretch, around its center
+    resampled = np.array([np.interp(center + (pixels - center) / (1 + value),
+                                    pixels, lamp_flux, left=0., right=0.)
+                          for value in stretches])
+
+    if reference is None:
+        reference = registration_flux(reference_flux, factor)
+    lamps = registration_flux(resampled, factor)
+
+    fft_size = correlation_size(max(len(reference), lamps.shape[1]))
+    correlation = np.fft.irfft(
+        np.fft.rfft(reference, fft_size) *
+        np.fft.rfft(lamps[:, ::-1], fft_size, axis=1),
+        fft_size,
+        axis=1)[:, :len(reference) + lamps.shape[1] - 1]
+
+    best_stretch, max_index = np.unravel_index(np.argmax(correlation),
+                                               correlation.shape)
+    quality = correlation[best_stretch, max_index]
+    offset = parabolic_peak(correlation[[best_stretch]],
+                            np.array([max_index]))[0]
+
+    # lag in downsampled pixels, then in pixels of the lamp
+    lag = max_index - (lamps.shape[1] - 1) + offset
+    shift = lag * factor
+    log.debug('Global registration: shift {:.2f} stretch {:.5f} '
+              'quality {:.3f}'.format(shift,
+                                      stretches[best_stretch],
+                                      quality))
+    return shift, stretches[best_stretch], quality
+
+
+def reference_position(pixels, shift, stretch, length):
+    """Predicted position in the reference lamp of pixels of a new lamp
+
+    Args:
+        pixels (array): Pixel positions in the new lamp.
+        shift (float): Shift returned by global_registration.
+        stretch (float): Stretch returned by global_registration.
+        length (int): Length of the new lamp.
+
+    Returns:
+        The positions in the reference lamp.
+
+    """
+    center = (length - 1) / 2.
+    return center + (np.asarray(pixels) - center) * (1 + stretch) + shift
+
+
+def refinement_half_width(half_width, slit, factor=DOWNSAMPLE_FACTOR):
+    """Half width of the windows used to refine the lines after registration
+
+    It must cover the uncertainty of the global registration and the width
+    of the smoothing kernel, but not more, neighbouring lines in the window
+    are what produce wrong matches.
+
+    Args:
+        half_width (int): Half width used without global registration.
+        slit (str): Value of the SLIT keyword of the new lamp.
+        factor (int): Downsampling factor of the global registration.
+
+    Returns:
+        The half width in pixels, never larger than `half_width`.
+
+    """
+    reference_kernel, _ = smoothing_kernels(slit)
+    return int(min(half_width, 2 * factor + len(reference_kernel) // 2))
@@ -0,0 +1,514 @@
+# -*- coding: utf8 -*-
+"""Reduction daemon and its client
+
+Starting the pipeline costs several seconds of imports, loading the reference
+lamps and computing twilight times, which is more than reducing a single
+frame. ``goodman-served`` pays that once and then runs the jobs sent by
+``goodman-submit`` over a Unix domain socket. The jobs are the command line
+programs, with the same arguments::
+
+    goodman-served &
+    goodman-submit redccd --raw-path /data/night
+    goodman-submit redspec --data-path /data/RED --proc-path /data/RED/
+    goodman-submit goodman-reduce --raw-path /data/night --cosmic none
+
+Jobs run one at a time in the working directory of the client. Their log and
+their output, i.e. the one of --help, are sent back to it. Plots are never
+shown on screen, --no-pause is always set, and the interactive wavelength
+solution is not available.
+
+The protocol is one JSON object per line. The client sends the job, its
+arguments and its working directory. The server answers with one line per
+log message or piece of standard output and error, and a last line with the
+status of the job.
+
+Whoever can connect to the socket runs the pipeline as the user of the
+server, so only that user can. The default socket is in $XDG_RUNTIME_DIR, or
+in a directory of the temporary directory that only the user can access, the
+socket itself is readable and writable only by the user and the client does
+not connect to a socket owned by somebody else.
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import argparse
+import importlib
+import json
+import logging
+import os
+import socket
+import stat
+import sys
+import tempfile
+import time
+
+FORMAT = '%(levelname)s: %(asctime)s:%(module)s.%(funcName)s: %(message)s'
+DATE_FORMAT = '%I:%M:%S%p'
+logging.basicConfig(level=logging.INFO, format=FORMAT, datefmt=DATE_FORMAT)
+log = logging.getLogger('redspec.served')
+
+# module of every job, it must define get_args and MainApp
+JOBS = {'redccd': 'goodman_ccd.goodman_ccd',
+        'redspec': 'goodman_spec.redspec',
+        'goodman-reduce': 'goodman_spec.reduce'}
+
+# jobs handled by the server itself
+CONTROL_JOBS = ['ping', 'shutdown']
+
+# loggers of the pipeline, their level and handlers are restored after a job
+PIPELINE_LOGGERS = ['goodmanccd', 'redspec']
+
+# modules imported when the server starts
+WARM_MODULES = ['goodman_ccd.data_classifier',
+                'goodman_ccd.night_organizer',
+                'goodman_ccd.image_processor',
+                'goodman_ccd.manifest',
+                'goodman_spec.wavelength',
+                'matplotlib.pyplot']
+
+
+def private_directory():
+    """Directory of the default socket when there is no $XDG_RUNTIME_DIR"""
+    return os.path.join(tempfile.gettempdir(),
+                        'goodman-served-{:d}'.format(os.getuid()))
+
+
+def default_socket_path():
+    """Socket used when none is given, one per user"""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'goodman-served.sock')
+    return os.path.join(private_directory(), 'goodman-served.sock')
+
+
+def is_private(path):
+    """Whether `path` belongs to the current user and nobody else can use it"""
+    status = os.lstat(path)
+    return status.st_uid == os.getuid() and \
+        not status.st_mode & (stat.S_IRWXG | stat.S_IRWXO)
+
+
+def check_owner(socket_path):
+    """Raises OSError if the socket does not belong to the current user"""
+    if os.lstat(socket_path).st_uid != os.getuid():
+        raise OSError('{:s} is not owned by the current user'.format(
+            socket_path))
+
+
+def send_message(stream, message):
+    """Writes a message as a line of JSON and flushes it"""
+    stream.write((json.dumps(message) + '\n').encode('utf-8'))
+    stream.flush()
+
+
+def read_message(stream):
+    """Reads a line of JSON, returns None at the end of the stream"""
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+class ClientLogHandler(logging.Handler):
+    """Sends the log records of a job to the client"""
+
+    def __init__(self, stream):
+        super(ClientLogHandler, self).__init__()
+        self.stream = stream
+        self.setFormatter(logging.Formatter(fmt=FORMAT, datefmt=DATE_FORMAT))
+
+    def emit(self, record):
+        try:
+            send_message(self.stream, {'log': self.format(record)})
+        except (IOError, OSError):
+            # the client went away, the job goes on
+            pass
+
+
+class ClientOutput(object):
+    """File object that sends what is written to it to the client
+
+    It replaces sys.stdout or sys.stderr while a job runs.
+
+    Args:
+        stream (object): File object of the connection.
+        name (str): 'stdout' or 'stderr', the key of the messages.
+
+    """
+
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+
+    def write(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        if not text:
+            return
+        try:
+            send_message(self.stream, {self.name: text})
+        except (IOError, OSError):
+            # the client went away, the job goes on
+            pass
+
+    def flush(self):
+        pass
+
+    @staticmethod
+    def isatty():
+        return False
+
+
+def get_args(arguments=None):
+    """Handles the argparse library and returns the arguments of the server
+
+    Args:
+        arguments (list): A list containing the arguments as elements.
+
+    Returns:
+        An argparse.Namespace instance.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Goodman reduction daemon. Keeps the pipeline loaded and "
+                    "runs the jobs sent by goodman-submit.")
+
+    parser.add_argument('--socket',
+                        action='store',
+                        dest='socket_path',
+                        metavar='<socket>',
+                        default=default_socket_path(),
+                        help="Unix domain socket to listen on. Default "
+                             "{:s}".format(default_socket_path()))
+
+    parser.add_argument('--reference-files',
+                        action='store',
+                        default='refdata/',
+                        metavar='<Reference Dir>',
+                        dest='reference_dir',
+                        help="Directory of Reference files location, loaded "
+                             "at start up.")
+
+    return parser.parse_args(args=arguments)
+
+
+def get_client_args(arguments=None):
+    """Handles the argparse library and returns the arguments of the client
+
+    Args:
+        arguments (list): A list containing the arguments as elements.
+
+    Returns:
+        An argparse.Namespace instance.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Sends a job to goodman-served and shows its log. The "
+                    "job arguments are the ones of the program, see "
+                    "'<job> --help'.")
+
+    parser.add_argument('--socket',
+                        action='store',
+                        dest='socket_path',
+                        metavar='<socket>',
+                        default=default_socket_path(),
+                        help="Unix domain socket of the server. Default "
+                             "{:s}".format(default_socket_path()))
+
+    parser.add_argument('job',
+                        choices=sorted(JOBS) + CONTROL_JOBS,
+                        help="Program to run, or 'ping' and 'shutdown' to "
+                             "control the server.")
+
+    parser.add_argument('arguments',
+                        nargs=argparse.REMAINDER,
+                        help="Arguments of the job.")
+
+    return parser.parse_args(args=arguments)
+
+
+class ReductionServer(object):
+    """Runs reduction jobs in a long lived process
+
+    Args:
+        args (object): argparse.Namespace instance, see `get_args`.
+
+    """
+
+    def __init__(self, args=None):
+        if args is None:
+            self.args = get_args()
+        else:
+            self.args = args
+        self.running = False
+
+    def __call__(self):
+        """Warms up the pipeline and serves jobs until asked to shut down"""
+        socket_path = self.args.socket_path
+        directory = os.path.dirname(os.path.abspath(socket_path))
+        if directory == private_directory():
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            if not is_private(directory):
+                sys.exit('{:s} must belong to the current user and be '
+                         'accessible only by it'.format(directory))
+        if os.path.lexists(socket_path):
+            try:
+                check_owner(socket_path)
+            except OSError as error:
+                sys.exit('{!s}'.format(error))
+            if self.is_alive(socket_path):
+                sys.exit('goodman-served is already running on '
+                         '{:s}'.format(socket_path))
+            os.unlink(socket_path)
+
+        self.warm_up()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # nobody else can connect, the socket is created private
+            previous_umask = os.umask(0o077)
+            try:
+                server.bind(socket_path)
+            finally:
+                os.umask(previous_umask)
+            os.chmod(socket_path, stat.S_IRUSR | stat.S_IWUSR)
+            server.listen(1)
+            log.info('Listening on {:s}'.format(socket_path))
+            self.running = True
+            while self.running:
+                connection, _ = server.accept()
+                try:
+                    self.handle(connection)
+                finally:
+                    connection.close()
+        except KeyboardInterrupt:
+            log.info('Interrupted')
+        finally:
+            server.close()
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+
+    def warm_up(self):
+        """Imports the pipeline and loads the reference data"""
+        start = time.time()
+        for module in WARM_MODULES:
+            importlib.import_module(module)
+
+        from goodman_spec.linelist import get_reference_data
+        reference_dir = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            self.args.reference_dir)
+        if os.path.isdir(reference_dir):
+            get_reference_data(reference_dir)
+        log.info('Pipeline loaded in {:.1f}s'.format(time.time() - start))
+
+    @staticmethod
+    def is_alive(socket_path):
+        """Whether a server answers on `socket_path`"""
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(socket_path)
+            return True
+        except (IOError, OSError):
+            return False
+        finally:
+            client.close()
+
+    def handle(self, connection):
+        """Reads a request from a client and answers it
+
+        Args:
+            connection (object): Connected socket.socket instance.
+
+        """
+        stream = connection.makefile('rwb')
+        try:
+            try:
+                request = read_message(stream)
+            except ValueError:
+                request = {}
+            if request is None:
+                # connected and closed, i.e. `is_alive`
+                return
+            if 'job' not in request:
+                send_message(stream, {'status': 'failed',
+                                      'message': 'Invalid request'})
+                return
+
+            job = request['job']
+            if job == 'ping':
+                send_message(stream, {'status': 'done',
+                                      'message': 'pid {:d}'.format(
+                                          os.getpid())})
+            elif job == 'shutdown':
+                self.running = False
+                send_message(stream, {'status': 'done',
+                                      'message': 'Shutting down'})
+            elif job in JOBS:
+                status, message, elapsed = self.run_job(
+                    job=job,
+                    arguments=request.get('arguments', []),
+                    cwd=request.get('cwd', os.getcwd()),
+                    stream=stream)
+                send_message(stream, {'status': status,
+                                      'message': message,
+                                      'seconds': elapsed})
+            else:
+                send_message(stream, {'status': 'failed',
+                                      'message': 'Unknown job '
+                                                 '{:s}'.format(job)})
+        except (IOError, OSError) as error:
+            log.warning('Lost connection with the client: '
+                        '{:s}'.format(str(error)))
+        finally:
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+
+    def run_job(self, job, arguments, cwd, stream):
+        """Runs a job in the working directory of the client
+
+        The standard output and error of the job, i.e. the help and usage
+        errors of argparse, go to the client. The state the programs leave
+        behind is undone afterwards: the working directory, the level and
+        handlers of the pipeline loggers and the instrumentation.
+
+        Args:
+            job (str): Name of the program, see JOBS.
+            arguments (list): Command line arguments of the program.
+            cwd (str): Working directory of the client.
+            stream (object): File object of the connection, receives the log
+                and the output.
+
+        Returns:
+            A tuple with the status, 'done' or 'failed', a message and the
+            elapsed time in seconds.
+
+        """
+        from goodman_ccd.instrumentation import instrumentation
+
+        log.info('Running {:s} {:s}'.format(job, ' '.join(arguments)))
+        start = time.time()
+        previous_cwd = os.getcwd()
+        loggers = [logging.getLogger(name) for name in PIPELINE_LOGGERS]
+        saved_state = [(logger.level, list(logger.handlers))
+                       for logger in loggers]
+        client_handler = ClientLogHandler(stream)
+        root_logger = logging.getLogger()
+        root_logger.addHandler(client_handler)
+        previous_output = sys.stdout, sys.stderr
+        previous_argv = sys.argv
+
+        status, message = 'done', ''
+        try:
+            sys.stdout = ClientOutput(stream, 'stdout')
+            sys.stderr = ClientOutput(stream, 'stderr')
+            # argparse takes the program name of the usage from it
+            sys.argv = [job] + list(arguments)
+            os.chdir(cwd)
+            program = importlib.import_module(JOBS[job])
+            args = program.get_args(arguments)
+            if getattr(args, 'interactive_ws', False):
+                raise ValueError('--interactive is not available in '
+                                 'goodman-served')
+            if hasattr(args, 'no_pause'):
+                args.no_pause = True
+            program.MainApp(args=args)()
+        except SystemExit as error:
+            if error.code not in (None, 0):
+                status, message = 'failed', '{!s}'.format(error.code)
+        except Exception as error:
+            log.exception('Job {:s} failed'.format(job))
+            status, message = 'failed', '{!s}'.format(error)
+        finally:
+            sys.stdout, sys.stderr = previous_output
+            sys.argv = previous_argv
+            root_logger.removeHandler(client_handler)
+            for logger, (level, handlers) in zip(loggers, saved_state):
+                for handler in logger.handlers:
+                    if handler not in handlers:
+                        logger.removeHandler(handler)
+                        handler.close()
+                logger.setLevel(level)
+            instrumentation.disable()
+            os.chdir(previous_cwd)
+
+        elapsed = time.time() - start
+        log.info('{:s} {:s} in {:.1f}s'.format(job, status, elapsed))
+        return status, message, elapsed
+
+
+def submit(job, arguments=None, socket_path=None, output=None):
+    """Sends a job to goodman-served and waits for it to finish
+
+    Args:
+        job (str): Name of the program, see JOBS, or 'ping' or 'shutdown'.
+        arguments (list): Command line arguments of the program.
+        socket_path (str): Socket of the server, the default one if None.
+        output (object): File object where the log and the standard error of
+            the job are written, sys.stderr if None. Its standard output goes
+            to sys.stdout.
+
+    Returns:
+        The last message of the server, a dictionary with `status` and
+        `message`.
+
+    Raises:
+        OSError: If the socket does not belong to the current user or the
+            server can not be reached.
+
+    """
+    if socket_path is None:
+        socket_path = default_socket_path()
+    if output is None:
+        output = sys.stderr
+
+    check_owner(socket_path)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    stream = client.makefile('rwb')
+    try:
+        send_message(stream, {'job': job,
+                              'arguments': arguments or [],
+                              'cwd': os.getcwd()})
+        while True:
+            message = read_message(stream)
+            if message is None:
+                return {'status': 'failed',
+                        'message': 'The server closed the connection'}
+            if 'log' in message:
+                output.write(message['log'] + '\n')
+                output.flush()
+            elif 'stderr' in message:
+                output.write(message['stderr'])
+                output.flush()
+            elif 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+                sys.stdout.flush()
+            else:
+                return message
+    finally:
+        stream.close()
+        client.close()
+
+
+def main_client(arguments=None):
+    """Entry point of goodman-submit, exits with 1 if the job failed"""
+    args = get_client_args(arguments)
+    try:
+        result = submit(job=args.job,
+                        arguments=args.arguments,
+                        socket_path=args.socket_path)
+    except (IOError, OSError) as error:
+        sys.exit('Unable to reach goodman-served on {:s}: {!s}'.format(
+            args.socket_path, error))
+    if result.get('message'):
+        print(result['message'])
+    if result.get('status') != 'done':
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    ReductionServer()()
@@ -1,132 +1,659 @@
-from astropy.io import fits
-from astropy.modeling import models, fitting
+# -*- coding: utf8 -*-
+"""Synthetic Goodman HTS observing nights
+
+Generates a complete raw spectroscopic night, BIAS, FLAT, COMP and OBJECT
+frames with Goodman-like headers for the Red or Blue camera, any binning, the
+Spectroscopic or a Custom region of interest and the instrument configurations
+of the reference lamps shipped in ``goodman_spec/refdata``. Using those
+configurations means the comparison lamps of a synthetic night can actually be
+wavelength calibrated by redspec.
+
+The frames are built with array operations only, an unbinned frame takes well
+under a second, so nights of any size can be generated to benchmark the
+pipelines in a reproducible way::
+
+    from goodman_spec.simulator import NightSimulator
+
+    simulator = NightSimulator(path='/tmp/night/raw', camera='Red', seed=1)
+    file_list = simulator()
+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import datetime
+import glob
+import logging
+import os
+import re
+
 import numpy as np
-import matplotlib.pyplot as plt
-import cPickle as pickle
 
+from astropy.io import fits
+
+log = logging.getLogger('redspec.simulator')
+
+REFERENCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'refdata')
+
+# unbinned size of the spectroscopic region of interest, columns include the
+# prescan/overscan.
+ROI_WIDTH = 4142
+ROI_HEIGHT = 1896
+
+# Custom regions of interest are a band of rows of the spectroscopic one, with
+# the same columns, so their trim and overscan sections are the same.
+MIN_ROI_ROWS = 100
+
+# first and last illuminated columns (1-based) of the unbinned detector, the
+# trim section of redccd for spectroscopy
+DATA_COLUMNS = (51, 4110)
+
+# fraction of the rows illuminated by the slit
+SLIT_EXTENT = (0.06, 0.94)
+
+SATURATION = 65535
+
+CAMERAS = {'Red': {'gain': 1.45,
+                   'rdnoise': 5.27,
+                   'bias_level': 1005.,
+                   'camera': 'Si 1110-111'},
+           'Blue': {'gain': 1.4,
+                    'rdnoise': 4.74,
+                    'bias_level': 560.,
+                    'camera': 'Si 1110-111'}}
+
+# SOAR telescope pointing for dome flats
+DOME_FLAT_RA = '04:30:00.000'
+DOME_FLAT_DEC = '-30:14:16.000'
+
+# exposure times in seconds
+BIAS_EXPTIME = 0.
+FLAT_EXPTIME = 5.
+COMP_EXPTIME = 1.
+OBJECT_EXPTIME = 300.
+
+# cosmic ray hits per unbinned pixel per second
+COSMIC_RAY_RATE = 2e-6
+
+
+def get_reference_configurations(camera=None):
+    """Instrument configurations for which a reference lamp exists
 
-class DataSimulator(object):
+    Args:
+        camera (str): 'Red' or 'Blue', reference lamps taken with the other
+            camera are excluded. Lamps without the INSTCONF keyword are valid
+            for both. None returns all of them.
 
-    def __init__(self, data_dimensions=1, x_size=None, y_size=None):
-        self.dimensions = data_dimensions
-        if self.dimensions == 1:
-            self.x_length = x_size
-            self.y_length = y_size
-        elif self.dimensions == 2 and (x_size is not None and y_size is not None):
-            self.x_length = x_size
-            self.y_length = y_size
+    Returns:
+        A list of dictionaries with the keys grating, cam_targ, grt_targ,
+        filter2, wavmode, slit, lamp and file. Configurations are unique, only
+        the first lamp is kept when several share the same configuration.
+
+    """
+    configurations = []
+    seen = set()
+    for lamp_file in sorted(glob.glob(os.path.join(REFERENCE_DIR, '*.fits'))):
+        header = fits.getheader(lamp_file)
+        instconf = header.get('INSTCONF', None)
+        if camera is not None and instconf not in (None, camera):
+            continue
+        key = (header['GRATING'],
+               float(header['CAM_TARG']),
+               float(header['GRT_TARG']),
+               header['FILTER2'])
+        if key in seen:
+            continue
+        seen.add(key)
+        grating = re.sub('[A-Za-z_-]', '', header['GRATING'])
+        wavmode = header.get('WAVMODE', None)
+        if wavmode is None:
+            mode = re.sub('goodman_comp_[^_]*_', '',
+                          os.path.basename(lamp_file)).split('_')[0]
+            wavmode = '{:s} {:s}'.format(grating, mode.lower())
+        configurations.append({'grating': header['GRATING'],
+                               'cam_targ': float(header['CAM_TARG']),
+                               'grt_targ': float(header['GRT_TARG']),
+                               'filter2': header['FILTER2'],
+                               'wavmode': wavmode,
+                               'slit': header['SLIT'],
+                               'lamp': header['OBJECT'].strip(),
+                               'file': lamp_file})
+    return configurations
+
+
+def bin_spectrum(spectrum, binning):
+    """Adds consecutive pixels of a spectrum
+
+    Args:
+        spectrum (array): One dimensional spectrum.
+        binning (int): Number of pixels added together, incomplete bins at the
+            end are discarded.
+
+    Returns:
+        The binned spectrum.
+
+    """
+    n_bins = len(spectrum) // binning
+    return spectrum[:n_bins * binning].reshape(n_bins, binning).sum(axis=1)
+
+
+class NightSimulator(object):
+    """Writes a synthetic raw spectroscopic night
+
+    The night follows the usual sequence, bias and dome flats in the afternoon
+    and for every instrument configuration a target observed with comparison
+    lamps taken at the same pointing.
+
+    Bias level, read noise and gain follow the camera. Illuminated frames
+    include photon noise, a fixed pixel response pattern and a slit
+    illumination profile, science frames have a curved trace per target on top
+    of the sky and cosmic ray hits.
+
+    Args:
+        path (str): Directory where the raw files are written, it is created
+            if necessary.
+        camera (str): 'Red' or 'Blue'.
+        binning (tuple): Serial (dispersion) and parallel (spatial) binning.
+        n_bias (int): Number of bias frames.
+        n_flats (int): Number of dome flats per configuration.
+        n_comps (int): Number of comparison lamps per configuration.
+        n_objects (int): Number of science frames per configuration.
+        n_targets (int): Number of spectra along the slit of science frames.
+        roi_rows (tuple): First and last unbinned rows (1-based) of the
+            spectroscopic region of interest that are read, a Custom ROI.
+            None reads the whole Spectroscopic ROI.
+        n_configurations (int): Number of instrument configurations observed,
+            at most the number of reference lamps available for the camera.
+        night (str): Local date at the beginning of the night, YYYY-MM-DD.
+        seed (int): Seed of the random number generator, makes the night
+            reproducible.
+
+    """
+
+    def __init__(self, path, camera='Red', binning=(1, 1), n_bias=5,
+                 n_flats=5, n_comps=1, n_objects=2, n_targets=1,
+                 roi_rows=None, n_configurations=1, night='2016-11-14',
+                 seed=None):
+        if camera not in CAMERAS:
+            raise ValueError('Unknown camera: {:s}'.format(str(camera)))
+        if roi_rows is None:
+            self.roi = 'Spectroscopic'
+            self.first_row, self.last_row = 1, ROI_HEIGHT
         else:
-            raise NotImplementedError
+            self.roi = 'Custom'
+            self.first_row, self.last_row = [int(row) for row in roi_rows]
+            if self.first_row < 1 or self.last_row > ROI_HEIGHT or \
+                    self.last_row - self.first_row + 1 < MIN_ROI_ROWS:
+                raise ValueError('Invalid ROI rows {:d}:{:d}, they must be '
+                                 'at least {:d} between 1 and {:d}'.format(
+                                     self.first_row, self.last_row,
+                                     MIN_ROI_ROWS, ROI_HEIGHT))
+        self.path = path
+        self.camera = camera
+        self.serial_binning, self.parallel_binning = [int(b) for b in binning]
+        self.n_bias = n_bias
+        self.n_flats = n_flats
+        self.n_comps = n_comps
+        self.n_objects = n_objects
+        self.n_targets = n_targets
+        self.night = night
+        self.random = np.random.RandomState(seed)
+
+        configurations = get_reference_configurations(camera=camera)
+        if n_configurations > len(configurations):
+            log.warning('Only {:d} configurations available for the {:s} '
+                        'camera'.format(len(configurations), camera))
+        self.configurations = configurations[:n_configurations]
+
+        self.gain = CAMERAS[camera]['gain']
+        self.rdnoise = CAMERAS[camera]['rdnoise']
+        self.bias_level = CAMERAS[camera]['bias_level']
+
+        self.shape = ((self.last_row - self.first_row + 1) //
+                      self.parallel_binning,
+                      ROI_WIDTH // self.serial_binning)
+        # binned columns that contain any illuminated one
+        self.data_start = (DATA_COLUMNS[0] - 1) // self.serial_binning
+        self.data_end = int(DATA_COLUMNS[1] / self.serial_binning)
+        self.n_columns = self.data_end - self.data_start
+
+        # fixed detector patterns, shared by all the frames of the night
+        self.bias_pattern = self.bias_level + self.random.normal(
+            0, 2., self.shape[1])[np.newaxis, :]
+        self.pixel_response = 1 + self.random.normal(
+            0, 0.01, (self.shape[0], self.n_columns))
+        self.slit_profile = self._slit_profile()
+
+        self.file_number = 0
+        self.time = datetime.datetime.strptime(night, '%Y-%m-%d')
 
-    def __call__(self, *args, **kwargs):
-        if self.dimensions == 1:
-            if self.x_length is None and self.y_length is not None:
-                print('object detection')
-                zero_array = np.zeros(self.y_length)
-            elif self.y_length is None:
-                pass
+    def __call__(self):
+        """Writes all the frames of the night
 
+        Returns:
+            The list of file names written, without path.
 
-def intensity(axis):
-    return np.exp(axis/100.) *(3 * axis ** 2 + 5 * axis + 20000) + axis ** 3 + 1000 * np.sin(axis)
-    # return 20000  * abs(np.sin(axis) +np.exp(axis) *np.sin(axis + 0.75 * np.pi)) +
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        start = datetime.datetime.strptime(self.night, '%Y-%m-%d')
+        file_list = []
 
+        # afternoon calibrations, well before sunset at Cerro Pachon.
+        self.time = start + datetime.timedelta(hours=19)
+        for _ in range(self.n_bias):
+            file_list.append(self.write_frame(
+                data=self.bias_frame(),
+                header=self.make_header(obstype='BIAS',
+                                        object_name='Bias',
+                                        exptime=BIAS_EXPTIME),
+                suffix='bias'))
 
-def make_2d_spectra(separation_fwhm=0, n_targets=1, fwhm=8., intens=0., noise_level=1., plots=False):
-    x = 4056
-    y = 1550
+        for configuration in self.configurations:
+            for _ in range(self.n_flats):
+                file_list.append(self.write_frame(
+                    data=self.flat_frame(),
+                    header=self.make_header(obstype='FLAT',
+                                            object_name='Flat',
+                                            exptime=FLAT_EXPTIME,
+                                            configuration=configuration,
+                                            ra=DOME_FLAT_RA,
+                                            dec=DOME_FLAT_DEC),
+                    suffix='flat',
+                    configuration=configuration))
 
-    header_copy = fits.getheader('/data/simon/data/soar/work/20161114_eng/reduced_data/fzh.0298_CVSO166_400m2_gg455.fits')
-    header_copy['OBJECT'] = 'Test-%s'%str(separation_fwhm)
-    header_copy['HISTORY'] = 'Simulated spectrum N-sources %s separation_fwhm %s FWHM %s' % (n_targets, separation_fwhm, fwhm)
+        # science, every configuration observes a different target
+        self.time = start + datetime.timedelta(days=1, hours=1)
+        for index, configuration in enumerate(self.configurations):
+            ra = '{:02d}:{:02d}:00.000'.format(index + 1,
+                                               (index * 17) % 60)
+            dec = '-{:02d}:30:00.000'.format(20 + index * 5)
+            target_name = 'SYNTH-{:02d}'.format(index + 1)
+            lamp_flux = self.reference_lamp(configuration)
+            for _ in range(self.n_comps):
+                file_list.append(self.write_frame(
+                    data=self.comp_frame(lamp_flux),
+                    header=self.make_header(obstype='COMP',
+                                            object_name=configuration['lamp'],
+                                            exptime=COMP_EXPTIME,
+                                            configuration=configuration,
+                                            ra=ra,
+                                            dec=dec),
+                    suffix='comp',
+                    configuration=configuration))
+            for _ in range(self.n_objects):
+                file_list.append(self.write_frame(
+                    data=self.object_frame(),
+                    header=self.make_header(obstype='OBJECT',
+                                            object_name=target_name,
+                                            exptime=OBJECT_EXPTIME,
+                                            configuration=configuration,
+                                            ra=ra,
+                                            dec=dec),
+                    suffix=target_name,
+                    configuration=configuration))
+        log.info('Wrote {:d} synthetic frames to {:s}'.format(len(file_list),
+                                                              self.path))
+        return file_list
 
-    targets = n_targets
-    target_separation_fwhm = float(separation_fwhm)
-    image = []
-    if targets > 1:
-        target_location = [y / 2. - target_separation_fwhm / float(targets) * fwhm,
-                           y / 2. + target_separation_fwhm / float(targets) * fwhm]
-        print separation_fwhm, int(y / 2.), target_location, (target_separation_fwhm / targets) * fwhm
-    else:
-        target_location = [y / 2.]
+    def make_header(self, obstype, object_name, exptime, configuration=None,
+                    ra=DOME_FLAT_RA, dec=DOME_FLAT_DEC):
+        """Builds a raw Goodman header
 
-    sub_x = np.linspace(0, 10, x)
-    y_axis = range(y)
+        The observation time advances with every header, by the exposure time
+        plus the readout time.
 
-    spectrum = [[] for i in range(int(targets))]
+        Args:
+            obstype (str): BIAS, FLAT, COMP or OBJECT.
+            object_name (str): Value of the OBJECT keyword.
+            exptime (float): Exposure time in seconds.
+            configuration (dict): Instrument configuration as returned by
+                `get_reference_configurations`. None for bias, that are taken
+                without grating.
+            ra (str): Right ascension of the pointing, hh:mm:ss.sss
+            dec (str): Declination of the pointing, dd:mm:ss.sss
 
-    for i in range(x):
-        if noise_level == 0:
-            data = np.ones(y)
+        Returns:
+            An astropy.io.fits.Header instance.
+
+        """
+        date_obs = self.time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        self.time += datetime.timedelta(seconds=exptime + 12.)
+
+        if configuration is None:
+            grating = '<NO GRATING>'
+            cam_targ = cam_ang = 0.
+            grt_targ = grt_ang = 0.
+            filter2 = '<NO FILTER>'
+            slit = '<NO MASK>'
+            wavmode = 'Imaging'
         else:
-            data = np.random.normal(10, noise_level, y)
-        for tar in range(int(targets)):
-            amplitude = intens * intensity(sub_x[i])
-            # theo_snr = amplitude / noise_level
-            # print theo_snr
-            # gauss = models.Gaussian1D(amplitude=amplitude, mean=target_location[tar], stddev=fwhm) 8.24687326842
-            voigt = models.Voigt1D(amplitude_L=amplitude, x_0=target_location[tar], fwhm_L=0.942561669206, fwhm_G=fwhm)
-            # gauss2 = models.Gaussian1D(amplitude=amplitude, mean=target_location[1], stddev=fwhm)
-
-            # spectrum[tar].append(amplitude)
-            sd = voigt(y_axis)
-            spectrum[tar].append(np.sum(sd[int(target_location[tar] - 2.5 * fwhm):int(target_location[tar] + 2.5 * fwhm)]))
-            # gauss.amplitude.value = amplitude
-            data += voigt(y_axis)
-
-        # signal_peak = xxxx
-        # snr = 5
-        # noise_level = 400.
-        # noise_amplitude = signal_peak / snr
-        # data =  np.random.normal(noise_level, noise_amplitude, data.shape)
-
-        # data2 = gauss2(y_axis)
-        # plt.plot(data)
-        # plt.plot(data2)
-        # plt.show()
-
-        if i == int(x / 2.) and plots:
-            # plt.title('FWHM Separation: %s' % separation_fwhm)
-            plt.title('Intensity: %s' % (intens))
-            plt.axvline(int(target_location[tar] - 2.5 * fwhm), color='r')
-            plt.axvline(int(target_location[tar] + 2.5 * fwhm), color='r')
-            plt.plot(data)
-            plt.show()
-
-        image.append(data)
-
-        # plt.plot(y_axis, data)
-        # plt.show()
-        # rotated = zip(*original[::-1])
-    rotated_image = zip(*image[::-1])
-    hdu_name_file = '20161128_single-object_n%s_s%s-fwhm_%1.3f_int.fits'% (str(int(n_targets)), str(int(separation_fwhm)), intens)
-    print(hdu_name_file)
-    new_hdu = fits.PrimaryHDU(rotated_image, header=header_copy)
-    new_hdu.writeto(hdu_name_file, clobber=True)
-    for part_index in range(len(spectrum)):
-        # f = open('obj.save', 'wb')
-        # cPickle.dump(my_obj, f, protocol=cPickle.HIGHEST_PROTOCOL)
-        # f.close()
-        f = open(hdu_name_file.replace('.fits','_%s.pkl' % str(part_index + 1)), 'wb')
-        pickle.dump(spectrum[part_index][::-1], f, protocol=pickle.HIGHEST_PROTOCOL)
-        f.close()
-        plt.plot(spectrum[part_index][::-1])
-        plt.title('Simulated spectrum')
-        plt.xlabel('Pixel Axis')
-        plt.ylabel('Peak Intensity')
-        plt.savefig('img/' + hdu_name_file.replace('.fits','.png'), dpi=300)
-        if plots:
-            plt.show()
-
-    if plots:
-        plt.title('Target Separation %s - N targets %s' % (str(separation_fwhm), targets))
-        plt.imshow(rotated_image)
-        plt.show()
+            grating = configuration['grating']
+            cam_targ = configuration['cam_targ']
+            grt_targ = configuration['grt_targ']
+            cam_ang = cam_targ + self.random.uniform(-0.05, 0.05)
+            grt_ang = grt_targ + self.random.uniform(-0.005, 0.005)
+            filter2 = configuration['filter2']
+            slit = configuration['slit']
+            wavmode = configuration['wavmode']
+
+        height, width = self.shape
+        header = fits.Header()
+        header['OBJECT'] = (object_name, 'Name of the object observed')
+        header['DATE-OBS'] = (date_obs,
+                              'DATE-OBS Format: YYYY-MM-DDThh:mm:ss.sss')
+        header['DATE'] = (date_obs[:10], 'Date Format is YYYY-MM-DD')
+        header['TELESCOP'] = 'SOAR 4.1m'
+        header['INSTRUME'] = 'Goodman Spectrograph'
+        header['INSTCONF'] = self.camera
+        header['CAMERA'] = CAMERAS[self.camera]['camera']
+        header['RA'] = (ra, 'right ascension [hh:mm:ss.sss]')
+        header['DEC'] = (dec, 'declination [dd:mm:ss.sss]')
+        header['AIRMASS'] = (1.1, 'airmass at approx. start of exposure')
+        header['UT'] = (date_obs[11:],
+                        'time at approx. start of exposure [UTC]')
+        header['OBSRA'] = (ra, 'target right ascension [hh:mm:ss.sss]')
+        header['OBSDEC'] = (dec, 'target declination  [dd:mm:ss.sss]')
+        header['CAM_ANG'] = (cam_ang, 'camera angle [deg]')
+        header['GRT_ANG'] = (grt_ang, 'grating angle [deg]')
+        header['CAM_TARG'] = (cam_targ, 'camera target [deg]')
+        header['GRT_TARG'] = (grt_targ, 'grating target [deg]')
+        header['FILTER'] = ('<NO FILTER>', 'primary filter wheel')
+        header['FILTER2'] = (filter2, 'secondary filter wheel')
+        header['GRATING'] = (grating, 'VPH grating [1/mm]')
+        header['SLIT'] = (slit, 'slit [arcsec]')
+        if self.camera == 'Red':
+            header['WAVMODE'] = (wavmode, 'wavelength mode')
+        header['EXPTIME'] = (exptime, 'integration time')
+        header['RDNOISE'] = (self.rdnoise, 'CCD readnoise [e-]')
+        header['GAIN'] = (self.gain, 'CCD gain [e-/ADU]')
+        header['OBSTYPE'] = (obstype, 'observation type')
+        header['OBSERVER'] = 'Synthetic'
+        header['EQUINOX'] = (2000., 'equinox of coordinates')
+        if self.roi == 'Custom':
+            header['ROI'] = 'Custom'
+        else:
+            header['ROI'] = '{:s} {:d}x{:d}'.format(self.roi,
+                                                    self.serial_binning,
+                                                    self.parallel_binning)
+        header['DISPAXIS'] = 1
+        header['DETSIZE'] = '[1:4096,1:4096]'
+        header['TRIMSEC'] = '[{:d}:{:d},1:{:d}]'.format(self.data_start + 1,
+                                                        self.data_end,
+                                                        height)
+        header['CCDSIZE'] = '[1:4096,1:4096]'
+        header['CCDSUM'] = '{:d} {:d}'.format(self.serial_binning,
+                                              self.parallel_binning)
+        header['HISTORY'] = 'Synthetic frame {:d}x{:d}'.format(width, height)
+        return header
+
+    def write_frame(self, data, header, suffix, configuration=None):
+        """Writes a raw frame as unsigned 16 bit integers
+
+        Args:
+            data (array): Frame in ADU.
+            header (object): astropy.io.fits.Header instance.
+            suffix (str): Used in the file name.
+            configuration (dict): Instrument configuration, the grating and
+                mode are added to the file name.
+
+        Returns:
+            The file name, without path.
+
+        """
+        self.file_number += 1
+        name = '{:04d}_{:s}'.format(self.file_number, suffix)
+        if configuration is not None:
+            name += '_' + re.sub('[^A-Za-z0-9]', '',
+                                 configuration['wavmode'])
+        file_name = name + '.fits'
+        data = np.clip(np.round(data), 0, SATURATION).astype(np.uint16)
+        hdu = fits.PrimaryHDU(data=data, header=header)
+        hdu.writeto(os.path.join(self.path, file_name))
+        log.debug('Wrote {:s}'.format(file_name))
+        return file_name
+
+    def bias_frame(self):
+        """Bias level, fixed column pattern and read noise, in ADU"""
+        noise = self.random.normal(0, self.rdnoise / self.gain, self.shape)
+        return self.bias_pattern + noise
+
+    def flat_frame(self, peak=25000.):
+        """Dome flat with a smooth lamp spectrum
+
+        Args:
+            peak (float): Peak level in ADU above the bias.
+
+        """
+        columns = np.linspace(-1, 1, self.n_columns)
+        lamp = 0.15 + 0.85 * np.exp(-0.5 * (columns / 0.6) ** 2)
+        electrons = peak * self.gain * \
+            self.slit_profile[:, np.newaxis] * lamp[np.newaxis, :]
+        return self.expose(electrons)
+
+    def comp_frame(self, lamp_flux):
+        """Comparison lamp, shifted by a fraction of a pixel to emulate flexure
+
+        Args:
+            lamp_flux (array): Binned reference lamp in electrons, as returned
+                by `reference_lamp`.
+
+        """
+        columns = np.arange(self.n_columns, dtype=float)
+        shift = self.random.uniform(-1.5, 1.5)
+        shifted = np.interp(columns - shift, columns, lamp_flux)
+        electrons = self.slit_profile[:, np.newaxis] * shifted[np.newaxis, :]
+        return self.expose(electrons)
+
+    def object_frame(self, sky_level=40., peak=3000., fwhm=4.):
+        """Science frame with sky, curved target traces and cosmic rays
+
+        Args:
+            sky_level (float): Sky continuum per unbinned pixel in electrons.
+            peak (float): Peak of the brightest target per unbinned pixel, in
+                electrons.
+            fwhm (float): Unbinned spatial full width at half maximum of the
+                targets.
+
+        """
+        height = self.shape[0]
+        rows = np.arange(height, dtype=float)[:, np.newaxis]
+        columns = np.linspace(-1, 1, self.n_columns)
+        binned_area = self.serial_binning * self.parallel_binning
+
+        sky = sky_level * binned_area * (1 + 0.3 * columns[np.newaxis, :])
+        electrons = self.slit_profile[:, np.newaxis] * sky
+
+        sigma = fwhm / 2.355 / self.parallel_binning
+        continuum = np.exp(-0.5 * ((columns + 0.2) / 0.7) ** 2)
+        for target in range(self.n_targets):
+            offset = target - (self.n_targets - 1) / 2.
+            center = height * (0.5 + 0.12 * offset)
+            trace = center + 4. / self.parallel_binning * columns + \
+                6. / self.parallel_binning * columns ** 2
+            amplitude = peak * binned_area / (target + 1.)
+            # the profile is only evaluated in the rows around the trace
+            low = max(int(trace.min() - 8 * sigma), 0)
+            high = min(int(trace.max() + 8 * sigma) + 1, height)
+            profile = np.exp(-0.5 * ((rows[low:high] -
+                                      trace[np.newaxis, :]) / sigma) ** 2)
+            electrons[low:high] += amplitude * continuum[np.newaxis, :] * \
+                profile
+
+        return self.expose(electrons, exptime=OBJECT_EXPTIME)
+
+    def reference_lamp(self, configuration, peak=30000.):
+        """Reads and bins the reference lamp of a configuration
+
+        Args:
+            configuration (dict): Instrument configuration.
+            peak (float): Level of the brightest line in ADU.
+
+        Returns:
+            The lamp spectrum in electrons, one value per illuminated column.
+
+        """
+        flux = np.asarray(fits.getdata(configuration['file']), dtype=float)
+        flux = np.clip(flux - np.median(flux), 0, None)
+        flux = bin_spectrum(flux, self.serial_binning)
+        lamp_flux = np.zeros(self.n_columns)
+        n_pixels = min(len(flux), self.n_columns)
+        lamp_flux[:n_pixels] = flux[:n_pixels]
+        return lamp_flux / lamp_flux.max() * peak * self.gain
+
+    def expose(self, electrons, exptime=0.):
+        """Converts an illumination pattern into a raw frame
+
+        Adds photon noise, pixel response, cosmic rays and the bias, the
+        overscan and non illuminated columns only receive the bias. Photon
+        noise uses the normal approximation to the Poisson distribution, which
+        is several times faster to draw for full frames.
+
+        Args:
+            electrons (array): Expected electrons for the illuminated columns.
+            exptime (float): Exposure time, sets the number of cosmic rays.
+
+        Returns:
+            The frame in ADU.
+
+        """
+        expected = np.clip(electrons * self.pixel_response, 0, None)
+        illuminated = expected + np.sqrt(expected) * \
+            self.random.standard_normal(expected.shape)
+
+        n_hits = self.random.poisson(COSMIC_RAY_RATE * exptime * ROI_WIDTH *
+                                     (self.last_row - self.first_row + 1))
+        if n_hits > 0:
+            hit_rows = self.random.randint(0, illuminated.shape[0], n_hits)
+            hit_columns = self.random.randint(0, illuminated.shape[1], n_hits)
+            hit_energy = self.random.uniform(500., 20000., n_hits)
+            np.add.at(illuminated, (hit_rows, hit_columns), hit_energy)
+
+        frame = self.bias_frame()
+        frame[:, self.data_start:self.data_end] += illuminated / self.gain
+        return frame
+
+    def _slit_profile(self):
+        """Illumination along the slit with soft edges, peak normalized
+
+        The slit covers SLIT_EXTENT of the Spectroscopic ROI, a Custom ROI
+        sees the part of it inside its rows.
+
+        """
+        # unbinned rows of the spectroscopic ROI, counted from zero
+        rows = self.first_row - 1 + \
+            np.arange(self.shape[0], dtype=float) * self.parallel_binning
+        low, high = [extent * ROI_HEIGHT for extent in SLIT_EXTENT]
+        edge_width = 3.
+        return 0.5 * (np.tanh((rows - low) / edge_width) -
+                      np.tanh((rows - high) / edge_width))
+
+
+def get_args(arguments=None):
+    """Command line arguments to generate a single night
+
+    Args:
+        arguments (list): A list containing the arguments as elements.
+
+    Returns:
+        args (object): argparse instance.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Writes a synthetic Goodman spectroscopic night.")
+
+    parser.add_argument('path',
+                        help="Directory for the raw files.")
+
+    parser.add_argument('--binning',
+                        action='store',
+                        default='1x1',
+                        metavar='<SxP>',
+                        help="Serial x parallel binning. Default 1x1")
+
+    parser.add_argument('--camera',
+                        action='store',
+                        default='Red',
+                        choices=sorted(CAMERAS),
+                        help="Camera. Default Red")
+
+    parser.add_argument('--configurations',
+                        action='store',
+                        type=int,
+                        default=1,
+                        metavar='<n>',
+                        help="Number of instrument configurations. Default 1")
+
+    parser.add_argument('--n-bias',
+                        action='store',
+                        type=int,
+                        default=5,
+                        metavar='<n>',
+                        help="Number of bias frames. Default 5")
+
+    parser.add_argument('--n-comps',
+                        action='store',
+                        type=int,
+                        default=1,
+                        metavar='<n>',
+                        help="Comparison lamps per configuration. Default 1")
+
+    parser.add_argument('--n-flats',
+                        action='store',
+                        type=int,
+                        default=5,
+                        metavar='<n>',
+                        help="Flats per configuration. Default 5")
+
+    parser.add_argument('--n-objects',
+                        action='store',
+                        type=int,
+                        default=2,
+                        metavar='<n>',
+                        help="Science frames per configuration. Default 2")
+
+    parser.add_argument('--n-targets',
+                        action='store',
+                        type=int,
+                        default=1,
+                        metavar='<n>',
+                        help="Spectra along the slit. Default 1")
+
+    parser.add_argument('--roi-rows',
+                        action='store',
+                        default=None,
+                        metavar='<first:last>',
+                        help="Unbinned rows of the Spectroscopic ROI that are "
+                             "read, i.e. 700:1200, a Custom ROI. Default all "
+                             "of them, 1:{:d}".format(ROI_HEIGHT))
+
+    parser.add_argument('--seed',
+                        action='store',
+                        type=int,
+                        default=None,
+                        metavar='<seed>',
+                        help="Random seed, for reproducible nights.")
 
+    return parser.parse_args(args=arguments)
 
 
 if __name__ == '__main__':
-    inten = np.linspace(0.1, 1.3, 20)
-    #for sep in range(1,15):
-    for inte in inten:
-        make_2d_spectra(n_targets=1, fwhm=8.24687326842, intens=inte, noise_level=3.5)
+    ARGS = get_args()
+    logging.basicConfig(level=logging.INFO)
+    SIMULATOR = NightSimulator(
+        path=ARGS.path,
+        camera=ARGS.camera,
+        binning=[int(b) for b in ARGS.binning.lower().split('x')],
+        n_bias=ARGS.n_bias,
+        n_flats=ARGS.n_flats,
+        n_comps=ARGS.n_comps,
+        n_objects=ARGS.n_objects,
+        n_targets=ARGS.n_targets,
+        roi_rows=None if ARGS.roi_rows is None else [
+            int(row) for row in ARGS.roi_rows.split(':')],
+        n_configurations=ARGS.configurations,
+        seed=ARGS.seed)
+    SIMULATOR()
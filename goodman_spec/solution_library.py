@@ -0,0 +1,309 @@
+# -*- coding: utf8 -*-
+"""Library of accepted wavelength solutions
+
+Every wavelength solution accepted by redspec is saved to a JSON file, by
+default LIBRARY_FILE_NAME in the data directory of the user, see
+`default_library_path`, together with its instrument configuration, RMS
+error, the lines it was fitted with and the date of the lamp. When a new
+lamp of the same configuration is calibrated in automatic mode the closest
+solution in time is used as a first guess, see
+`WavelengthCalibration.library_wavelength_solution`, and the template lamp is
+only needed when the lines predicted by it do not match.
+
+Worker processes share the file, it is locked while it is updated and
+replaced by a complete copy. When it can not be written the new solutions are
+kept in memory only.
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import datetime
+import fcntl
+import json
+import logging
+import os
+
+from astropy.modeling import models
+
+from .linelist import configuration_key
+
+log = logging.getLogger('redspec.solutionlibrary')
+
+LIBRARY_FILE_NAME = 'goodman_solution_library.json'
+
+# increased whenever the content changes in an incompatible way
+LIBRARY_VERSION = 1
+
+# keywords that define the pixel to wavelength relation, together with the
+# length of the extracted lamp
+LIBRARY_KEYWORDS = ('grating', 'grt_targ', 'cam_targ', 'ccdsum')
+
+# solutions kept per configuration, the most recent ones
+MAX_ENTRIES_PER_CONFIGURATION = 10
+
+# SolutionLibrary instances shared by the whole process, by file name
+_LIBRARY_CACHE = {}
+
+
+def default_library_path():
+    """Library used when none is given, one per user
+
+    It is LIBRARY_FILE_NAME in goodman/ inside $XDG_DATA_HOME, or
+    ~/.local/share when it is not set.
+
+    """
+    data_home = os.environ.get('XDG_DATA_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(data_home, 'goodman', LIBRARY_FILE_NAME)
+
+
+def get_solution_library(file_name):
+    """Returns the SolutionLibrary instance shared by the whole process
+
+    Args:
+        file_name (str): Full path of the library file.
+
+    Returns:
+        A SolutionLibrary instance.
+
+    """
+    key = os.path.abspath(file_name)
+    try:
+        return _LIBRARY_CACHE[key]
+    except KeyError:
+        library = SolutionLibrary(key)
+        _LIBRARY_CACHE[key] = library
+        return library
+
+
+def library_key(header, length):
+    """Configuration of a comparison lamp as stored in the library
+
+    Args:
+        header (object): FITS header of the extracted lamp.
+        length (int): Number of pixels of the extracted lamp.
+
+    Returns:
+        A list with the values of LIBRARY_KEYWORDS and the length, or None if
+        any of the keywords is missing.
+
+    """
+    try:
+        key = configuration_key(header, LIBRARY_KEYWORDS)
+    except KeyError:
+        return None
+    return list(key) + [int(length)]
+
+
+def date_number(value):
+    """Days since 0001-01-01 of a FITS date, None if it can not be parsed"""
+    value = '{!s}'.format(value).strip()
+    for date_format, size in (('%Y-%m-%dT%H:%M:%S', 19), ('%Y-%m-%d', 10)):
+        try:
+            date = datetime.datetime.strptime(value[:size], date_format)
+        except ValueError:
+            continue
+        return date.toordinal() + (date.hour * 3600 + date.minute * 60 +
+                                   date.second) / 86400.
+    return None
+
+
+def make_entry(header, length, model, rms_error, pixels, wavelengths):
+    """Library entry of an accepted wavelength solution
+
+    Args:
+        header (object): FITS header of the extracted lamp.
+        length (int): Number of pixels of the extracted lamp.
+        model (object): astropy.modeling.models.Chebyshev1D instance, the
+            wavelength solution.
+        rms_error (float): RMS error of the solution in angstrom.
+        pixels (array): Position of the lines used, in pixels.
+        wavelengths (array): Reference wavelength of those lines.
+
+    Returns:
+        A dictionary, or None if the lamp lacks any of LIBRARY_KEYWORDS.
+
+    """
+    key = library_key(header, length)
+    if key is None:
+        return None
+    domain = getattr(model, 'domain', None)
+    return {'configuration': key,
+            'lamp': '{!s}'.format(header.get('OBJECT', '')).strip(),
+            'file': '{!s}'.format(header.get('OFNAME', '')).strip(),
+            'date': '{!s}'.format(header.get('DATE-OBS', '')).strip(),
+            'saved': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+            'degree': int(model.degree),
+            'domain': None if domain is None else [float(value)
+                                                   for value in domain],
+            'coefficients': [float(value) for value in model.parameters],
+            'rms': float(rms_error),
+            'lines': [[float(pixel), float(wavelength)]
+                      for pixel, wavelength in zip(pixels, wavelengths)]}
+
+
+def entry_model(entry):
+    """Chebyshev model of a library entry, see `make_entry`"""
+    coefficients = dict([('c{:d}'.format(i), value)
+                         for i, value in enumerate(entry['coefficients'])])
+    if entry['domain'] is not None:
+        coefficients['domain'] = entry['domain']
+    return models.Chebyshev1D(degree=entry['degree'], **coefficients)
+
+
+def _entry_id(entry):
+    return (tuple(entry['configuration']), entry['file'], entry['date'])
+
+
+def merge_entries(entries, new_entries):
+    """Adds entries replacing the ones of the same lamp and configuration
+
+    Only the MAX_ENTRIES_PER_CONFIGURATION most recent lamps of every
+    configuration are kept.
+
+    Args:
+        entries (list): Entries of the library.
+        new_entries (list): Entries to add.
+
+    Returns:
+        A new list of entries.
+
+    """
+    merged = {}
+    for entry in list(entries) + list(new_entries):
+        merged[_entry_id(entry)] = entry
+    by_configuration = {}
+    for entry in merged.values():
+        by_configuration.setdefault(tuple(entry['configuration']),
+                                    []).append(entry)
+    kept = []
+    for configuration in sorted(by_configuration):
+        ordered = sorted(by_configuration[configuration],
+                         key=lambda entry: (entry['date'], entry['saved']),
+                         reverse=True)
+        kept.extend(ordered[:MAX_ENTRIES_PER_CONFIGURATION])
+    return kept
+
+
+def read_library(file_name):
+    """Reads the entries of a library file
+
+    Args:
+        file_name (str): Full path of the library file.
+
+    Returns:
+        A list of entries, empty if the file does not exist or is not usable.
+
+    """
+    try:
+        with open(file_name) as library_file:
+            content = json.load(library_file)
+    except (IOError, OSError) as error:
+        log.debug('Solution library not loaded: {:s}'.format(str(error)))
+        return []
+    except ValueError as error:
+        log.warning('Ignoring invalid solution library {:s}: {:s}'.format(
+            file_name, str(error)))
+        return []
+    if content.get('version') != LIBRARY_VERSION:
+        log.warning('Ignoring solution library {:s}, it has an unsupported '
+                    'version'.format(file_name))
+        return []
+    return content['entries']
+
+
+class SolutionLibrary(object):
+    """Accepted wavelength solutions, read from and saved to a JSON file
+
+    Args:
+        file_name (str): Full path of the library file.
+
+    Attributes:
+        entries (list): One dictionary per solution, see `make_entry`.
+
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.entries = []
+        self._mtime = None
+        self.refresh()
+
+    def refresh(self):
+        """Reads the file again if it changed since it was last read"""
+        try:
+            mtime = os.stat(self.file_name).st_mtime
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self.entries = merge_entries(read_library(self.file_name),
+                                         self.entries)
+
+    def lookup(self, header, length):
+        """Finds the solution closest in time for the configuration of a lamp
+
+        Args:
+            header (object): FITS header of the extracted lamp.
+            length (int): Number of pixels of the extracted lamp.
+
+        Returns:
+            An entry, see `make_entry`, or None if there is none for the
+            configuration.
+
+        """
+        self.refresh()
+        key = library_key(header, length)
+        if key is None:
+            return None
+        candidates = [entry for entry in self.entries
+                      if entry['configuration'] == key]
+        if candidates == []:
+            return None
+
+        date = date_number(header.get('DATE-OBS', ''))
+
+        def distance(entry):
+            entry_date = date_number(entry['date'])
+            if date is None or entry_date is None:
+                return float('inf')
+            return abs(entry_date - date)
+
+        return min(candidates,
+                   key=lambda entry: (distance(entry),
+                                      entry['rms'],
+                                      entry['file']))
+
+    def add(self, entry):
+        """Adds an accepted solution and saves the library
+
+        The file is read again while it is locked, so the solutions saved by
+        other processes in the meantime are kept.
+
+        Args:
+            entry (dict): The solution, see `make_entry`.
+
+        """
+        self.entries = merge_entries(self.entries, [entry])
+        temporary_name = '{:s}.{:d}.tmp'.format(self.file_name, os.getpid())
+        try:
+            directory = os.path.dirname(self.file_name)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.file_name + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self.entries = merge_entries(read_library(self.file_name),
+                                             self.entries)
+                with open(temporary_name, 'w') as library_file:
+                    json.dump({'version': LIBRARY_VERSION,
+                               'entries': self.entries},
+                              library_file,
+                              indent=1,
+                              sort_keys=True)
+                os.rename(temporary_name, self.file_name)
+                self._mtime = os.stat(self.file_name).st_mtime
+        except (IOError, OSError) as error:
+            log.warning('Solution library not saved: {:s}'.format(str(error)))
+            return
+        log.debug('Saved solution of {:s} to {:s}'.format(entry['file'],
+                                                          self.file_name))
@@ -14,10 +14,8 @@ from __future__ import (absolute_import, division, print_function,
 import astropy.units as u
 import glob
 import logging
+import multiprocessing
 import numpy as np
-# import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mtick
 import os
 import re
 import sys
@@ -25,14 +23,29 @@ import scipy.interpolate
 
 from astropy.io import fits
 from astropy.stats import sigma_clip
-from astropy.modeling import models, fitting
 from astropy.convolution import convolve, Gaussian1DKernel, Box1DKernel
 from ccdproc import CCDData
-from matplotlib.backends.backend_pdf import PdfPages
-from scipy import signal
 
-from .wsbuilder import (ReadWavelengthSolution, WavelengthFitter)
-from .linelist import ReferenceData
+from . import centroiding
+from .wsbuilder import WavelengthFitter
+from .lamp_templates import get_lamp_template
+from .linearization import Linearizer
+from .line_identification import identify_lines
+from .linelist import get_reference_data, match_lines
+from .solution_library import (default_library_path,
+                               entry_model,
+                               get_solution_library,
+                               make_entry)
+from .registration import (MIN_REGISTRATION_QUALITY,
+                           global_registration,
+                           line_shifts,
+                           reference_position,
+                           refinement_half_width)
+from .plot_renderer import (DeferredPlotRenderer,
+                            PlotRecord,
+                            WORKER_MEMORY,
+                            render_plot_record,
+                            show_plot_record)
 from goodman_ccd.core import (spectroscopic_extraction,
                               search_comp_group,
                               add_wcs_keys,
@@ -40,6 +53,10 @@ from goodman_ccd.core import (spectroscopic_extraction,
                               NoMatchFound,
                               NotEnoughLinesDetected,
                               CriticalError)
+from goodman_ccd.instrumentation import instrumentation
+from goodman_ccd.tracing import TraceCache
+from goodman_ccd.memory_budget import memory_budget
+from goodman_ccd.lazy_import import LazyModule, plt
 
 
 
@@ -47,15 +64,75 @@ from goodman_ccd.core import (spectroscopic_extraction,
 # log.basicConfig(level=log.INFO, format=FORMAT)
 log = logging.getLogger('redspec.wavelength')
 
+mtick = LazyModule('matplotlib.ticker')
+signal = LazyModule('scipy.signal')
+
 SHOW_PLOTS = False
 
+# approximate memory used by a spectroscopic reduction worker, in bytes
+SPECTROSCOPY_WORKER_MEMORY = 600e6
+
+
+SOLUTION_CACHE_KEYWORDS = ['GRATING',
+                           'CAM_TARG',
+                           'GRT_TARG',
+                           'FILTER2',
+                           'SLIT',
+                           'CCDSUM']
+
+# a line matches a reference line when the solution puts it closer than this
+# number of pixels, see WavelengthCalibration.match_lines
+LIBRARY_MATCH_PIXELS = 3.
+
+# a solution of the library is used as first guess if it matches this many
+# lines and this fraction of the lines detected in the lamp
+LIBRARY_MIN_LINES = 6
+LIBRARY_MIN_MATCH_FRACTION = 0.5
+
+# solutions are saved to the library and taken from it only if their RMS
+# error is smaller than this number of pixels
+LIBRARY_MAX_RMS_PIXELS = 1.5
+
+
+def solution_cache_key(ccd, comp_list):
+    """Key that identifies a wavelength solution for reuse
+
+    Science frames that share the same comparison lamps, extracted from the
+    same zone, and the same instrument configuration get the same wavelength
+    solution, so the lamp only has to be solved once.
+
+    Args:
+        ccd (object): a ccdproc.CCDData instance containing the extracted
+            science spectrum.
+        comp_list (list): Extracted comparison lamps, instances of
+            ccdproc.CCDData.
+
+    Returns:
+        A tuple with the file name and extraction zone (APNUM1) of every lamp
+        followed by the values of SOLUTION_CACHE_KEYWORDS.
+
+    """
+    lamps = tuple([(str(comp.header.get('OFNAME', '')),
+                    str(comp.header.get('APNUM1', '')))
+                   for comp in comp_list])
+    configuration = tuple([str(ccd.header.get(keyword, '')).strip()
+                           for keyword in SOLUTION_CACHE_KEYWORDS])
+    return lamps + configuration
+
 
-def process_spectroscopy_data(data_container, args, extraction_type='simple'):
+def process_spectroscopy_data(data_container, args, extraction_type='simple',
+                              products=None):
     """Does spectroscopic processing
 
     This is a high level method that manages all subprocess regarding the
     spectroscopic reduction.
 
+    Every group of science frames is matched with its comparison lamps first,
+    then the groups are processed, see `process_group`. Groups are independent
+    of each other so with `args.workers` larger than one they are processed
+    in a pool of worker processes, large groups are split in chunks of files
+    when there are less groups than workers.
+
     It returns a True value but it should be modified to return something more
     usable in case it is integrated in other application.
 
@@ -67,6 +144,9 @@ def process_spectroscopy_data(data_container, args, extraction_type='simple'):
         extraction_type (str): string that defines the type of extraction to be
             performed. 'simple' or 'optimal'. This is required by the extraction
             function.
+        products (object): goodman_ccd.product_store.ProductStore instance
+            that holds the frames, or None to read them from
+            `data_container.full_path`.
 
     Returns:
         a True value.
@@ -76,22 +156,27 @@ def process_spectroscopy_data(data_container, args, extraction_type='simple'):
     assert data_container.is_empty is False
     assert any(extraction_type == option for option in ['simple',
                                                         'optimal'])
-    # to be returned
-    extracted = None
-    comps = None
 
     full_path = data_container.full_path
 
-    for sub_container in [groups for groups in [data_container.spec_groups,
-                          data_container.object_groups] if groups is not None]:
+    sub_containers = [groups for groups in [data_container.spec_groups,
+                                            data_container.object_groups]
+                      if groups is not None]
+
+    instrumentation.start_progress(
+        total=sum([len(group[group.obstype == 'OBJECT'])
+                   for sub_container in sub_containers
+                   for group in sub_container]))
+
+    # comparison lamps are matched in order since comp-only groups are added
+    # to the data container as they are found
+    tasks = []
+    for sub_container in sub_containers:
         for group in sub_container:
-            # instantiate WavelengthCalibration here for each group.
-            get_wsolution = WavelengthCalibration(args=args)
             # this will contain only obstype == OBJECT
             object_group = group[group.obstype == 'OBJECT']
             # this has to be initialized here
             comp_group = None
-            comp_ccd_list = []
             if 'COMP' in group.obstype.unique():
                 log.debug('Group has comparison lamps')
                 comp_group = group[group.obstype == 'COMP']
@@ -118,76 +203,324 @@ def process_spectroscopy_data(data_container, args, extraction_type='simple'):
                 else:
                     log.warning('Data will be extracted but not calibrated')
 
-            for spec_file in object_group.file.tolist():
-                log.info('Processing Science File: {:s}'.format(spec_file))
-                file_path = os.path.join(full_path, spec_file)
-                ccd = CCDData.read(file_path, unit=u.adu)
-                ccd.header = add_wcs_keys(header=ccd.header)
-                ccd.header['OFNAME'] = (spec_file, 'Original File Name')
-                if comp_group is not None and comp_ccd_list == []:
-                    for comp_file in comp_group.file.tolist():
-                        comp_path = os.path.join(full_path, comp_file)
-                        comp_ccd = CCDData.read(comp_path, unit=u.adu)
-                        comp_ccd.header = add_wcs_keys(header=comp_ccd.header)
-                        comp_ccd.header['OFNAME'] = (comp_file,
-                                                     'Original File Name')
-                        comp_ccd_list.append(comp_ccd)
-                        # plt.imshow(comp_ccd.data)
-                        # plt.show()
+            tasks.append((object_group.file.tolist(), comp_group))
+
+    workers = get_spectroscopy_workers(args=args, n_tasks=len(tasks))
+    if workers > 1:
+        if products is not None:
+            # the workers read the frames from disk
+            products.spill()
+        process_in_pool(tasks=tasks,
+                        full_path=full_path,
+                        args=args,
+                        extraction_type=extraction_type,
+                        workers=workers)
+        return True
+
+    if products is not None:
+        # frames leave the store after their last use, comparison lamps are
+        # read once by every group with science frames
+        products.expect_reads(
+            [file_name for object_files, comp_group in tasks
+             for file_name in object_files +
+             (comp_group.file.tolist()
+              if comp_group is not None and object_files != [] else [])])
+
+    # plots are saved by background processes while the reduction goes on
+    plot_renderer = None
+    if args.save_plots or args.no_pause:
+        plot_renderer = DeferredPlotRenderer(
+            processes=memory_budget.workers(args.plot_workers, WORKER_MEMORY))
+
+    for object_files, comp_group in tasks:
+        process_group(object_files=object_files,
+                      comp_group=comp_group,
+                      full_path=full_path,
+                      args=args,
+                      extraction_type=extraction_type,
+                      plot_renderer=plot_renderer,
+                      products=products)
+
+    if plot_renderer is not None:
+        plot_renderer.close()
+    return True
+
+
+def get_spectroscopy_workers(args, n_tasks):
+    """Number of worker processes for the spectroscopic reduction
+
+    Plots shown on screen and the interactive wavelength solution need the
+    main process, in those cases the reduction is serial.
+
+    Args:
+        args (object): Instance of arparse.Namespace with the arguments of the
+            pipeline, uses `workers`.
+        n_tasks (int): Number of groups to be processed.
+
+    Returns:
+        The number of workers, one means serial processing.
+
+    """
+    workers = getattr(args, 'workers', 1) or 1
+    if workers <= 1 or n_tasks == 0:
+        return 1
+    if args.interactive_ws:
+        log.warning('Interactive wavelength solution, ignoring --workers')
+        return 1
+    if (args.plot_results or args.debug_mode) and not args.no_pause:
+        log.warning('Plots are shown on screen, ignoring --workers. Use '
+                    '--no-pause to save them instead.')
+        return 1
+    return max(memory_budget.workers(workers, SPECTROSCOPY_WORKER_MEMORY), 1)
+
+
+def split_tasks(tasks, workers):
+    """Splits large groups when there are less groups than workers
+
+    Chunks of the same group do not share their wavelength solutions or
+    traces, so groups are only split when otherwise workers would be idle.
+
+    Args:
+        tasks (list): Tuples of the list of science files of a group and its
+            comparison lamps group.
+        workers (int): Number of worker processes.
+
+    Returns:
+        A list of tasks with the same format.
+
+    """
+    if len(tasks) >= workers:
+        return tasks
+    n_files = sum([len(object_files) for object_files, _ in tasks])
+    chunk_size = max(int(np.ceil(n_files / workers)), 1)
+    chunks = []
+    for object_files, comp_group in tasks:
+        for start in range(0, len(object_files), chunk_size):
+            chunks.append((object_files[start:start + chunk_size],
+                           comp_group))
+    return chunks
+
+
+def process_in_pool(tasks, full_path, args, extraction_type, workers):
+    """Processes groups in a pool of worker processes
+
+    The reference data is loaded before the workers are started, where
+    processes are forked the workers share it. Plots are rendered by each
+    worker and the statistics of the workers are added to the ones of the
+    main process.
+
+    Args:
+        tasks (list): Tuples of the list of science files of a group and its
+            comparison lamps group.
+        full_path (str): Directory of the data.
+        args (object): Instance of arparse.Namespace with the arguments of the
+            pipeline.
+        extraction_type (str): 'simple' or 'optimal'.
+        workers (int): Number of worker processes.
+
+    """
+    get_reference_data(args.reference_dir)
+
+    tasks = split_tasks(tasks=tasks, workers=workers)
+    log.info('Processing {:d} groups in {:d} worker '
+             'processes'.format(len(tasks), workers))
+
+    pool = multiprocessing.Pool(
+        processes=workers,
+        initializer=initialize_worker,
+        initargs=(args.reference_dir,
+                  instrumentation.enabled,
+                  instrumentation.track_memory))
+    try:
+        pending = [pool.apply_async(process_group_in_worker,
+                                    (object_files,
+                                     comp_group,
+                                     full_path,
+                                     args,
+                                     extraction_type))
+                   for object_files, comp_group in tasks]
+        pool.close()
+        for result in pending:
+            n_files, collected = result.get()
+            instrumentation.merge(collected)
+            instrumentation.advance(frames=n_files)
+        pool.join()
+    except BaseException:
+        pool.terminate()
+        raise
+
+
+def initialize_worker(reference_dir, instrumentation_enabled, track_memory):
+    """Prepares a worker process of `process_in_pool`
+
+    Args:
+        reference_dir (str): Reference data directory, loaded here unless it
+            was inherited from the main process.
+        instrumentation_enabled (bool): Whether the main process collects
+            statistics.
+        track_memory (bool): Whether memory usage is recorded too.
+
+    """
+    get_reference_data(reference_dir)
+    # inherited statistics belong to the main process
+    if instrumentation_enabled:
+        instrumentation.enable(show_progress=False, track_memory=track_memory)
+    else:
+        instrumentation.disable()
+
+
+def process_group_in_worker(object_files, comp_group, full_path, args,
+                            extraction_type):
+    """Runs `process_group` in a worker process
+
+    Plots are rendered in the worker itself, daemonic processes can not start
+    a pool of their own.
+
+    Returns:
+        A tuple with the number of science files and the statistics collected
+        by the worker, see Instrumentation.collect.
+
+    """
+    plot_renderer = None
+    if args.save_plots or args.no_pause:
+        plot_renderer = DeferredPlotRenderer(processes=0)
+    process_group(object_files=object_files,
+                  comp_group=comp_group,
+                  full_path=full_path,
+                  args=args,
+                  extraction_type=extraction_type,
+                  plot_renderer=plot_renderer,
+                  show_progress=False)
+    return len(object_files), instrumentation.collect()
+
+
+def read_frame(full_path, file_name, products=None):
+    """Reads a frame from disk or takes it from a ProductStore
+
+    Args:
+        full_path (str): Directory of the data.
+        file_name (str): File name of the frame.
+        products (object): ProductStore instance or None.
+
+    Returns:
+        A ccdproc.CCDData instance.
+
+    """
+    if products is not None:
+        return products.get(file_name)
+    file_path = os.path.join(full_path, file_name)
+    ccd = CCDData.read(file_path, unit=u.adu)
+    instrumentation.record_read(file_path)
+    return ccd
+
+
+def process_group(object_files, comp_group, full_path, args, extraction_type,
+                  plot_renderer=None, show_progress=True, products=None):
+    """Extracts and calibrates the science files of a group
+
+    The files share the same comparison lamps, their wavelength solutions
+    and their traces are reused whenever possible.
+
+    Args:
+        object_files (list): File names of the science frames.
+        comp_group (object): pandas.DataFrame with the comparison lamps of the
+            group or None.
+        full_path (str): Directory of the data.
+        args (object): Instance of arparse.Namespace with the arguments of the
+            pipeline.
+        extraction_type (str): 'simple' or 'optimal'.
+        plot_renderer (object): DeferredPlotRenderer instance or None.
+        show_progress (bool): Advance the progress line after every file.
+        products (object): ProductStore instance that holds the frames or
+            None to read them from `full_path`.
+
+    """
+    # instantiate WavelengthCalibration here for each group.
+    get_wsolution = WavelengthCalibration(args=args,
+                                          plot_renderer=plot_renderer)
+    # wavelength solutions of this group, see solution_cache_key
+    solution_cache = {}
+    # targets and traces shared by the exposures of this group
+    trace_cache = TraceCache()
+    comp_ccd_list = []
+
+    for spec_file in object_files:
+        log.info('Processing Science File: {:s}'.format(spec_file))
+        ccd = read_frame(full_path, spec_file, products=products)
+        if show_progress:
+            instrumentation.advance()
+        ccd.header = add_wcs_keys(header=ccd.header)
+        ccd.header['OFNAME'] = (spec_file, 'Original File Name')
+        if comp_group is not None and comp_ccd_list == []:
+            for comp_file in comp_group.file.tolist():
+                comp_ccd = read_frame(full_path, comp_file, products=products)
+                comp_ccd.header = add_wcs_keys(header=comp_ccd.header)
+                comp_ccd.header['OFNAME'] = (comp_file,
+                                             'Original File Name')
+                comp_ccd_list.append(comp_ccd)
+                # plt.imshow(comp_ccd.data)
+                # plt.show()
+        else:
+            log.debug('Comp Group is None or comp list already exist')
+
+        try:
+            extracted, comps = spectroscopic_extraction(
+                ccd=ccd,
+                extraction=extraction_type,
+                comp_list=comp_ccd_list,
+                nfind=args.max_n_targets,
+                plots=SHOW_PLOTS,
+                trace_cache=trace_cache)
+
+            if args.debug_mode and not args.no_pause:
+                fig = plt.figure(0)
+                fig.clf()
+                fig.canvas.set_window_title('Extracted Data')
+
+                manager = plt.get_current_fig_manager()
+
+                if plt.get_backend() == u'GTK3Agg':
+                    manager.window.maximize()
+                elif plt.get_backend() == u'Qt4Agg':
+                    manager.window.showMaximized()
+
+                for edata in extracted:
+                    plt.plot(edata.data, label=edata.header['OBJECT'])
+                    if comps != []:
+                        for comp in comps:
+                            plt.plot(comp.data,
+                                     label=comp.header['OBJECT'])
+                plt.legend(loc='best')
+                if plt.isinteractive():
+                    plt.draw()
+                    plt.pause(1)
                 else:
-                    log.debug('Comp Group is None or comp list already exist')
+                    plt.show()
 
-                try:
-                    extracted, comps = spectroscopic_extraction(
-                        ccd=ccd,
-                        extraction=extraction_type,
-                        comp_list=comp_ccd_list,
-                        nfind=args.max_n_targets,
-                        plots=SHOW_PLOTS)
-
-                    if args.debug_mode:
-                        fig = plt.figure(0)
-                        fig.clf()
-                        fig.canvas.set_window_title('Extracted Data')
-
-                        manager = plt.get_current_fig_manager()
-
-                        if plt.get_backend() == u'GTK3Agg':
-                            manager.window.maximize()
-                        elif plt.get_backend() == u'Qt4Agg':
-                            manager.window.showMaximized()
-
-                        for edata in extracted:
-                            plt.plot(edata.data, label=edata.header['OBJECT'])
-                            if comps != []:
-                                for comp in comps:
-                                    plt.plot(comp.data,
-                                             label=comp.header['OBJECT'])
-                        plt.legend(loc='best')
-                        if plt.isinteractive():
-                            plt.draw()
-                            plt.pause(1)
-                        else:
-                            plt.show()
+            object_number = None
+            for i in range(len(extracted)):
+                extracted_ccd = extracted[i]
 
+                # this is for numbering the last file.
+                if len(extracted) == 1:
                     object_number = None
-                    for i in range(len(extracted)):
-                        extracted_ccd = extracted[i]
-
-                        # this is for numbering the last file.
-                        if len(extracted) == 1:
-                            object_number = None
-                        else:
-                            object_number = i + 1
-
-                        wsolution_obj = get_wsolution(ccd=extracted_ccd,
-                                                      comp_list=comps,
-                                                      object_number=object_number)
-                        # return wsolution_obj
-                except NoTargetException:
-                    log.error('No target was identified')
-                    break
-    return True
+                else:
+                    object_number = i + 1
+
+                cache_key = solution_cache_key(ccd=extracted_ccd,
+                                               comp_list=comps)
+
+                wsolution_obj = get_wsolution(
+                    ccd=extracted_ccd,
+                    comp_list=comps,
+                    object_number=object_number,
+                    wsolution_obj=solution_cache.get(cache_key))
+
+                if wsolution_obj is not None:
+                    solution_cache[cache_key] = wsolution_obj
+        except NoTargetException:
+            log.error('No target was identified')
+            break
 
 
 class WavelengthCalibration(object):
@@ -208,7 +541,7 @@ class WavelengthCalibration(object):
 
     """
 
-    def __init__(self, args):
+    def __init__(self, args, plot_renderer=None):
         """Wavelength Calibration Class Initialization
 
         A WavelengthCalibration class is instantiated for each science target
@@ -221,18 +554,28 @@ class WavelengthCalibration(object):
 
         Args:
             args (object): Runtime arguments.
+            plot_renderer (object): Instance of
+                goodman_spec.plot_renderer.DeferredPlotRenderer used to save
+                plots in the background. If None plots are saved inline.
 
         """
 
         # TODO - Documentation missing
         self.args = args
+        self.plot_renderer = plot_renderer
         self.poly_order = 2
         self.wsolution = None
         self.rms_error = None
-        self.reference_data = ReferenceData(self.args.reference_dir)
+        self.reference_data = get_reference_data(self.args.reference_dir)
+        self.solution_library = None
+        if not self.args.no_solution_library:
+            self.solution_library = get_solution_library(
+                self.args.solution_library or default_library_path())
         # self.science_object = science_object
         self.slit_offset = None
         self.interpolation_size = 200
+        self._linearizer = None
+        self._linearizer_solution = None
         self.line_search_method = 'derivative'
         """Instrument configuration and spectral characteristics"""
         self.pixel_size = 15 * u.micrometer
@@ -248,6 +591,7 @@ class WavelengthCalibration(object):
         self.alpha = None
         self.beta = None
         self.center_wavelength = None
+        self.dispersion = None
         self.blue_limit = None
         self.red_limit = None
         """Interactive wavelength finding"""
@@ -275,6 +619,8 @@ class WavelengthCalibration(object):
         self.events = True
         self.first = True
         self.evaluation_comment = None
+        # comparison lamps already written, by (file name, target number)
+        self.written_lamps = set()
         # self.binning = self.lamp_header[]
         self.pixelcenter = []
         """this data must come parsed"""
@@ -317,6 +663,20 @@ class WavelengthCalibration(object):
         self.i_fig = None
 
         log.info('Processing Science Target: {:s}'.format(ccd.header['OBJECT']))
+        if wsolution_obj is not None and comp_list != [] and \
+                wsolution_obj.check_compatibility(header=ccd.header):
+            log.info('Reusing wavelength solution from lamp '
+                     '{:s}'.format(wsolution_obj.reference_lamp))
+            lamp_ccd = comp_list[0]
+            self.lamp_data = lamp_ccd.data
+            self.lamp_header = lamp_ccd.header.copy()
+            self.lamp_name = self.lamp_header['OBJECT']
+            self.wsolution = wsolution_obj.wsolution
+            self.calibration_lamp = wsolution_obj.reference_lamp
+            self.evaluation_comment = wsolution_obj.evaluation_comment
+            return self.apply_wavelength_solution(ccd=ccd,
+                                                  object_number=object_number)
+
         if comp_list is not None:
             for lamp_ccd in comp_list:
 
@@ -334,11 +694,14 @@ class WavelengthCalibration(object):
                 log.info('Processing Comparison Lamp: '
                          '{:s}'.format(self.lamp_name))
 
-                self.data1 = self.interpolate(self.lamp_data)
                 # self.lines_limits = self.get_line_limits()
                 # self.lines_center = self.get_line_centers(self.lines_limits)
-                self.lines_center = self.get_lines_in_lamp()
+                with instrumentation.stage('line_detection'):
+                    self.lines_center = self.get_lines_in_lamp()
                 self.spectral = self.get_spectral_characteristics()
+                self.evaluation_comment = None
+                self.wsolution = None
+                self.rms_error = None
                 object_name = ccd.header['OBJECT']
                 if self.args.interactive_ws:
                     self.interactive_wavelength_solution(object_name=object_name)
@@ -348,105 +711,10 @@ class WavelengthCalibration(object):
                     self.automatic_wavelength_solution()
                     # self.wsolution = self.wavelength_solution()
                 if self.wsolution is not None:
-                    # TODO (simon): plug in a record system
-                    # record = '{:s} {:.3f} {:.3f}'.format(
-                    #     self.lamp_header['GRATING'],
-                    #     self.lamp_header['GRT_TARG'],
-                    #     self.lamp_header['CAM_TARG'])
-                    #
-                    # for par in self.wsolution.parameters:
-                    #     record += ' {:.5f}'.format(par)
-                    #
-                    # os.system("echo \'{:s}\' >> parametros.txt".format(record))
-
-                    self.linear_lamp = self.linearize_spectrum(self.lamp_data)
-
-                    self.lamp_header = self.add_wavelength_solution(
-                        new_header=self.lamp_header,
-                        spectrum=self.linear_lamp,
-                        original_filename=self.calibration_lamp,
-                        index=object_number)
-
-                    # print(ccd.header)
-
-                    self.linearized_sci = self.linearize_spectrum(ccd.data)
-
-                    self.header = self.add_wavelength_solution(
-                        new_header=ccd.header,
-                        spectrum=self.linearized_sci,
-                        original_filename=ccd.header['OFNAME'],
-                        index=object_number)
-
-
-                    wavelength_solution = WavelengthSolution(
-                        solution_type='non_linear',
-                        model_name='chebyshev',
-                        model_order=self.poly_order,
-                        model=self.wsolution,
-                        ref_lamp=self.calibration_lamp,
-                        eval_comment=self.evaluation_comment,
-                        header=self.header)
-
-                    if self.args.plot_results or self.args.debug_mode or \
-                            self.args.save_plots:
-
-                        if not self.args.debug_mode:
-                            plt.ion()
-                            # plt.show()
-                        else:
-                            plt.ioff()
-
-                        wavelength_axis = self.wsolution(range(ccd.data.size))
-
-                        object_name = ccd.header['OBJECT']
-                        grating = ccd.header['GRATING']
-
-                        fig_title = 'Wavelength Calibrated Data : ' \
-                                    '{:s}\n{:s}'.format(object_name, grating)
-
-                        fig = plt.figure()
-                        fig.canvas.set_window_title(ccd.header['OFNAME'])
-                        ax1 = fig.add_subplot(111)
-                        manager = plt.get_current_fig_manager()
-                        if plt.get_backend() == u'GTK3Agg':
-                            manager.window.maximize()
-                        elif plt.get_backend() == u'Qt4Agg':
-                            manager.window.showMaximized()
-
-                        ax1.set_title(fig_title)
-                        ax1.set_xlabel('Wavelength (Angstrom)')
-                        ax1.set_ylabel('Intensity (ADU)')
-                        ax1.set_xlim((wavelength_axis[0], wavelength_axis[-1]))
-
-                        ax1.plot(wavelength_axis,
-                                 ccd.data,
-                                 color='k',
-                                 label='Data')
-
-                        ax1.legend(loc='best')
-                        plt.tight_layout()
-                        if self.args.save_plots:
-                            log.info('Saving plots')
-                            plots_dir = os.path.join(self.args.destiny, 'plots')
-                            if not os.path.isdir(plots_dir):
-                                os.mkdir(plots_dir)
-                            plot_name = re.sub('.fits',
-                                               '.png',
-                                               ccd.header['OFNAME'])
-                            plot_path = os.path.join(plots_dir, plot_name)
-                            # print(plot_path)
-                            plt.savefig(plot_path, dpi=300)
-                            log.info('Saved plot as {:s} file '
-                                     'DPI=300'.format(plot_name))
-
-                        if self.args.debug_mode:
-                            plt.show()
-                        else:
-                            plt.draw()
-                            plt.pause(2)
-                            plt.ioff()
-
-                    return wavelength_solution
+                    self.save_solution()
+                    return self.apply_wavelength_solution(
+                        ccd=ccd,
+                        object_number=object_number)
                 else:
                     log.error('It was not possible to get a wavelength '
                               'solution from this lamp.')
@@ -454,28 +722,111 @@ class WavelengthCalibration(object):
         else:
             print('Data should be saved anyways')
 
-        # else:
-        #     self.wsolution = wsolution_obj.wsolution
-        #     self.calibration_lamp = wsolution_obj.reference_lamp
-        #     self.evaluation_comment = wsolution_obj.evaluation_comment
-        #     # print('wavelengthSolution ', self.wsolution)
-        #     # print('Evaluation Comment', self.evaluation_comment)
-        #     # repeat for all sci
-        #     for target_index in range(self.science_object.no_targets):
-        #         log.debug('Processing target {:d}'.format(target_index + 1))
-        #         new_data = self.science_pack.data[target_index]
-        #         new_header = self.science_pack.headers[target_index]
-        #         if self.science_object.no_targets > 1:
-        #             new_index = target_index + 1
-        #         else:
-        #             new_index = None
-        #         self.linearized_sci = self.linearize_spectrum(new_data)
-        #         self.header = self.add_wavelength_solution(new_header,
-        #                                                    self.linearized_sci,
-        #                                                    self.sci_filename,
-        #                                                    self.evaluation_comment,
-        #                                                    index=new_index)
-        #     return wsolution_obj
+    def apply_wavelength_solution(self, ccd, object_number=None):
+        """Applies the current wavelength solution to the lamp and the target
+
+        Linearizes and writes the comparison lamp, unless it was already
+        written by a previous call, and the science spectrum, then plots the
+        result if requested. When the science spectrum has an uncertainty,
+        as the optimal extraction provides, its variance is linearized too and
+        written as a VARIANCE extension.
+
+        Args:
+            ccd (object): a ccdproc.CCDData instance containing the extracted
+                science spectrum.
+            object_number (int): Target number used as a file name suffix in
+                multi-target images. Default value is None.
+
+        Returns:
+            wavelength_solution (object): Instance of WavelengthSolution.
+
+        """
+        lamp_key = (self.calibration_lamp, object_number)
+        write_lamp = lamp_key not in self.written_lamps
+
+        if write_lamp and len(self.lamp_data) == len(ccd.data):
+            # lamp and target are linearized together
+            self.linear_lamp, self.linearized_sci = self.linearize_spectra(
+                [self.lamp_data, ccd.data])
+        else:
+            if write_lamp:
+                self.linear_lamp = self.linearize_spectrum(self.lamp_data)
+            self.linearized_sci = self.linearize_spectrum(ccd.data)
+
+        linear_variance = None
+        if ccd.uncertainty is not None:
+            # interpolated without smoothing, negative values are not valid
+            variance = np.asarray(ccd.uncertainty.array, dtype=float) ** 2
+            linear_variance = np.clip(
+                self.get_linearizer(len(variance))(variance, smooth=False),
+                0.,
+                None)
+
+        if write_lamp:
+            self.lamp_header = self.add_wavelength_solution(
+                new_header=self.lamp_header,
+                spectrum=self.linear_lamp,
+                original_filename=self.calibration_lamp,
+                evaluation_comment=self.evaluation_comment,
+                index=object_number)
+            self.written_lamps.add(lamp_key)
+
+        self.header = self.add_wavelength_solution(
+            new_header=ccd.header,
+            spectrum=self.linearized_sci,
+            original_filename=ccd.header['OFNAME'],
+            evaluation_comment=self.evaluation_comment,
+            index=object_number,
+            variance=linear_variance)
+
+        wavelength_solution = WavelengthSolution(
+            solution_type='non_linear',
+            model_name='chebyshev',
+            model_order=self.poly_order,
+            model=self.wsolution,
+            ref_lamp=self.calibration_lamp,
+            eval_comment=self.evaluation_comment,
+            header=self.header)
+
+        if self.args.plot_results or self.args.debug_mode or \
+                self.args.save_plots:
+
+            wavelength_axis = self.wsolution(range(ccd.data.size))
+
+            object_name = ccd.header['OBJECT']
+            grating = ccd.header['GRATING']
+
+            fig_title = 'Wavelength Calibrated Data : ' \
+                        '{:s}\n{:s}'.format(object_name, grating)
+
+            record = PlotRecord(
+                title=fig_title,
+                window_title=ccd.header['OFNAME'],
+                xlabel='Wavelength (Angstrom)',
+                ylabel='Intensity (ADU)',
+                xlim=(wavelength_axis[0], wavelength_axis[-1]))
+
+            record.plot(wavelength_axis,
+                        ccd.data,
+                        color='k',
+                        label='Data')
+
+            if self.args.save_plots or self.args.no_pause:
+                plots_dir = os.path.join(self.args.destiny, 'plots')
+                if not os.path.isdir(plots_dir):
+                    os.mkdir(plots_dir)
+                plot_name = re.sub('.fits',
+                                   '.png',
+                                   ccd.header['OFNAME'])
+                record.add_output(os.path.join(plots_dir,
+                                               plot_name),
+                                  dpi=300)
+                log.info('Saving plot as {:s} file '
+                         'DPI=300'.format(plot_name))
+
+            self.render_plot(record, pause=2)
+
+        return wavelength_solution
 
     def get_wsolution(self):
         """Get the mathematical model of the wavelength solution
@@ -554,11 +905,10 @@ class WavelengthCalibration(object):
         # print(round(new_order))
         peaks = signal.argrelmax(filtered_data, axis=0, order=new_order)[0]
 
-        if slit_size >= 5:
+        if float(slit_size) >= 5:
 
             lines_center = self.recenter_broad_lines(lamp_data=no_nan_lamp_data,
                                                      lines=peaks,
-                                                     slit_size=slit_size,
                                                      order=new_order)
         else:
             # lines_center = peaks
@@ -592,10 +942,11 @@ class WavelengthCalibration(object):
     def recenter_lines(self, data, lines, plots=False):
         """Finds the centroid of an emission line
 
-        For every line center (pixel value) it will scan left first until the
-        data stops decreasing, it assumes it is an emission line and then will
-        scan right until it stops decreasing too. Defined those limits it will
-        use the line data in between and calculate the centroid.
+        For every line center (pixel value) it will find where the data stops
+        decreasing to the left and to the right, it assumes it is an emission
+        line. Defined those limits it will use the line data in between and
+        calculate the centroid. All lines are processed at once, see
+        goodman_spec.centroiding.recenter_lines.
 
         Notes:
             This method is used to recenter relatively narrow lines only, there
@@ -612,74 +963,11 @@ class WavelengthCalibration(object):
             A list containing the recentered line positions.
 
         """
-        new_center = []
-        x_size = data.shape[0]
-        median = np.median(data)
-        for line in lines:
-            # TODO (simon): Check if this definition is valid, so far is not
-            # TODO (cont..): critical
-            left_limit = 0
-            right_limit = 1
-            condition = True
-            left_index = int(line)
-
-            while condition and left_index - 2 > 0:
-
-                if (data[left_index - 1] > data[left_index]) and \
-                        (data[left_index - 2] > data[left_index - 1]):
-
-                    condition = False
-                    left_limit = left_index
-
-                elif data[left_index] < median:
-                    condition = False
-                    left_limit = left_index
-
-                else:
-                    left_limit = left_index
-
-                left_index -= 1
-
-            # id right limit
-            condition = True
-            right_index = int(line)
-            while condition and right_index + 2 < x_size - 1:
-
-                if (data[right_index + 1] > data[right_index]) and \
-                        (data[right_index + 2] > data[right_index + 1]):
-
-                    condition = False
-                    right_limit = right_index
-
-                elif data[right_index] < median:
-                    condition = False
-                    right_limit = right_index
-
-                else:
-                    right_limit = right_index
-                right_index += 1
-            index_diff = [abs(line - left_index), abs(line - right_index)]
-
-            sub_x_axis = range(line - min(index_diff),
-                               (line + min(index_diff)) + 1)
-
-            sub_data = data[line - min(index_diff):(line + min(index_diff)) + 1]
-            centroid = np.sum(sub_x_axis * sub_data) / np.sum(sub_data)
-
-            # checks for asymmetries
-            differences = [abs(data[line] - data[left_limit]),
-                           abs(data[line] - data[right_limit])]
-
-            if max(differences) / min(differences) >= 2.:
-                if plots:
-                    plt.axvspan(line - 1, line + 1, color='g', alpha=0.3)
-                new_center.append(line + 1)
-            else:
-                new_center.append(centroid + 1)
+        new_center = list(centroiding.recenter_lines(data, lines))
         if plots:
             fig = plt.figure(1)
             fig.canvas.set_window_title('Lines Detected in Lamp')
-            plt.axhline(median, color='b')
+            plt.axhline(np.median(data), color='b')
 
             plt.plot(self.raw_pixel_axis,
                      data,
@@ -706,6 +994,10 @@ class WavelengthCalibration(object):
     def recenter_broad_lines(self, lamp_data, lines, order):
         """Recenter broad lines
 
+        Fits a gaussian to every line, as a parabola fitted to the logarithm
+        of the data, all lines at once. See
+        goodman_spec.centroiding.recenter_broad_lines.
+
         Notes:
             This method is used to recenter broad lines only, there is a special
             method for dealing with narrower lines.
@@ -724,30 +1016,9 @@ class WavelengthCalibration(object):
         """
         # TODO (simon): use slit size information for a square function
         # TODO (simon): convolution
-        new_line_centers = []
-        gaussian_kernel = Gaussian1DKernel(stddev=2.)
-        lamp_data = convolve(lamp_data, gaussian_kernel)
-        for line in lines:
-            lower_index = max(0, int(line - order))
-            upper_index = min(len(lamp_data), int(line + order))
-            lamp_sample = lamp_data[lower_index:upper_index]
-            x_axis = np.linspace(lower_index, upper_index, len(lamp_sample))
-            line_max = np.max(lamp_sample)
-
-            gaussian_model = models.Gaussian1D(amplitude=line_max,
-                                               mean=line,
-                                               stddev=order)
-
-            fit_gaussian = fitting.LevMarLSQFitter()
-            fitted_gaussian = fit_gaussian(gaussian_model, x_axis, lamp_sample)
-            new_line_centers.append(fitted_gaussian.mean.value)
-            # if self.args.debug_mode:
-            #     plt.plot(x_axis, lamp_sample)
-            #     plt.plot(x_axis, gaussian_model(x_axis))
-            #     plt.plot(x_axis, fitted_gaussian(x_axis), color='k')
-            #     plt.axvline(line)
-            #     plt.show()
-        return new_line_centers
+        return list(centroiding.recenter_broad_lines(data=lamp_data,
+                                                     lines=lines,
+                                                     order=order))
 
     def get_spectral_characteristics(self):
         """Calculates some Goodman's specific spectroscopic values.
@@ -764,6 +1035,7 @@ class WavelengthCalibration(object):
                 red: Red limit in Angstrom
                 alpha: Angle
                 beta: Angle
+                dispersion: Angstrom per pixel
                 pix1: Pixel One
                 pix2: Pixel Two
 
@@ -795,6 +1067,11 @@ class WavelengthCalibration(object):
         self.center_wavelength = (np.sin(self.alpha) +
                                   np.sin(self.beta)) / self.grating_frequency
 
+        # grating equation derivative, angstrom per binned pixel
+        self.dispersion = (np.cos(self.beta) * self.pixel_size *
+                           self.serial_binning / self.goodman_focal_length /
+                           self.grating_frequency).to(u.angstrom)
+
         limit_angle = np.arctan(
             self.pixel_count *
             (self.pixel_size / self.goodman_focal_length) / 2)
@@ -822,6 +1099,7 @@ class WavelengthCalibration(object):
                                     'red': self.red_limit,
                                     'alpha': self.alpha,
                                     'beta': self.beta,
+                                    'dispersion': self.dispersion,
                                     'pix1': pixel_one,
                                     'pix2': pixel_two}
         return spectral_characteristics
@@ -889,12 +1167,9 @@ class WavelengthCalibration(object):
         if data_name == 'reference':
             pseudo_center = np.argmin(abs(self.reference_solution[0] - x_data))
 
-            reference_line_index = np.argmin(
-                abs(self.reference_data.get_line_list_by_name(
-                    self.lamp_name) - x_data))
-
-            reference_line_value = self.reference_data.get_line_list_by_name(
-                self.lamp_name)[reference_line_index]
+            reference_line_value = self.reference_data.get_nearest_lines(
+                lamp_name=self.lamp_name,
+                values=[x_data])[0]
 
             sub_x = self.reference_solution[0][
                     pseudo_center - 10: pseudo_center + 10]
@@ -939,7 +1214,8 @@ class WavelengthCalibration(object):
             return reference_line_value
         elif data_name == 'raw-data':
             pseudo_center = np.argmin(abs(self.raw_pixel_axis - x_data))
-            raw_line_index = np.argmin(abs(self.lines_center - x_data))
+            raw_line_index = np.argmin(
+                np.abs(np.asarray(self.lines_center) - x_data))
             raw_line_value = self.lines_center[raw_line_index]
             # print(raw_line_value)
             sub_x = self.raw_pixel_axis[pseudo_center - 10: pseudo_center + 10]
@@ -1020,7 +1296,8 @@ class WavelengthCalibration(object):
         comparison lamps. It will only process them if they are the exact match.
         A workflow summary is presented below:
           - Identify the exactly matching reference comparison lamp. If it
-            doesn't exist it will return None. If it does exist the reference
+            doesn't exist the lines are identified by their pattern instead,
+            see `pattern_wavelength_solution`. If it does exist the reference
             lamp will be loaded and it's wavelength solution read.
           - Identify lines in the new lamp, the lamp data has been already
             loaded at the initialization of the class
@@ -1045,11 +1322,19 @@ class WavelengthCalibration(object):
           - Once these values are cleaned of rejected values the final solution
             is calculated.
 
+        Before all that, the solution library is searched for a previous
+        solution of the same configuration, see
+        `library_wavelength_solution`. If the lines it predicts match, the
+        reference lamp is not used at all.
+
         Returns:
             None in case it is not possible to find a suitable template lamp or
             if is not possible to calculate the solution.
 
         """
+        if self.library_wavelength_solution():
+            return None
+
         # TODO (simon): Implement the use of the binning value
         try:
             # reference_lamp_file = self.reference_data.get_best_reference_lamp(
@@ -1059,30 +1344,20 @@ class WavelengthCalibration(object):
 
             log.debug('Found reference lamp: {:s}'.format(reference_lamp_file))
 
-            reference_lamp_data = CCDData.read(reference_lamp_file, unit=u.adu)
         except NotImplementedError:
 
-            log.warning('This configuration is not supported in '
-                        'automatic mode.')
-
-            # TODO (simon): Evaluate if send this to interactive mode
+            log.warning('There is no reference lamp for this configuration, '
+                        'identifying the lines by their pattern.')
+            if not self.pattern_wavelength_solution():
+                log.warning('This configuration is not supported in '
+                            'automatic mode.')
             return None
 
-        read_wsolution = ReadWavelengthSolution(
-            header=reference_lamp_data.header, data=reference_lamp_data.data)
-
-        reference_lamp_wav_axis, reference_lamp_data.data = read_wsolution()
-        reference_lamp_copy = reference_lamp_data.copy()
-
-        if False:
-            box_kernel = Box1DKernel(width=33)
-            test = convolve(reference_lamp_copy.data, box_kernel)
-
-        else:
-            gaussian_kernel = Gaussian1DKernel(stddev=3.)
-
-            reference_lamp_copy.data = convolve(reference_lamp_copy.data,
-                                                gaussian_kernel)
+        # wavelength axis, flux and solution of the reference lamp are read
+        # and preprocessed only once per process.
+        template = get_lamp_template(reference_lamp_file)
+        reference_lamp_wav_axis = template.wav_axis
+        reference_lamp_flux = template.flux
 
         # Initialize wavelength builder class
         wavelength_solution = WavelengthFitter(model='chebyshev',
@@ -1090,13 +1365,8 @@ class WavelengthCalibration(object):
         # self.wsolution = wavelength_solution.ws_fit(pixel, auto_angs)
 
         '''detect lines in comparison lamp (not reference)'''
-        lamp_lines_pixel = self.get_lines_in_lamp()
-        lamp_lines_angst = read_wsolution.math_model(lamp_lines_pixel)
-
-        pixel_values = []
-        angstrom_values = []
-        correlation_values = []
-        angstrom_differences = []
+        with instrumentation.stage('line_detection'):
+            lamp_lines_pixel = self.get_lines_in_lamp()
 
         log.debug('Length {:d}'.format(len(self.lamp_data)))
         log.debug('NLines {:d}'.format(len(lamp_lines_pixel)))
@@ -1107,58 +1377,64 @@ class WavelengthCalibration(object):
         half_width = int((len(self.lamp_data) /
                           float(len(lamp_lines_pixel))) / 2.)
 
-        for i in range(len(lamp_lines_pixel)):
-            line_value_pixel = lamp_lines_pixel[i]
-            line_value_angst = lamp_lines_angst[i]
-            # half_width = 100
-
-            xmin = int(max(0, round(line_value_pixel - half_width)))
-
-            xmax = int(min(round(line_value_pixel + half_width),
-                           len(self.lamp_data)))
-
-            if xmin >= xmax:
-                continue
-            # print(xmin, xmax, self.lamp_data.size)
-            # TODO (simon): Convolve to match wider lines such as those from
-            # TODO (cont): the slit of 5 arseconds
-            ref_sample = reference_lamp_data.data[xmin:xmax]
-            ref_wavele = reference_lamp_wav_axis[xmin:xmax]
-            lamp_sample = self.lamp_data[xmin:xmax]
-
-            correlation_value = self.cross_correlation(ref_sample, lamp_sample)
-            log.debug('Cross correlation value '
-                      '{:s}'.format(str(correlation_value)))
-
-            """record value for reference wavelength"""
-            angstrom_value_model = read_wsolution.math_model(
-                line_value_pixel + correlation_value)
-
-            correlation_values.append(correlation_value)
-            angstrom_differences.append(angstrom_value_model - line_value_angst)
-            angstrom_values.append(angstrom_value_model)
-            pixel_values.append(line_value_pixel)
-
-            if False:
-                plt.ion()
-                plt.title('Samples after cross correlation')
-                plt.xlabel('Pixel Axis')
-                plt.ylabel('Intensity')
-
-                plt.plot(ref_sample,
-                         color='k',
-                         label='Reference Sample')
-
-                plt.plot([x + correlation_value for x in
-                          range(len(lamp_sample))],
-                         lamp_sample,
-                         label='New Lamp Sample')
-
-                plt.legend(loc='best')
-                plt.draw()
-                plt.pause(1)
-                plt.clf()
-                plt.ioff()
+        lamp_lines_pixel = np.asarray(lamp_lines_pixel, dtype=float)
+
+        # coarse registration of the whole lamp, lines are then refined in
+        # narrow windows around their predicted position in the reference.
+        with instrumentation.stage('registration'):
+            shift, stretch, quality = global_registration(
+                reference_flux=reference_lamp_flux,
+                lamp_flux=self.lamp_data,
+                max_stretch=self.args.max_stretch,
+                reference=template.registration_flux)
+
+        if quality >= MIN_REGISTRATION_QUALITY:
+            log.info('Lamp registration: shift {:.1f} pixels, stretch '
+                     '{:.4f}'.format(shift, stretch))
+            reference_offsets = np.round(
+                reference_position(pixels=lamp_lines_pixel,
+                                   shift=shift,
+                                   stretch=stretch,
+                                   length=len(self.lamp_data)) -
+                lamp_lines_pixel)
+            half_width = refinement_half_width(
+                half_width=half_width,
+                slit=self.lamp_header['SLIT'])
+        else:
+            log.warning('Lamp registration failed, correlation '
+                        '{:.2f}'.format(quality))
+            reference_offsets = np.zeros(len(lamp_lines_pixel))
+
+        xmin = np.maximum(0, np.round(lamp_lines_pixel - half_width))
+        xmax = np.minimum(np.round(lamp_lines_pixel + half_width),
+                          len(self.lamp_data))
+        reference_xmin = xmin + reference_offsets
+
+        # windows must not be empty neither in the lamp nor in the reference
+        valid = (xmin < xmax) & (reference_xmin >= 0) & \
+                (reference_xmin < len(reference_lamp_flux))
+
+        # all line windows are correlated at once, see registration.py
+        with instrumentation.stage('cross_correlation'):
+            correlation_values = reference_offsets[valid] + line_shifts(
+                reference_flux=reference_lamp_flux,
+                lamp_flux=self.lamp_data,
+                starts=xmin[valid],
+                stops=xmax[valid],
+                slit=self.lamp_header['SLIT'],
+                reference_starts=reference_xmin[valid])
+        log.debug('Cross correlation values '
+                  '{:s}'.format(str(correlation_values)))
+
+        pixel_values = lamp_lines_pixel[valid]
+
+        """record value for reference wavelength"""
+        angstrom_values = template.math_model(pixel_values +
+                                              correlation_values)
+
+        pixel_values = list(pixel_values)
+        angstrom_values = list(angstrom_values)
+        correlation_values = list(correlation_values)
 
         # This is good and necessary as a first approach for some very wrong
         # correlation results
@@ -1218,48 +1494,202 @@ class WavelengthCalibration(object):
 
         self.evaluate_solution()
 
-        if self.args.plot_results or self.args.debug_mode:
-            plt.switch_backend('Qt4Agg')
-            if self.i_fig is None:
-                self.i_fig = plt.figure(figsize=(15, 10))
-                self.i_fig.canvas.set_window_title(
-                    'Automatic Wavelength Solution')
-            else:
-                self.i_fig.clf()
+        self.plot_automatic_solution(
+            pixel_values=pixel_values,
+            angstrom_values=angstrom_values,
+            reference_wav_axis=reference_lamp_wav_axis,
+            reference_flux=reference_lamp_flux)
 
-            if not self.args.debug_mode:
-                plt.ion()
-                # plt.show()
-            else:
-                plt.ioff()
+    def match_lines(self, model, tolerance=LIBRARY_MATCH_PIXELS):
+        """Pairs the lines of the lamp with reference lines using a solution
 
-            manager = plt.get_current_fig_manager()
+        See goodman_spec.linelist.match_lines.
+
+        Args:
+            model (object): Wavelength solution, a callable that converts
+                pixels to angstrom.
+            tolerance (float): Largest distance in pixels between the
+                predicted position of a line and its reference line.
 
-            if plt.get_backend() == u'GTK3Agg':
-                manager.window.maximize()
-            elif plt.get_backend() == u'Qt4Agg':
-                manager.window.showMaximized()
+        Returns:
+            Two arrays, the pixel position of the matched lines and the
+            wavelength of their reference lines.
 
-            self.ax1 = self.i_fig.add_subplot(111)
+        """
+        return match_lines(
+            pixels=self.lines_center,
+            model=model,
+            sorted_lines=self.reference_data.get_line_list_by_name(
+                self.lamp_name),
+            tolerance=tolerance)
+
+    def solution_rms_pixels(self):
+        """RMS error of the current solution in pixels"""
+        length = len(self.lamp_data)
+        dispersion = abs(self.wsolution(length - 1) - self.wsolution(0)) / \
+            float(length - 1)
+        return self.rms_error / dispersion
+
+    def library_wavelength_solution(self):
+        """Finds a wavelength solution starting from the solution library
+
+        The solution of the library closest in time for the configuration of
+        the lamp predicts the wavelength of the detected lines. If enough of
+        them fall on a reference line the solution is fitted again to those
+        lines, see `fit_identified_lines`.
 
-            self.ax1.plot([], color='m', label='Pixels')
-            self.ax1.plot([], color='c', label='Angstrom')
-            for val in pixel_values:
-                self.ax1.axvline(self.wsolution(val), color='m')
-            for val2 in angstrom_values:
-                self.ax1.axvline(val2, color='c', linestyle='--')
+        Returns:
+            True if the solution was found, then it is in `wsolution`.
 
-            self.ax1.plot(reference_lamp_wav_axis,
-                          reference_lamp_data.data,
-                          label='Reference',
-                          color='k',
-                          alpha=1)
+        """
+        if self.solution_library is None or len(self.lines_center) == 0:
+            return False
+
+        entry = self.solution_library.lookup(header=self.lamp_header,
+                                             length=len(self.lamp_data))
+        if entry is None:
+            log.debug('No library solution for this configuration')
+            return False
+
+        with instrumentation.stage('library_match'):
+            pixel_values, angstrom_values = self.match_lines(
+                model=entry_model(entry))
+
+        return self.fit_identified_lines(
+            pixel_values=pixel_values,
+            angstrom_values=angstrom_values,
+            source='library solution of {:s} {:s}'.format(entry['file'],
+                                                          entry['date']))
+
+    def pattern_wavelength_solution(self):
+        """Finds a wavelength solution without a reference lamp
+
+        The detected lines are identified by the pattern of their spacings,
+        using the dispersion and central wavelength predicted by
+        `get_spectral_characteristics`, see
+        goodman_spec.line_identification. The solution is then fitted with
+        `fit_identified_lines`.
+
+        Returns:
+            True if the solution was found, then it is in `wsolution`.
+
+        """
+        if self.dispersion is None:
+            self.get_spectral_characteristics()
+
+        lines_center = np.asarray(self.lines_center, dtype=float)
+        intensities = np.nan_to_num(self.lamp_data)[
+            np.clip(np.round(lines_center).astype(int),
+                    0,
+                    len(self.lamp_data) - 1)]
+
+        with instrumentation.stage('line_identification'):
+            pixel_values, angstrom_values = identify_lines(
+                pixels=lines_center,
+                length=len(self.lamp_data),
+                reference_lines=self.reference_data.get_line_list_by_name(
+                    self.lamp_name),
+                center_wavelength=self.center_wavelength.to(
+                    u.angstrom).value,
+                dispersion=self.dispersion.to(u.angstrom).value,
+                intensities=intensities)
+
+        return self.fit_identified_lines(pixel_values=pixel_values,
+                                         angstrom_values=angstrom_values,
+                                         source='their pattern')
+
+    def fit_identified_lines(self, pixel_values, angstrom_values, source):
+        """Fits a wavelength solution to identified lines and checks it
+
+        The solution is fitted to the identified lines, and once more to the
+        lines matched by it, see `match_lines`. It is rejected if too few
+        lines were identified or its RMS error is larger than
+        LIBRARY_MAX_RMS_PIXELS.
+
+        Args:
+            pixel_values (array): Pixel position of the identified lines.
+            angstrom_values (array): Wavelength of their reference lines.
+            source (str): How the lines were identified, for the log.
+
+        Returns:
+            True if the solution was accepted, then it is in `wsolution`.
+
+        """
+        n_lines = len(self.lines_center)
+        if len(pixel_values) < max(LIBRARY_MIN_LINES,
+                                   LIBRARY_MIN_MATCH_FRACTION * n_lines):
+            log.info('{:d} of {:d} lines identified by {:s}'.format(
+                len(pixel_values), n_lines, source))
+            return False
+
+        wavelength_solution = WavelengthFitter(model='chebyshev',
+                                               degree=self.poly_order)
+        self.wsolution = wavelength_solution.ws_fit(pixel_values,
+                                                    angstrom_values)
+        if self.wsolution is not None:
+            pixel_values, angstrom_values = self.match_lines(
+                model=self.wsolution)
+            self.wsolution = wavelength_solution.ws_fit(pixel_values,
+                                                        angstrom_values)
+        if self.wsolution is None:
+            return False
+
+        self.evaluate_solution()
+        if self.solution_rms_pixels() > LIBRARY_MAX_RMS_PIXELS:
+            log.info('Lines identified by {:s} give RMS Error '
+                     '{:.3f}'.format(source, self.rms_error))
+            self.wsolution = None
+            self.rms_error = None
+            return False
+
+        log.info('{:d} lines identified by {:s}'.format(len(pixel_values),
+                                                        source))
+
+        self.plot_automatic_solution(pixel_values=pixel_values,
+                                     angstrom_values=angstrom_values)
+        return True
+
+    def save_solution(self):
+        """Saves the current solution to the solution library
 
-            self.ax1.plot(self.wsolution(self.raw_pixel_axis),
-                          self.lamp_data,
-                          label='Last Solution',
-                          color='r',
-                          alpha=0.7)
+        Only solutions with an RMS error below LIBRARY_MAX_RMS_PIXELS that
+        match at least LIBRARY_MIN_LINES lines are saved.
+
+        """
+        if self.solution_library is None or self.rms_error is None:
+            return
+        if self.solution_rms_pixels() > LIBRARY_MAX_RMS_PIXELS:
+            log.debug('Solution not saved to the library, RMS Error '
+                      '{:.3f}'.format(self.rms_error))
+            return
+
+        pixel_values, angstrom_values = self.match_lines(model=self.wsolution)
+        if len(pixel_values) < LIBRARY_MIN_LINES:
+            return
+
+        entry = make_entry(header=self.lamp_header,
+                           length=len(self.lamp_data),
+                           model=self.wsolution,
+                           rms_error=self.rms_error,
+                           pixels=pixel_values,
+                           wavelengths=angstrom_values)
+        if entry is not None:
+            self.solution_library.add(entry)
+
+    def plot_automatic_solution(self, pixel_values, angstrom_values,
+                                reference_wav_axis=None, reference_flux=None):
+        """Plots the automatic wavelength solution if requested
+
+        Args:
+            pixel_values (list): Pixel position of the lines fitted.
+            angstrom_values (list): Wavelength of the lines fitted.
+            reference_wav_axis (array): Wavelength axis of the reference lamp,
+                None if no reference lamp was used.
+            reference_flux (array): Flux of the reference lamp.
+
+        """
+        if self.args.plot_results or self.args.debug_mode or \
+                self.args.save_plots:
 
             try:
                 wavmode = self.lamp_header['wavmode']
@@ -1267,45 +1697,96 @@ class WavelengthCalibration(object):
                 log.debug(error)
                 wavmode = ''
 
-            self.ax1.set_xlabel('Wavelength (Angstrom)')
-            self.ax1.set_ylabel('Intensity (ADU)')
-
-            self.ax1.set_title('Automatic Wavelength Solution\n'
-                               + self.lamp_header['OBJECT']
-                               + ' ' + wavmode + '\n'
-                               + 'RMS Error: {:.3f}'.format(self.rms_error))
+            record = PlotRecord(
+                title='Automatic Wavelength Solution\n'
+                      + self.lamp_header['OBJECT']
+                      + ' ' + wavmode + '\n'
+                      + 'RMS Error: {:.3f}'.format(self.rms_error),
+                window_title='Automatic Wavelength Solution',
+                xlabel='Wavelength (Angstrom)',
+                ylabel='Intensity (ADU)',
+                figsize=(15, 10))
+
+            record.plot([], [], color='m', label='Pixels')
+            record.plot([], [], color='c', label='Angstrom')
+            record.axvlines(self.wsolution(pixel_values), color='m')
+            record.axvlines(angstrom_values, color='c', linestyle='--')
+
+            if reference_wav_axis is not None:
+                record.plot(reference_wav_axis,
+                            reference_flux,
+                            label='Reference',
+                            color='k',
+                            alpha=1)
 
-            self.ax1.legend(loc='best')
-            self.i_fig.tight_layout()
+            record.plot(self.wsolution(self.raw_pixel_axis),
+                        self.lamp_data,
+                        label='Last Solution',
+                        color='r',
+                        alpha=0.7)
 
-            if self.args.save_plots:
+            if self.args.save_plots or self.args.no_pause:
                 # saves pdf files of the wavelength solution plot
                 out_file_name = 'automatic-solution_' + self.lamp_header[
                     'OBJECT']
-
-                file_count = len(glob.glob(os.path.join(self.args.destiny,
-                                                        out_file_name + '*')))
-
-                out_file_name += '_{:04d}.pdf'.format(file_count)
-                pdf_pages = PdfPages(
-                    os.path.join(self.args.destiny, out_file_name))
-                plt.savefig(pdf_pages, format='pdf')
-                pdf_pages.close()
+                pdf_name = self.plot_file_name(self.args.destiny,
+                                               out_file_name,
+                                               '.pdf')
+                record.add_output(pdf_name)
 
                 # saves png images
                 plots_path = os.path.join(self.args.destiny, 'plots')
                 if not os.path.isdir(plots_path):
                     os.path.os.makedirs(plots_path)
-                plot_name = os.path.join(plots_path, out_file_name + '.png')
-                plt.savefig(plot_name, dpi=300)
-            if self.args.debug_mode:
-                plt.show()
+                plot_name = os.path.join(plots_path,
+                                         os.path.basename(pdf_name) + '.png')
+                record.add_output(plot_name, dpi=300)
+
+            self.render_plot(record, pause=1)
+
+    def render_plot(self, record, pause=2):
+        """Saves and/or displays a diagnostic plot according to the arguments
+
+        Files are rendered by the deferred plot renderer if there is one,
+        otherwise they are rendered right away. The plot is displayed on screen
+        with `--plot-results` or `--debug` unless `--no-pause` is set, in which
+        case it is only saved.
+
+        Args:
+            record (object): goodman_spec.plot_renderer.PlotRecord instance.
+            pause (float): Seconds the plot is displayed in non-debug mode.
+
+        """
+        if record.outputs:
+            if self.plot_renderer is not None:
+                self.plot_renderer.submit(record)
             else:
-                plt.draw()
-                plt.pause(1)
-                plt.ioff()
-                plt.close()
-                # plt.close(self.i_fig)
+                render_plot_record(record)
+
+        if (self.args.plot_results or self.args.debug_mode) and \
+                not self.args.no_pause:
+            show_plot_record(record, block=self.args.debug_mode, pause=pause)
+
+    def plot_file_name(self, path, base_name, extension):
+        """Numbered name for a plot file that doesn't exist yet
+
+        Args:
+            path (str): Directory of the file.
+            base_name (str): File name without number nor extension.
+            extension (str): File extension including the dot.
+
+        Returns:
+            Full path of the form path/base_name_NNNN.extension
+
+        """
+        if self.plot_renderer is not None:
+            return self.plot_renderer.unique_file_name(path,
+                                                       base_name,
+                                                       extension)
+        file_count = len(glob.glob(os.path.join(path, base_name + '*')))
+        return os.path.join(path, '{:s}_{:04d}{:s}'.format(base_name,
+                                                           file_count,
+                                                           extension))
 
     def interactive_wavelength_solution(self, object_name=''):
         """Find the wavelength solution interactively
@@ -1388,10 +1869,8 @@ class WavelengthCalibration(object):
         if reference_file is not None:
             log.info('Using reference file: {:s}'.format(reference_file))
             reference_plots_enabled = True
-            ref_data = fits.getdata(reference_file)
-            ref_header = fits.getheader(reference_file)
-            fits_ws_reader = ReadWavelengthSolution(ref_header, ref_data)
-            self.reference_solution = fits_ws_reader()
+            template = get_lamp_template(reference_file)
+            self.reference_solution = [template.wav_axis, template.flux]
         else:
             reference_plots_enabled = False
             log.error('Please Check the OBJECT Keyword of your reference data')
@@ -1855,22 +2334,13 @@ class WavelengthCalibration(object):
         square_differences = []
         if self.wsolution is not None:
             wlines = self.wsolution(self.lines_center)
-            for i in range(len(wlines)):
-                # [abs(list_val - wlines[i]) for list_val in \
-                # self.reference_data.get_line_list_by_name(self.lamp_name)]
-
-                closer_index = np.argmin(
-                    abs(self.reference_data.get_line_list_by_name(
-                        self.lamp_name) - wlines[i]))
-
-                rline = self.reference_data.get_line_list_by_name(
-                    self.lamp_name)[closer_index]
-
-                rw_difference = wlines[i] - rline
-                # print('Difference w - r ', rw_difference, rline)
-                square_differences.append(rw_difference ** 2)
-                new_physical.append(self.lines_center[i])
-                new_wavelength.append(rline)
+            rlines = self.reference_data.get_nearest_lines(
+                lamp_name=self.lamp_name,
+                values=wlines)
+
+            square_differences = list((wlines - rlines) ** 2)
+            new_physical = list(self.lines_center)
+            new_wavelength = list(rlines)
             clipped_differences = sigma_clip(square_differences,
                                              sigma=2,
                                              iters=3)
@@ -1999,20 +2469,13 @@ class WavelengthCalibration(object):
 
         """
         if self.wsolution is not None:
-            differences = np.array([])
             wavelength_line_centers = self.wsolution(self.lines_center)
 
-            for wline in wavelength_line_centers:
-                closer_index = np.argmin(
-                    abs(self.reference_data.get_line_list_by_name(
-                        self.lamp_name) - wline))
-
-                rline = self.reference_data.get_line_list_by_name(
-                    self.lamp_name)[closer_index]
-
-                rw_difference = wline - rline
-                # print 'Difference w - r ', rw_difference, rline
-                differences = np.append(differences, rw_difference)
+            # closest reference line to every line center, all at once
+            differences = wavelength_line_centers - \
+                self.reference_data.get_nearest_lines(
+                    lamp_name=self.lamp_name,
+                    values=wavelength_line_centers)
 
             clipping_sigma = 2.
             # print(differences)
@@ -2028,10 +2491,7 @@ class WavelengthCalibration(object):
 
             npoints = len(clipped_differences)
             n_rejections = np.ma.count_masked(clipped_differences)
-            square_differences = []
-            for i in range(len(clipped_differences)):
-                if clipped_differences[i] is not np.ma.masked:
-                    square_differences.append(clipped_differences[i] ** 2)
+            square_differences = np.ma.compressed(clipped_differences) ** 2
             old_rms_error = None
             if self.rms_error is not None:
                 old_rms_error = float(self.rms_error)
@@ -2182,6 +2642,45 @@ class WavelengthCalibration(object):
             if self.wsolution is not None:
                 self.wsolution = None
 
+    def get_linearizer(self, size):
+        """Linearizer for the current wavelength solution
+
+        The interpolation weights depend only on the wavelength solution and
+        the length of the spectra, so they are kept until any of them changes.
+
+        Args:
+            size (int): Length of the spectra.
+
+        Returns:
+            A goodman_spec.linearization.Linearizer instance.
+
+        """
+        if self._linearizer is None or \
+                self._linearizer_solution is not self.wsolution or \
+                len(self._linearizer.x_axis) != size:
+            self._linearizer = Linearizer(self.wsolution(np.arange(size)))
+            self._linearizer_solution = self.wsolution
+        return self._linearizer
+
+    def linearize_spectra(self, data_list):
+        """Linearizes several spectra with the current wavelength solution
+
+        All the spectra are resampled at once, see linearize_spectrum.
+
+        Args:
+            data_list (list): Non linear spectra, all of the same length.
+
+        Returns:
+            A list with the linearized version of every spectrum, each one
+            contains the linear wavelength axis and the smoothed linearized
+            data.
+
+        """
+        linearizer = self.get_linearizer(len(data_list[0]))
+        with instrumentation.stage('linearization', frames=len(data_list)):
+            linearized = linearizer(np.array(data_list))
+        return [[linearizer.new_x_axis, data] for data in linearized]
+
     def linearize_spectrum(self, data, plots=False):
         """Produces a linearized version of the spectrum
 
@@ -2208,17 +2707,13 @@ class WavelengthCalibration(object):
         # for data_point in data:
         #     print(data_point)
         # print('data ', data)
-        pixel_axis = range(len(data))
-        # print(pixel_axis)
         if self.wsolution is not None:
-            x_axis = self.wsolution(pixel_axis)
-            new_x_axis = np.linspace(x_axis[0], x_axis[-1], len(data))
-            tck = scipy.interpolate.splrep(x_axis, data, s=0)
-            linearized_data = scipy.interpolate.splev(new_x_axis,
-                                                      tck,
-                                                      der=0)
-
-            smoothed_linearized_data = signal.medfilt(linearized_data)
+            linearizer = self.get_linearizer(len(data))
+            x_axis = linearizer.x_axis
+            new_x_axis = linearizer.new_x_axis
+            with instrumentation.stage('linearization', frames=1):
+                linearized_data = linearizer(data, smooth=False)
+                smoothed_linearized_data = signal.medfilt(linearized_data)
             # print('sl ', smoothed_linearized_data)
             if plots:
                 fig6 = plt.figure(6)
@@ -2265,7 +2760,8 @@ class WavelengthCalibration(object):
                                 spectrum,
                                 original_filename,
                                 evaluation_comment=None,
-                                index=None):
+                                index=None,
+                                variance=None):
         """Add wavelength solution to the new FITS header
 
         Defines FITS header keyword values that will represent the wavelength
@@ -2285,6 +2781,8 @@ class WavelengthCalibration(object):
             quality of the wavelength solution
             index (int): If in one 2D image there are more than one target the
             index represents the target number.
+            variance (array): Optional variance of the spectrum, it is written
+            in an image extension named VARIANCE.
 
         Returns:
             new_header (object): An Astropy header object. Although not
@@ -2344,7 +2842,19 @@ class WavelengthCalibration(object):
         # print(spectrum[1])
         # print(len(spectrum))
 
-        fits.writeto(new_filename, spectrum[1], new_header, clobber=True)
+        # comparison lamps can be written by several worker processes, the
+        # file is renamed into place once complete
+        temporary_filename = '{:s}.{:d}.tmp'.format(new_filename, os.getpid())
+        if variance is None:
+            fits.writeto(temporary_filename, spectrum[1], new_header,
+                         clobber=True)
+        else:
+            hdu_list = fits.HDUList([
+                fits.PrimaryHDU(data=spectrum[1], header=new_header),
+                fits.ImageHDU(data=variance, name='VARIANCE')])
+            hdu_list.writeto(temporary_filename, clobber=True)
+        os.rename(temporary_filename, new_filename)
+        instrumentation.record_write(new_filename)
         log.info('Created new file: {:s}'.format(new_filename))
         # print new_header
         return new_header
@@ -2629,68 +3139,40 @@ class WavelengthSolution(object):
         """
         if header is not None:
             new_dict = self.set_spectral_features(header)
+            camera = str(self.spectral_dict['camera']).lower()
+            if camera == 'red':
+                exact_keys = ['grating', 'roi', 'instconf', 'wavmode']
+            else:
+                exact_keys = ['grating', 'ccdsum', 'serial_bin',
+                              'parallel_bin']
             for key in new_dict.keys():
-                if self.spectral_dict['camera'] == 'red':
-                    if key in ['grating', 'roi', 'instconf', 'wavmode'] and \
-                                    new_dict[key] != self.spectral_dict[key]:
-
-                        log.info('Keyword: {:s} does not Match'.format(
-                            key.upper()))
-
-                        log.info('{:s} - Solution: {:s} - New '
-                                 'Data: {:s}'.format(key.upper(),
-                                                     self.spectral_dict[key],
-                                                     new_dict[key]))
+                if key in exact_keys and \
+                        new_dict[key] != self.spectral_dict.get(key):
 
-                        return False
+                    log.info('Keyword: {:s} does not Match'.format(
+                        key.upper()))
 
-                    elif key in ['cam_ang',  'grt_ang'] and \
-                                    abs(new_dict[key] -
-                                                self.spectral_dict[key]) > 1:
+                    log.info('{:s} - Solution: {:s} - New '
+                             'Data: {:s}'.format(key.upper(),
+                                                 str(self.spectral_dict.get(
+                                                     key)),
+                                                 str(new_dict[key])))
 
-                        log.debug('Keyword: {:s} Lamp: {:s} Data: '
-                                  '{:s}'.format(key,
-                                                self.spectral_dict[key],
-                                                new_dict[key]))
+                    return False
 
-                        log.info('Solution belong to a different Instrument'
-                                 'Configuration.')
+                elif key in ['cam_ang', 'grt_ang'] and \
+                        abs(float(new_dict[key]) -
+                            float(self.spectral_dict[key])) > 1:
 
-                        return False
-                    # else:
-                    #     return True
-                elif self.spectral_dict['camera'] == 'blue':
-                    if key in ['grating',
-                               'ccdsum',
-                               'serial_bin',
-                               'parallel_bin'] and \
-                                    new_dict[key] != self.spectral_dict[key]:
-
-                        log.debug('Keyword: {:s} does not Match', key.upper())
-
-                        log.info('{:s} - Solution: {:s} - New Data: {:s}',
-                                 key.upper(),
-                                 self.spectral_dict[key],
-                                 new_dict[key])
-
-                        return False
+                    log.debug('Keyword: {:s} Lamp: {:s} Data: '
+                              '{:s}'.format(key,
+                                            str(self.spectral_dict[key]),
+                                            str(new_dict[key])))
 
-                    elif key in ['cam_ang',
-                                 'grt_ang'] and abs(
-                                float(new_dict[key]) -
-                                float(self.spectral_dict[key]))> 1:
+                    log.info('Solution belong to a different Instrument '
+                             'Configuration.')
 
-                        log.debug('Keyword: {:s} Lamp: {:s} Data: {:s}',
-                                  key,
-                                  self.spectral_dict[key],
-                                  new_dict[key])
-
-                        log.info('Solution belong to a different Instrument '
-                                 'Configuration.')
-
-                        return False
-                    # else:
-                    #     return True
+                    return False
             return True
         else:
             log.error('Header has not been parsed')
@@ -6,10 +6,11 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import logging
-import matplotlib.pyplot as plt
 import shlex
 
 from astropy.modeling import models, fitting
+from goodman_ccd.instrumentation import instrumentation
+from goodman_ccd.lazy_import import plt
 
 # log.basicConfig(level=log.DEBUG)
 log = logging.getLogger('redspec.wsbuilder')
@@ -63,7 +64,10 @@ class WavelengthFitter(object):
             try:
                 # print(physical)
                 # print(wavelength)
-                fitted_model = self.model_fit(self.model, physical, wavelength)
+                with instrumentation.stage('fitting'):
+                    fitted_model = self.model_fit(self.model,
+                                                  physical,
+                                                  wavelength)
                 return fitted_model
             except TypeError as error:
                 log.info('Unable to do fit, please add more data points.')
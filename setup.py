@@ -7,8 +7,9 @@ setup(
     package_dir={'goodman_ccd': 'goodman_ccd',
                  'goodman_spec': 'goodman_spec'},
     package_data={'goodman_ccd': ['files/dcr.par'],
-                  'goodman_spec': ['refdata/*fits']},
-    scripts=['bin/redccd', 'bin/redspec'],
+                  'goodman_spec': ['refdata/*fits', 'refdata/*npz']},
+    scripts=['bin/redccd', 'bin/redspec', 'bin/goodman-reduce',
+             'bin/goodman-served', 'bin/goodman-submit'],
     url='https://github.com/soar-telescope/goodman',
     license='BSD 3-Clause',
     author='Simon Torres R.',